@@ -67,6 +67,19 @@ class Event(dict):
         self.duration = duration  # type: ignore
         self.data = data or {}
 
+    @classmethod
+    def from_trusted(
+        cls, id: Id, timestamp: datetime, duration: timedelta, data: Data
+    ) -> "Event":
+        """
+        Creates an event without parsing or normalizing the arguments, useful when
+        decoding many events from storage. The timestamp must be a UTC datetime with
+        millisecond resolution, as if it had been set through the initializer.
+        """
+        event = cls.__new__(cls)
+        dict.__init__(event, id=id, timestamp=timestamp, duration=duration, data=data)
+        return event
+
     def __eq__(self, other: object) -> bool:
         if isinstance(other, Event):
             return (
@@ -1,19 +1,66 @@
-from typing import Callable, Dict
+import inspect
+import logging
+from typing import Any, Callable, Dict, Mapping
 
 from . import storages
 from .datastore import Datastore
 from .migration import check_for_migration
 
+logger = logging.getLogger(__name__)
+
 
 def get_storage_methods() -> Dict[str, Callable[..., storages.AbstractStorage]]:
-    from .storages import MemoryStorage, PeeweeStorage, SqliteStorage
+    from .storages import (
+        MemoryStorage,
+        PartitionedSqliteStorage,
+        PeeweeStorage,
+        SqliteStorage,
+    )
 
     methods: Dict[str, Callable[..., storages.AbstractStorage]] = {
         PeeweeStorage.sid: PeeweeStorage,
         MemoryStorage.sid: MemoryStorage,
         SqliteStorage.sid: SqliteStorage,
+        PartitionedSqliteStorage.sid: PartitionedSqliteStorage,
     }
     return methods
 
 
-__all__ = ["Datastore", "get_storage_methods", "check_for_migration"]
+def get_storage_kwargs(
+    storage_method: Callable[..., storages.AbstractStorage], config: Mapping
+) -> Dict[str, Any]:
+    """
+    Picks the arguments for a storage method from a config table, such as one loaded
+    with ``aw_core.config.load_config_toml``. The result can be passed to ``Datastore``.
+
+    For example, with the following in the aw-server config::
+
+        [server.storage.sqlite]
+        profile = "balanced"
+        read_connections = 4
+
+        [server.storage.sqlite.pragmas]
+        cache_size = -64000
+
+    ``get_storage_kwargs(SqliteStorage, config["server"]["storage"]["sqlite"])`` returns
+    ``{"profile": "balanced", "read_connections": 4, "pragmas": {"cache_size": -64000}}``.
+
+    Keys that the storage method doesn't accept are ignored with a warning.
+    """
+    params = inspect.signature(storage_method).parameters
+    kwargs: Dict[str, Any] = {}
+    for key, value in config.items():
+        if key not in params or key == "testing":
+            logger.warning(f"Ignoring unknown storage option '{key}'")
+            continue
+        # Tables loaded with tomlkit aren't plain dicts
+        kwargs[key] = dict(value) if isinstance(value, Mapping) else value
+    return kwargs
+
+
+__all__ = [
+    "Datastore",
+    "get_storage_methods",
+    "get_storage_kwargs",
+    "check_for_migration",
+]
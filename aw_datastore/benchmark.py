@@ -1,22 +1,49 @@
 #!/usr/bin/env python3
+"""
+Benchmarks the storage methods against each other.
+
+Prints the results as JSON so that runs can be compared before and after a change.
+
+Usage:
+
+    python -m aw_datastore.benchmark [--storage SqliteStorage] [--sizes 10000 1000000]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Callable
+from time import perf_counter
+from typing import Callable, Iterator, List, Optional
 
 from aw_core.models import Event
 
-from aw_datastore import get_storage_methods
+from aw_datastore import Datastore, get_storage_methods
 from aw_datastore.storages import AbstractStorage
 
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    resource = None  # type: ignore
+
 td1s = timedelta(seconds=1)
 
+# Inserting millions of events in a single call would require them all to be in memory at once
+BULK_CHUNK_SIZE = 100_000
+
 
-def create_test_events(n):
+def create_test_events(n, offset=0):
     now = datetime.now(timezone.utc) - timedelta(days=1000)
 
     events = []
-    for i in range(n):
+    for i in range(offset, offset + n):
         events.append(
             Event(timestamp=now + i * td1s, duration=td1s, data={"label": "asd"})
         )
@@ -36,62 +63,206 @@ def temporary_bucket(ds):
     ds.delete_bucket(bucket_id)
 
 
-def benchmark(storage: Callable[..., AbstractStorage]):
-    raise NotImplementedError(
-        "No longer implemented as ttt/takethetime dependency is removed"
-    )
+def peak_rss() -> Optional[int]:
+    """
+    Returns the peak resident set size of the process in bytes, if available.
+
+    It's the peak of the whole process, which is why ``main`` runs each benchmark
+    in a new process.
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, but in kilobytes on Linux
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _percentile(latencies: List[float], p: float) -> Optional[float]:
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    i = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[i]
+
+
+class Timer:
+    """Collects latencies of repeated operations and summarizes them"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.latencies: List[float] = []
+        self.items = 0
+
+    @contextmanager
+    def measure(self, items: int = 1) -> Iterator[None]:
+        start = perf_counter()
+        yield
+        self.latencies.append(perf_counter() - start)
+        self.items += items
 
-    # if storage.__name__ == "PeeweeStorage":
-    #     ds = Datastore(storage, testing=True, filepath="test.db")
-    # else:
-    #     ds = Datastore(storage, testing=True)
+    def summary(self) -> dict:
+        """Summarizes the latencies, which are None if the operation never ran"""
+        total = sum(self.latencies)
+        p50 = _percentile(self.latencies, 50)
+        p99 = _percentile(self.latencies, 99)
+        return {
+            "op": self.name,
+            "calls": len(self.latencies),
+            "items": self.items,
+            "total_s": total,
+            "ops_per_sec": self.items / total if total > 0 else None,
+            "p50_ms": p50 * 1000 if p50 is not None else None,
+            "p99_ms": p99 * 1000 if p99 is not None else None,
+        }
 
-    # num_single_events = 50
-    # num_replace_events = 50
-    # num_bulk_events = 20_000
-    # num_events = num_single_events + num_replace_events + num_bulk_events + 1
-    # num_final_events = num_single_events + num_bulk_events + 1
 
-    # events = create_test_events(num_events)
-    # single_events = events[:num_single_events]
-    # replace_events = events[num_single_events : num_single_events + num_replace_events]
-    # bulk_events = events[num_single_events + num_replace_events : -1]
+def _create_datastore(
+    storage: Callable[..., AbstractStorage], tmpdir: str
+) -> Datastore:
+    if storage.__name__ in ["PeeweeStorage", "SqliteStorage"]:
+        filepath = os.path.join(tmpdir, f"{storage.__name__}.db")
+        return Datastore(storage, testing=True, filepath=filepath)
+    elif storage.__name__ == "PartitionedSqliteStorage":
+        # Takes a directory, with a database file per month of events
+        filepath = os.path.join(tmpdir, storage.__name__)
+        return Datastore(storage, testing=True, filepath=filepath)
+    return Datastore(storage, testing=True)
 
-    # print(storage.__name__)
 
-    # with temporary_bucket(ds) as bucket:
-    #     with ttt(" sum"):
-    #         with ttt(f" single insert {num_single_events} events"):
-    #             for event in single_events:
-    #                 bucket.insert(event)
+def benchmark(
+    storage: Callable[..., AbstractStorage],
+    num_events: int = 20_000,
+    num_single_events: int = 50,
+    num_replace_events: int = 50,
+    num_reads: int = 50,
+) -> dict:
+    """
+    Runs the benchmark for a storage method, with a bucket containing ``num_events`` events.
 
-    #         with ttt(f" bulk insert {num_bulk_events} events"):
-    #             bucket.insert(bulk_events)
+    Returns a dict with the throughput and latencies of each operation.
+    """
+    timers = {
+        name: Timer(name)
+        for name in [
+            "insert_one",
+            "insert_bulk",
+            "replace_last",
+            "get_one",
+            "get_all",
+            "get_range",
+            "get_eventcount",
+            "buckets",
+        ]
+    }
 
-    #         with ttt(f" replace last {num_replace_events}"):
-    #             for e in replace_events:
-    #                 bucket.replace_last(e)
+    num_single_events = min(num_single_events, num_events)
 
-    #         with ttt(" insert 1 event"):
-    #             bucket.insert(events[-1])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ds = _create_datastore(storage, tmpdir)
+        with temporary_bucket(ds) as bucket:
+            for event in create_test_events(num_single_events):
+                with timers["insert_one"].measure():
+                    bucket.insert(event)
 
-    #         with ttt(" get one"):
-    #             events_tmp = bucket.get(limit=1)
+            offset = num_single_events
+            remaining = num_events - num_single_events
+            while remaining > 0:
+                chunk = create_test_events(min(BULK_CHUNK_SIZE, remaining), offset)
+                with timers["insert_bulk"].measure(len(chunk)):
+                    bucket.insert(chunk)
+                offset += len(chunk)
+                remaining -= len(chunk)
+
+            for event in create_test_events(num_replace_events, offset - 1):
+                with timers["replace_last"].measure():
+                    bucket.replace_last(event)
+
+            for _ in range(num_reads):
+                with timers["get_one"].measure():
+                    events = bucket.get(limit=1)
+                assert len(events) == 1
+
+            # Fetching everything is slow for large buckets, so only do it a few times
+            for _ in range(3):
+                with timers["get_all"].measure(num_events):
+                    events = bucket.get(limit=-1)
+                assert len(events) == num_events
+                del events
+
+            # Query a range of an hour in the middle of the bucket
+            first = create_test_events(1, num_events // 2)[0]
+            for _ in range(num_reads):
+                with timers["get_range"].measure():
+                    bucket.get(
+                        limit=-1,
+                        starttime=first.timestamp,
+                        endtime=first.timestamp + timedelta(hours=1),
+                    )
+
+            for _ in range(num_reads):
+                with timers["get_eventcount"].measure():
+                    bucket.get_eventcount()
+
+            for _ in range(num_reads):
+                with timers["buckets"].measure():
+                    ds.buckets()
+        ds.close()
+
+    return {
+        "storage": storage.__name__,
+        "num_events": num_events,
+        "operations": [timer.summary() for timer in timers.values()],
+        "peak_rss": peak_rss(),
+    }
+
+
+def main() -> None:
+    storage_methods = get_storage_methods()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the aw_datastore storage methods"
+    )
+    parser.add_argument(
+        "--storage",
+        nargs="+",
+        choices=[s.__name__ for s in storage_methods.values()],
+        help="Storage methods to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[10_000],
+        help="Number of events in the benchmarked bucket (default: 10000)",
+    )
+    parser.add_argument("--reads", type=int, default=50)
+    parser.add_argument("--output", help="Write the results to a file")
+    args = parser.parse_args()
 
-    #         with ttt(" get all"):
-    #             events_tmp = bucket.get(limit=-1)
-    #             assert len(events_tmp) == num_final_events
+    results = []
+    # Each run is done in a new process, so that its peak_rss isn't that of earlier runs
+    context = multiprocessing.get_context("spawn")
+    for storage in storage_methods.values():
+        if args.storage and storage.__name__ not in args.storage:
+            continue
+        for size in args.sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                future = executor.submit(
+                    benchmark, storage, num_events=size, num_reads=args.reads
+                )
+                results.append(future.result())
 
-    #         with ttt(" get range"):
-    #             events_tmp = bucket.get(
-    #                 limit=-1,
-    #                 starttime=events[1].timestamp + 0.01 * td1s,
-    #                 endtime=events[-1].timestamp + events[-1].duration,
-    #             )
-    #             assert len(events_tmp) == num_final_events - 1
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
 
 
 if __name__ == "__main__":
-    for storage in get_storage_methods().values():
-        if len(sys.argv) <= 1 or storage.__name__ in sys.argv:
-            benchmark(storage)
+    main()
@@ -1,19 +1,87 @@
+import copy
 import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from typing import (
     Callable,
+    Deque,
     Dict,
+    Iterable,
+    Iterator,
     List,
     Optional,
+    Sequence,
+    Set,
+    Tuple,
     Union,
+    cast,
 )
 
 from aw_core.models import Event
+from aw_transform.heartbeats import heartbeat_merge
 
-from .storages import AbstractStorage
+from .storages import AbstractStorage, DataFilter, SearchFilter
 
 logger = logging.getLogger(__name__)
 
+# Number of modifications of each bucket whose time range is remembered
+MAX_LOGGED_MODIFICATIONS = 1000
+
+
+class _ModificationLog:
+    """The version and the time ranges of the last modifications of a bucket"""
+
+    def __init__(self) -> None:
+        self.version = 0
+        # Modifications up to this version are no longer in the log
+        self.floor = 0
+        self.entries: Deque[Tuple[int, Optional[datetime], Optional[datetime]]] = deque(
+            maxlen=MAX_LOGGED_MODIFICATIONS
+        )
+
+    def add(
+        self, version: int, start: Optional[datetime], end: Optional[datetime]
+    ) -> None:
+        if len(self.entries) == self.entries.maxlen:
+            self.floor = self.entries[0][0]
+        self.entries.append((version, start, end))
+        self.version = version
+
+    def modified_since(
+        self, version: int, start: Optional[datetime], end: Optional[datetime]
+    ) -> bool:
+        if version >= self.version:
+            return False
+        if version < self.floor:
+            return True
+        for v, mod_start, mod_end in reversed(self.entries):
+            if v <= version:
+                break
+            if (mod_start is None or end is None or mod_start <= end) and (
+                mod_end is None or start is None or mod_end >= start
+            ):
+                return True
+        return False
+
+
+def _events_range(events: Iterable[Event]) -> Tuple[datetime, datetime]:
+    events = list(events)
+    return (
+        min(e.timestamp for e in events),
+        max(e.timestamp + e.duration for e in events),
+    )
+
+
+def _modified_range(
+    old: Optional[Event], new: Optional[Event] = None
+) -> Tuple[Optional[datetime], Optional[datetime]]:
+    # If the old event isn't known, it could have been anywhere
+    if old is None:
+        return None, None
+    return _events_range([old] if new is None else [old, new])
+
 
 class Datastore:
     def __init__(
@@ -25,18 +93,30 @@ class Datastore:
         self.logger = logger.getChild("Datastore")
         self.bucket_instances: Dict[str, Bucket] = dict()
 
+        # Incremented on every modification, the bucket ids are logged with the
+        # version and time range of their modifications (None for the list of buckets)
+        self.version = 0
+        self._modifications: Dict[Optional[str], _ModificationLog] = {}
+        self._modifications_lock = threading.Lock()
+        self._tracking = threading.local()
+
         self.storage_strategy = storage_strategy(testing=testing, **kwargs)
 
     def __repr__(self):
         return f"<Datastore object using {self.storage_strategy.__class__.__name__}>"
 
+    def close(self) -> None:
+        """Closes the storage, writing any pending events. Call it on shutdown."""
+        self.storage_strategy.close()
+
     def __getitem__(self, bucket_id: str) -> "Bucket":
+        self._record_access(bucket_id)
         # If this bucket doesn't have a initialized object, create it
         if bucket_id not in self.bucket_instances:
             # If the bucket exists in the database, create an object representation of it
             if bucket_id in self.buckets():
-                bucket = Bucket(self, bucket_id)
-                self.bucket_instances[bucket_id] = bucket
+                # Threads creating it at the same time must share one instance
+                self.bucket_instances.setdefault(bucket_id, Bucket(self, bucket_id))
             else:
                 self.logger.error(
                     f"Cannot create a Bucket object for {bucket_id} because it doesn't exist in the database"
@@ -57,30 +137,109 @@ class Datastore:
     ) -> "Bucket":
         created = created or datetime.now(timezone.utc)
         self.logger.info(f"Creating bucket '{bucket_id}'")
-        self.storage_strategy.create_bucket(
-            bucket_id, type, client, hostname, created.isoformat(), name=name, data=data
-        )
+        with self._modifying(None), self._modifying(bucket_id):
+            self.storage_strategy.create_bucket(
+                bucket_id,
+                type,
+                client,
+                hostname,
+                created.isoformat(),
+                name=name,
+                data=data,
+            )
         return self[bucket_id]
 
     def update_bucket(self, bucket_id: str, **kwargs):
         self.logger.info(f"Updating bucket '{bucket_id}'")
-        return self.storage_strategy.update_bucket(bucket_id, **kwargs)
+        with self._modifying(None), self._modifying(bucket_id):
+            return self.storage_strategy.update_bucket(bucket_id, **kwargs)
 
     def delete_bucket(self, bucket_id: str):
         self.logger.info(f"Deleting bucket '{bucket_id}'")
-        if bucket_id in self.bucket_instances:
-            del self.bucket_instances[bucket_id]
-        return self.storage_strategy.delete_bucket(bucket_id)
+        with self._modifying(None), self._modifying(bucket_id):
+            if bucket_id in self.bucket_instances:
+                del self.bucket_instances[bucket_id]
+            return self.storage_strategy.delete_bucket(bucket_id)
 
     def buckets(self):
+        self._record_access(None)
         return self.storage_strategy.buckets()
 
+    def _log_modification(
+        self,
+        bucket_id: Optional[str],
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> None:
+        """Logs that events of the bucket in the range (or anywhere, if not given) were modified"""
+        with self._modifications_lock:
+            self.version += 1
+            if bucket_id not in self._modifications:
+                self._modifications[bucket_id] = _ModificationLog()
+            self._modifications[bucket_id].add(self.version, start, end)
+
+    @contextmanager
+    def _modifying(
+        self,
+        bucket_id: Optional[str],
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> Iterator[None]:
+        """
+        Logs the modification once it's done (even if it failed), so that results
+        of queries that read the data while it was modified are invalidated too.
+        """
+        try:
+            yield
+        finally:
+            self._log_modification(bucket_id, start, end)
+
+    def modified_since(
+        self,
+        bucket_id: Optional[str],
+        version: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> bool:
+        """
+        Returns whether events of the bucket in the range might have been modified
+        since the datastore had the given ``version``. With ``bucket_id=None``, whether
+        buckets were created, updated or deleted.
+        """
+        with self._modifications_lock:
+            log = self._modifications.get(bucket_id)
+            if log is None:
+                return False
+            return log.modified_since(version, starttime, endtime)
+
+    @contextmanager
+    def track_access(self) -> Iterator[Set[Optional[str]]]:
+        """
+        Collects the ids of the buckets accessed by the current thread while in the
+        context (and None if the list of buckets was accessed).
+        """
+        accessed: Set[Optional[str]] = set()
+        stack = self._tracking.__dict__.setdefault("stack", [])
+        stack.append(accessed)
+        try:
+            yield accessed
+        finally:
+            stack.pop()
+
+    def _record_access(self, bucket_id: Optional[str]) -> None:
+        for accessed in getattr(self._tracking, "stack", []):
+            accessed.add(bucket_id)
+
 
 class Bucket:
     def __init__(self, datastore: Datastore, bucket_id: str) -> None:
         self.logger = logger.getChild("Bucket")
         self.ds = datastore
         self.bucket_id = bucket_id
+        # Cache of the last event, used by heartbeat to avoid reading it back
+        self._last_event: Optional[Event] = None
+        # Serializes the modifications of the bucket, which read or reset _last_event
+        self._lock = threading.RLock()
 
     def metadata(self) -> dict:
         return self.ds.storage_strategy.get_metadata(self.bucket_id)
@@ -92,6 +251,64 @@ class Bucket:
         endtime: Optional[datetime] = None,
     ) -> List[Event]:
         """Returns events sorted in descending order by timestamp"""
+        starttime, endtime = self._round_range(starttime, endtime)
+        return self.ds.storage_strategy.get_events(
+            self.bucket_id, limit, starttime, endtime
+        )
+
+    def iter_events(
+        self,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+        filters: Sequence[DataFilter] = (),
+    ) -> Iterator[Event]:
+        """
+        Lazily yields events in the same order as `get`, fetching them from
+        the storage in chunks. Useful to process large ranges in constant memory.
+
+        Only the events matching all the ``filters`` are yielded, storage methods
+        that can filter the events in their queries only read those.
+        """
+        starttime, endtime = self._round_range(starttime, endtime)
+        storage = self.ds.storage_strategy
+        if filters:
+            events = storage.iter_events_filtered(
+                self.bucket_id, filters, starttime, endtime, chunksize
+            )
+            if events is not None:
+                return events
+            events = storage.iter_events(self.bucket_id, starttime, endtime, chunksize)
+            return (e for e in events if all(f.match(e.data) for f in filters))
+        return storage.iter_events(self.bucket_id, starttime, endtime, chunksize)
+
+    def search(
+        self,
+        search: SearchFilter,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+        filters: Sequence[DataFilter] = (),
+    ) -> Iterator[Event]:
+        """
+        Same as `iter_events`, but only yields the events matching the search. It's
+        looked up in the full-text index of the storage if it ``supports_search``,
+        otherwise all the events in the range are read and searched.
+        """
+        storage = self.ds.storage_strategy
+        if storage.supports_search:
+            rounded_start, rounded_end = self._round_range(starttime, endtime)
+            events = storage.search_events(
+                self.bucket_id, search, rounded_start, rounded_end, filters, chunksize
+            )
+            if events is not None:
+                return events
+        events = self.iter_events(starttime, endtime, chunksize, filters)
+        return (e for e in events if search.match(e.data))
+
+    def _round_range(
+        self, starttime: Optional[datetime], endtime: Optional[datetime]
+    ) -> Tuple[Optional[datetime], Optional[datetime]]:
         # Resolution is rounded down since not all datastores like microsecond precision
         if starttime:
             starttime = starttime.replace(
@@ -108,9 +325,37 @@ class Bucket:
             endtime = endtime.replace(microsecond=microseconds) + timedelta(
                 seconds=second_offset
             )
+        return starttime, endtime
 
-        return self.ds.storage_strategy.get_events(
-            self.bucket_id, limit, starttime, endtime
+    def get_rollup(
+        self,
+        keys: Sequence[str],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> Optional[List[Event]]:
+        """
+        Returns the events merged by the values of ``keys`` from the rollups of the
+        storage, or None if it has none for the keys. See `AbstractStorage.get_rollup`.
+        """
+        starttime, endtime = self._round_range(starttime, endtime)
+        return self.ds.storage_strategy.get_rollup(
+            self.bucket_id, keys, starttime, endtime
+        )
+
+    def get_aggregate(
+        self,
+        keys: Sequence[str],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        filters: Sequence[DataFilter] = (),
+    ) -> Optional[List[Event]]:
+        """
+        Returns the events matching the filters merged by the values of ``keys`` by
+        the storage, or None if it can't. See `AbstractStorage.get_aggregate`.
+        """
+        starttime, endtime = self._round_range(starttime, endtime)
+        return self.ds.storage_strategy.get_aggregate(
+            self.bucket_id, keys, starttime, endtime, filters
         )
 
     def get_by_id(self, event_id) -> Optional[Event]:
@@ -152,7 +397,11 @@ class Bucket:
                 self.logger.warning(
                     f"Event inserted into bucket {self.bucket_id} reaches into the future. Current UTC time: {str(now)}. Event data: {str(events)}"
                 )
-            inserted = self.ds.storage_strategy.insert_one(self.bucket_id, events)
+            with self._lock, self.ds._modifying(
+                self.bucket_id, *_events_range([events])
+            ):
+                self._last_event = None
+                inserted = self.ds.storage_strategy.insert_one(self.bucket_id, events)
             # assert inserted
         elif isinstance(events, list):
             if events:
@@ -164,7 +413,12 @@ class Bucket:
                     self.logger.warning(
                         f"Event inserted into bucket {self.bucket_id} reaches into the future. Current UTC time: {str(now)}. Event data: {str(event)}"
                     )
-            self.ds.storage_strategy.insert_many(self.bucket_id, events)
+            if events:
+                with self._lock, self.ds._modifying(
+                    self.bucket_id, *_events_range(events)
+                ):
+                    self._last_event = None
+                    self.ds.storage_strategy.insert_many(self.bucket_id, events)
         else:
             raise TypeError
 
@@ -180,10 +434,69 @@ Inserted: {oldest_event}"""
         return inserted
 
     def delete(self, event_id):
-        return self.ds.storage_strategy.delete(self.bucket_id, event_id)
+        with self._lock:
+            old = self._cached_event(event_id)
+            self._last_event = None
+            with self.ds._modifying(self.bucket_id, *_modified_range(old)):
+                return self.ds.storage_strategy.delete(self.bucket_id, event_id)
 
     def replace_last(self, event):
-        return self.ds.storage_strategy.replace_last(self.bucket_id, event)
+        with self._lock:
+            old = self._last_event
+            self._last_event = None
+            with self.ds._modifying(self.bucket_id, *_modified_range(old, event)):
+                return self.ds.storage_strategy.replace_last(self.bucket_id, event)
 
     def replace(self, event_id, event):
-        return self.ds.storage_strategy.replace(self.bucket_id, event_id, event)
+        with self._lock:
+            old = self._cached_event(event_id)
+            self._last_event = None
+            with self.ds._modifying(self.bucket_id, *_modified_range(old, event)):
+                return self.ds.storage_strategy.replace(self.bucket_id, event_id, event)
+
+    def _cached_event(self, event_id) -> Optional[Event]:
+        # Only the last event is known without reading it from the storage
+        last_event = self._last_event
+        if last_event is not None and last_event.id == event_id:
+            return last_event
+        return None
+
+    def heartbeat(self, heartbeat: Event, pulsetime: float) -> Event:
+        """
+        Merges the heartbeat into the last event of the bucket according to the rules
+        of `aw_transform.heartbeat_merge`, or inserts it as a new event if it can't be merged.
+
+        The last event is kept in memory, so consecutive heartbeats only need a single
+        write each (see `AbstractStorage.update_last`). Returns the resulting (merged
+        or inserted) event.
+        """
+        with self._lock:
+            last_event = self._get_last_event()
+            if last_event is not None:
+                merged = heartbeat_merge(copy.copy(last_event), heartbeat, pulsetime)
+                if merged is not None:
+                    # The last event was read back from the storage, so it has an id
+                    event_id = cast(int, merged.id)
+                    with self.ds._modifying(
+                        self.bucket_id, *_modified_range(last_event, merged)
+                    ):
+                        self.ds.storage_strategy.update_last(
+                            self.bucket_id, event_id, merged
+                        )
+                    self._last_event = merged
+                    return copy.copy(merged)
+
+            with self.ds._modifying(self.bucket_id, *_events_range([heartbeat])):
+                inserted = self.ds.storage_strategy.insert_one(
+                    self.bucket_id, copy.copy(heartbeat)
+                )
+            # Heartbeats older than the last event don't replace it as the last one
+            if last_event is None or inserted.timestamp >= last_event.timestamp:
+                self._last_event = copy.copy(inserted)
+            return inserted
+
+    def _get_last_event(self) -> Optional[Event]:
+        if self._last_event is None:
+            events = self.get(limit=1)
+            self._last_event = events[0] if events else None
+        return self._last_event
@@ -1,10 +1,13 @@
 import logging
 import os
-from typing import List, Optional
+import sqlite3
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
 
 from aw_core.dirs import get_data_dir
 
 from .storages import AbstractStorage
+from .storages.sqlite import data_hash
 
 logger = logging.getLogger(__name__)
 
@@ -60,3 +63,188 @@ def peewee_v2_to_sqlite_v1(datastore):
         bucket_events = pw_db.get_events(bucket_id, -1)
         datastore.insert_many(bucket_id, bucket_events)
     logger.info("Migration of peewee v2 to sqlite v1 finished")
+
+
+def sqlite_v1_to_v2(data_dir: str, datastore_name: str, filepath: str) -> None:
+    """
+    Copies the sqlite v1 database (if there is one) to filepath, where it then gets
+    the schema upgrades. The v1 database is left as it was, since older versions
+    of aw-core can't read the upgraded schema. Writes made to it after the copy
+    don't get into the v2 database.
+    """
+    v1_path = os.path.join(data_dir, f"{datastore_name}.v1.db")
+    if not os.path.exists(v1_path):
+        return
+    logger.info("Migrating database from sqlite v1 to sqlite v2")
+    # Copied to a temporary file first, so that an interrupted copy is started over
+    tmp_path = filepath + ".tmp"
+    src = sqlite3.connect(Path(v1_path).resolve().as_uri() + "?mode=ro", uri=True)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+    os.replace(tmp_path, filepath)
+    logger.info("Migration of sqlite v1 to sqlite v2 finished")
+
+
+def _sqlite_add_last_event_id(conn: sqlite3.Connection) -> None:
+    # Points at the event with the latest endtime in the bucket, makes replace_last O(1)
+    conn.execute("ALTER TABLE buckets ADD COLUMN last_event_id INTEGER")
+    conn.execute(
+        """
+        UPDATE buckets SET last_event_id = (
+            SELECT id FROM events WHERE bucketrow = buckets.rowid
+            ORDER BY endtime DESC, id DESC LIMIT 1
+        )
+        """
+    )
+
+
+def _sqlite_replace_event_indexes(conn: sqlite3.Connection) -> None:
+    # Range queries filter on both endtime and starttime, with the (bucketrow, endtime)
+    # and (bucketrow, starttime) indexes only one of the bounds could be used.
+    # The index on id duplicated the primary key.
+    conn.execute("DROP INDEX IF EXISTS event_index_id")
+    conn.execute("DROP INDEX IF EXISTS event_index_starttime")
+    conn.execute("DROP INDEX IF EXISTS event_index_endtime")
+    conn.execute(
+        "CREATE INDEX event_index_bucket_endtime ON events(bucketrow, endtime, starttime)"
+    )
+    conn.execute(
+        "CREATE INDEX event_index_bucket_starttime ON events(bucketrow, starttime, endtime)"
+    )
+
+
+def _sqlite_add_max_duration(conn: sqlite3.Connection) -> None:
+    # Upper bound of the duration of the events in the bucket (in microseconds),
+    # lets range queries bound starttime from below as well
+    conn.execute(
+        "ALTER TABLE buckets ADD COLUMN max_duration INTEGER NOT NULL DEFAULT 0"
+    )
+    conn.execute(
+        """
+        UPDATE buckets SET max_duration = coalesce((
+            SELECT max(endtime - starttime) FROM events WHERE bucketrow = buckets.rowid
+        ), 0)
+        """
+    )
+
+
+def _sqlite_deduplicate_event_data(conn: sqlite3.Connection) -> None:
+    # Moves the data of events to a table where each distinct datastr is only stored once,
+    # events reference it by id. Requires rebuilding the events table.
+    conn.create_function("aw_data_hash", 1, data_hash, deterministic=True)
+    conn.execute(
+        """
+        CREATE TABLE eventdata (
+            id INTEGER PRIMARY KEY,
+            hash BLOB UNIQUE NOT NULL,
+            datastr TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO eventdata(hash, datastr)
+        SELECT aw_data_hash(datastr), datastr FROM events
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE events_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bucketrow INTEGER NOT NULL,
+            starttime INTEGER NOT NULL,
+            endtime INTEGER NOT NULL,
+            dataid INTEGER NOT NULL,
+            FOREIGN KEY (bucketrow) REFERENCES buckets(rowid),
+            FOREIGN KEY (dataid) REFERENCES eventdata(id)
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO events_new(id, bucketrow, starttime, endtime, dataid)
+        SELECT e.id, e.bucketrow, e.starttime, e.endtime, d.id
+        FROM events e JOIN eventdata d ON d.hash = aw_data_hash(e.datastr)
+        """
+    )
+    # Keep AUTOINCREMENT from reusing the ids of events deleted before the upgrade
+    row = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'events'"
+    ).fetchone()
+    conn.execute("DROP TABLE events")
+    conn.execute("ALTER TABLE events_new RENAME TO events")
+    if row is not None:
+        conn.execute(
+            "UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'events'", row
+        )
+        conn.execute(
+            "INSERT INTO sqlite_sequence(name, seq) SELECT 'events', ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'events')",
+            row,
+        )
+    conn.execute(
+        "CREATE INDEX event_index_bucket_endtime ON events(bucketrow, endtime, starttime)"
+    )
+    conn.execute(
+        "CREATE INDEX event_index_bucket_starttime ON events(bucketrow, starttime, endtime)"
+    )
+    # Needed to find data that is no longer used by any event
+    conn.execute("CREATE INDEX event_index_dataid ON events(dataid)")
+
+
+def _sqlite_add_rollups(conn: sqlite3.Connection) -> None:
+    # Hourly durations of events by the values of the keys in rollup_keys,
+    # see aw_datastore.storages.rollups
+    conn.execute("CREATE TABLE rollup_keys (keys TEXT PRIMARY KEY)")
+    conn.execute(
+        """
+        CREATE TABLE rollups (
+            bucketrow INTEGER NOT NULL,
+            keys TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            datastr TEXT NOT NULL,
+            duration INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (bucketrow, keys, hour, datastr)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+# In-place upgrades of the schema of a SqliteStorage database.
+# The schema version is stored in PRAGMA user_version, 0 being the original schema.
+# Upgrade 4 moves the data of events out of the events table, which sqlite v1 reads,
+# so databases from 4 on are sqlite v2 files (see sqlite_v1_to_v2). The upgrades
+# are one-way, there are no downgrades.
+SQLITE_SCHEMA_UPGRADES: List[Tuple[int, Callable[[sqlite3.Connection], None]]] = [
+    (1, _sqlite_add_last_event_id),
+    (2, _sqlite_replace_event_indexes),
+    (3, _sqlite_add_max_duration),
+    (4, _sqlite_deduplicate_event_data),
+    (5, _sqlite_add_rollups),
+]
+
+SQLITE_SCHEMA_VERSION = SQLITE_SCHEMA_UPGRADES[-1][0]
+
+
+def upgrade_sqlite_schema(conn: sqlite3.Connection) -> None:
+    """Applies the schema upgrades the database hasn't had yet, each in its own transaction"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for upgrade_version, upgrade in SQLITE_SCHEMA_UPGRADES:
+        if version >= upgrade_version:
+            continue
+        logger.info(f"Upgrading sqlite schema to version {upgrade_version}")
+        conn.commit()
+        conn.execute("BEGIN")
+        try:
+            upgrade(conn)
+            conn.execute(f"PRAGMA user_version = {upgrade_version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = upgrade_version
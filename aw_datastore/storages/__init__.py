@@ -3,13 +3,19 @@ import logging as _logging
 logger: _logging.Logger = _logging.getLogger(__name__)
 
 from .abstract import AbstractStorage
+from .filters import DataFilter
 from .memory import MemoryStorage
 from .peewee import PeeweeStorage
+from .partitioned import PartitionedSqliteStorage
+from .search import SearchFilter
 from .sqlite import SqliteStorage
 
 __all__ = [
     "AbstractStorage",
+    "DataFilter",
     "MemoryStorage",
+    "PartitionedSqliteStorage",
     "PeeweeStorage",
+    "SearchFilter",
     "SqliteStorage",
 ]
@@ -1,9 +1,26 @@
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Sequence
 
 from aw_core.models import Event
 
+from .filters import DataFilter
+from .search import SearchFilter
+
+
+def _trim_event(
+    e: Event, starttime: Optional[datetime], endtime: Optional[datetime]
+) -> None:
+    """Trims the event in place to the part of it that is within the range"""
+    if starttime:
+        if e.timestamp < starttime:
+            e_end = e.timestamp + e.duration
+            e.timestamp = starttime
+            e.duration = e_end - e.timestamp
+    if endtime:
+        if e.timestamp + e.duration > endtime:
+            e.duration = endtime - e.timestamp
+
 
 class AbstractStorage(metaclass=ABCMeta):
     """
@@ -12,6 +29,9 @@ class AbstractStorage(metaclass=ABCMeta):
 
     sid = "Storage id not set, fix me"
 
+    # Whether search_events can use an index, instead of reading all the events
+    supports_search = False
+
     @abstractmethod
     def __init__(self, testing: bool) -> None:
         self.testing = True
@@ -72,6 +92,58 @@ class AbstractStorage(metaclass=ABCMeta):
     ) -> List[Event]:
         raise NotImplementedError
 
+    def iter_events(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+    ) -> Iterator[Event]:
+        """
+        Lazily yields the events in a range, in the same order as `get_events`.
+
+        Storage methods that can should override this to fetch the events in
+        chunks of ``chunksize`` instead of materializing the whole range at once.
+        """
+        yield from self.get_events(bucket_id, -1, starttime, endtime)
+
+    def iter_events_filtered(
+        self,
+        bucket_id: str,
+        filters: Sequence[DataFilter],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+    ) -> Optional[Iterator[Event]]:
+        """
+        Same as `iter_events`, but only yields the events matching all the filters.
+
+        Storage methods that can select the events by their data in their queries
+        override this, so that the other events aren't read at all. Returns None
+        if the filters can't be used, the events then have to be filtered instead.
+        """
+        return None
+
+    def search_events(
+        self,
+        bucket_id: str,
+        search: SearchFilter,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        filters: Sequence[DataFilter] = (),
+        chunksize: int = 1000,
+    ) -> Optional[Iterator[Event]]:
+        """
+        Same as `iter_events_filtered`, but only yields the events matching the search
+        as well.
+
+        Storage methods with ``supports_search`` set override this, so that the
+        events are looked up in a full-text index. Returns None if the index can't
+        be used (for example if it doesn't have the searched keys), the events then
+        have to be searched instead.
+        """
+        return None
+
     def get_eventcount(
         self,
         bucket_id: str,
@@ -80,6 +152,40 @@ class AbstractStorage(metaclass=ABCMeta):
     ) -> int:
         raise NotImplementedError
 
+    def get_aggregate(
+        self,
+        bucket_id: str,
+        keys: Sequence[str],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        filters: Sequence[DataFilter] = (),
+    ) -> Optional[List[Event]]:
+        """
+        Returns the events in the range matching the filters, merged by the values
+        of ``keys`` like `aw_transform.merge_events_by_keys` does (including the
+        order of the merged events). Without keys, all events are merged into one.
+
+        Storage methods that can aggregate the events in their queries override this.
+        Returns None if they can't, the events then have to be merged instead.
+        """
+        return None
+
+    def get_rollup(
+        self,
+        bucket_id: str,
+        keys: Sequence[str],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> Optional[List[Event]]:
+        """
+        Returns the events in the range merged by the values of ``keys``, like
+        `aw_transform.merge_events_by_keys` does, sorted by duration (descending).
+
+        Storage methods that keep pre-aggregated durations for the keys override this.
+        Returns None if they can't be used, the events then have to be merged instead.
+        """
+        return None
+
     @abstractmethod
     def insert_one(self, bucket_id: str, event: Event) -> Event:
         raise NotImplementedError
@@ -99,3 +205,18 @@ class AbstractStorage(metaclass=ABCMeta):
     @abstractmethod
     def replace_last(self, bucket_id: str, event: Event) -> None:
         raise NotImplementedError
+
+    def close(self) -> None:
+        """Writes anything pending and releases the resources of the storage"""
+        return None
+
+    def update_last(self, bucket_id: str, event_id: int, event: Event) -> None:
+        """
+        Replaces the last event of the bucket, which has the id, with an event ending
+        at least as late and with the same data (such as the last event with a
+        heartbeat merged into it).
+
+        Since it stays the last event, storage methods can update it in place without
+        looking up the last event of the bucket again. Same as `replace` by default.
+        """
+        self.replace(bucket_id, event_id, event)
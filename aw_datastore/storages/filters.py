@@ -0,0 +1,179 @@
+"""
+Filters on the data of events, which SQLite storages can apply in their queries.
+
+The SQL conditions only use the JSON functions of SQLite (and a REGEXP function
+registered on the connections). They select exactly the matching data, except that
+the REGEXP function lets through values that aren't strings, for which
+``DataFilter.match`` raises like ``aw_transform.filter_keyvals_regex`` does. So events
+read with regex filters have to be checked with ``DataFilter.match`` as well.
+
+Keys of the data can also be indexed, with a generated column on the eventdata table
+holding their value (see ``sync_indexed_keys``). Filters on those keys use the column,
+so that the events can be looked up through its index instead of reading the data of
+each of them.
+"""
+
+import functools
+import re
+import sqlite3
+from typing import AbstractSet, Any, FrozenSet, NamedTuple, Optional, Sequence, Tuple
+
+# Range of the integers that can be bound as parameters
+MIN_INT = -(2**63)
+MAX_INT = 2**63 - 1
+
+# Prefix of the names of the generated columns of indexed keys
+INDEXED_COLUMN_PREFIX = "data."
+
+
+@functools.lru_cache(maxsize=64)
+def _compile(regex: str) -> re.Pattern:
+    return re.compile(regex)
+
+
+class DataFilter(NamedTuple):
+    """
+    Selects events by the value of a key in their data: those with one of ``vals``
+    (or the others if ``exclude``), like ``aw_transform.filter_keyvals``, or those
+    matching ``regex``, like ``aw_transform.filter_keyvals_regex``.
+    """
+
+    key: str
+    vals: Tuple[Any, ...] = ()
+    regex: Optional[str] = None
+    exclude: bool = False
+
+    def match(self, data: dict) -> bool:
+        if self.regex is not None:
+            return self.key in data and bool(
+                _compile(self.regex).findall(data[self.key])
+            )
+        return (self.key in data and data[self.key] in self.vals) != self.exclude
+
+
+def _regexp(regex: str, value: Any) -> bool:
+    if value is None:
+        return False
+    elif not isinstance(value, str):
+        # Left to DataFilter.match, which raises like filter_keyvals_regex does
+        return True
+    return _compile(regex).search(value) is not None
+
+
+def register_functions(conn: sqlite3.Connection) -> None:
+    """Registers the functions used by the filters on a connection"""
+    conn.create_function("regexp", 2, _regexp, deterministic=True)
+
+
+def _is_scalar(value: Any) -> bool:
+    if isinstance(value, int):
+        return MIN_INT <= value <= MAX_INT
+    return isinstance(value, (str, float))
+
+
+class FilterSQL(NamedTuple):
+    """
+    A condition on the eventdata table, and its parameters. If ``seek``, it's
+    selective on an indexed column, and best used to look up the matching data.
+    """
+
+    condition: str
+    params: list
+    seek: bool = False
+
+
+def filters_sql(
+    filters: Sequence[DataFilter],
+    column: str = "datastr",
+    indexed: AbstractSet[str] = frozenset(),
+) -> Optional[FilterSQL]:
+    """
+    Returns a condition (and its parameters) on the JSON of the data in ``column``
+    that is true for all the data matching the filters, or None if a filter can't
+    be done in SQL. The generated columns of the ``indexed`` keys are used for the
+    filters on them.
+    """
+    conditions = []
+    params: list = []
+    seek = False
+    for f in filters:
+        if '"' in f.key:
+            return None
+        path = f'$."{f.key}"'
+        if f.key in indexed:
+            value, value_params = _quote(indexed_column(f.key)), []
+        else:
+            value, value_params = f"json_extract({column}, ?)", [path]
+        if f.regex is not None:
+            # Raises for invalid regexes before the query runs
+            _compile(f.regex)
+            conditions.append(f"{value} REGEXP ?")
+            params += [*value_params, f.regex]
+        elif not all(_is_scalar(v) for v in f.vals):
+            return None
+        elif not f.vals:
+            if not f.exclude:
+                conditions.append("0")
+        else:
+            # Nested values are never equal to the values, whatever their JSON is
+            placeholders = ", ".join("?" * len(f.vals))
+            condition = (
+                f"{value} IN ({placeholders})"
+                f" AND json_type({column}, ?) NOT IN ('object', 'array')"
+            )
+            if f.exclude:
+                condition = f"NOT coalesce({condition}, 0)"
+            else:
+                seek = seek or f.key in indexed
+            conditions.append(condition)
+            params += [*value_params, *f.vals, path]
+    return FilterSQL(" AND ".join(conditions) or "1", params, seek)
+
+
+def indexed_column(key: str) -> str:
+    """Name of the generated column holding the value of an indexed key"""
+    return INDEXED_COLUMN_PREFIX + key
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_indexed_keys(conn: sqlite3.Connection) -> FrozenSet[str]:
+    """Returns the keys with a generated column on the eventdata table"""
+    # table_xinfo also lists the generated columns, unlike table_info
+    rows = conn.execute("PRAGMA table_xinfo(eventdata)").fetchall()
+    n = len(INDEXED_COLUMN_PREFIX)
+    return frozenset(
+        row[1][n:] for row in rows if row[1].startswith(INDEXED_COLUMN_PREFIX)
+    )
+
+
+def sync_indexed_keys(conn: sqlite3.Connection, keys: Sequence[str]) -> FrozenSet[str]:
+    """
+    Adds an indexed generated column to the eventdata table for each of the keys
+    that doesn't have one yet, and drops those of the keys that aren't indexed
+    anymore. Returns the indexed keys.
+
+    The columns are virtual, so adding one only builds its index and the data
+    isn't stored twice. Keys containing '"' can't be indexed.
+    """
+    existing = get_indexed_keys(conn)
+    for key in existing - set(keys):
+        column = indexed_column(key)
+        conn.execute(f"DROP INDEX IF EXISTS {_quote('eventdata_index_' + column)}")
+        conn.execute(f"ALTER TABLE eventdata DROP COLUMN {_quote(column)}")
+    for key in keys:
+        if key in existing:
+            continue
+        column = indexed_column(key)
+        path = f'$."{key}"'.replace("'", "''")
+        conn.execute(
+            f"ALTER TABLE eventdata ADD COLUMN {_quote(column)}"
+            f" GENERATED ALWAYS AS (json_extract(datastr, '{path}')) VIRTUAL"
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {_quote('eventdata_index_' + column)}"
+            f" ON eventdata({_quote(column)})"
+        )
+    return frozenset(keys)
@@ -1,12 +1,12 @@
 import copy
 import sys
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 
 from aw_core.models import Event
 
 from . import logger
-from .abstract import AbstractStorage
+from .abstract import AbstractStorage, _trim_event
 
 
 class MemoryStorage(AbstractStorage):
@@ -111,9 +111,29 @@ class MemoryStorage(AbstractStorage):
             return []
         elif limit < 0:
             limit = sys.maxsize
-        events = events[:limit]
-        # Return
-        return copy.deepcopy(events)
+        # Copied one by one, so that events with the same data object get their own copies
+        events = [copy.deepcopy(e) for e in events[:limit]]
+        # Trim events that are out of range, like the other storage methods
+        for e in events:
+            _trim_event(e, starttime, endtime)
+        return events
+
+    def iter_events(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+    ) -> Iterator[Event]:
+        events = sorted(self.db[bucket_id], key=lambda k: k["timestamp"])[::-1]
+        for e in events:
+            if starttime and starttime > e.timestamp + e.duration:
+                continue
+            if endtime and e.timestamp > endtime:
+                continue
+            e = copy.deepcopy(e)
+            _trim_event(e, starttime, endtime)
+            yield e
 
     def get_eventcount(
         self,
@@ -125,7 +145,7 @@ class MemoryStorage(AbstractStorage):
             [
                 e
                 for e in self.db[bucket]
-                if (not starttime or starttime <= e.timestamp)
+                if (not starttime or starttime <= e.timestamp + e.duration)
                 and (not endtime or e.timestamp <= endtime)
             ]
         )
@@ -0,0 +1,776 @@
+import heapq
+import logging
+import os
+import re
+import sqlite3
+import stat
+import threading
+import weakref
+from bisect import insort
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from aw_core.dirs import get_data_dir
+from aw_core.models import Event
+
+from .filters import (
+    DataFilter,
+    FilterSQL,
+    get_indexed_keys,
+    register_functions,
+    sync_indexed_keys,
+)
+from .rollups import Span
+from .search import HAS_FTS5, SearchFilter, get_search_keys, sync_search_keys
+from .sqlite import (
+    DEFAULT_PROFILE,
+    EPOCH,
+    HAS_GENERATED_COLUMNS,
+    LATEST_VERSION,
+    MAX_TIMESTAMP,
+    SqliteStorage,
+    _apply_pragmas,
+    _delete_bucket_events,
+    _delete_unused_data,
+    _duration_us,
+    _filters_where,
+    _fetch_datastrs,
+    _get_data_id,
+    _get_event_data_id,
+    _get_event_span,
+    _iter_bucket_spans,
+    _rows_to_events,
+    _select_chunk,
+    _select_groups,
+    _synchronized,
+    _to_us,
+    _where_data,
+)
+
+logger = logging.getLogger(__name__)
+
+# The id of an event is the id within its partition, with the partition key in the upper bits
+LOCAL_ID_BITS = 32
+LOCAL_ID_MASK = (1 << LOCAL_ID_BITS) - 1
+
+PARTITION_FILENAME = "events-{:04d}-{:02d}.db"
+PARTITION_FILENAME_RE = re.compile(r"^events-(\d{4})-(\d{2})\.db$")
+
+# Same schema as the events of SqliteStorage after all upgrades
+CREATE_PARTITION_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS eventdata (
+        id INTEGER PRIMARY KEY,
+        hash BLOB UNIQUE NOT NULL,
+        datastr TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bucketrow INTEGER NOT NULL,
+        starttime INTEGER NOT NULL,
+        endtime INTEGER NOT NULL,
+        dataid INTEGER NOT NULL,
+        FOREIGN KEY (dataid) REFERENCES eventdata(id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS event_index_bucket_endtime ON events(bucketrow, endtime, starttime)",
+    "CREATE INDEX IF NOT EXISTS event_index_bucket_starttime ON events(bucketrow, starttime, endtime)",
+    "CREATE INDEX IF NOT EXISTS event_index_dataid ON events(dataid)",
+]
+
+
+def _partition_key(us: int) -> int:
+    """Returns the key of the partition (the month) of a time in microseconds"""
+    dt = EPOCH + timedelta(microseconds=us)
+    return dt.year * 12 + dt.month - 1
+
+
+def _partition_start(key: int) -> int:
+    """Returns the start of the month of the partition, in microseconds"""
+    year, month = divmod(key, 12)
+    return _to_us(datetime(year, month + 1, 1, tzinfo=timezone.utc))
+
+
+def _global_id(key: int, local_id: int) -> int:
+    return (key << LOCAL_ID_BITS) | local_id
+
+
+def _split_id(event_id: int) -> Tuple[int, int]:
+    return event_id >> LOCAL_ID_BITS, event_id & LOCAL_ID_MASK
+
+
+def _close_partitions(
+    lock: threading.RLock, partitions: Dict[int, sqlite3.Connection]
+) -> None:
+    # Like sqlite._close_storage, for the connections to the partitions
+    with lock:
+        for conn in partitions.values():
+            conn.commit()
+            conn.close()
+        partitions.clear()
+
+
+class PartitionedSqliteStorage(SqliteStorage):
+    """
+    Like SqliteStorage, but the events are split into one database file per month
+    (of their start), next to a database file with the buckets. This keeps each
+    file small enough to back up and VACUUM, and range queries only read the
+    partitions that can contain events in the range.
+
+    Partitions of past months can be compacted with ``compact_partitions``, and
+    made read-only with ``seal_partitions``.
+
+    Since the partition is part of the event id, replacing an event with one
+    that starts in another month moves it and gives it a new id.
+    """
+
+    sid = "sqlite-partitioned"
+
+    def __init__(
+        self,
+        testing,
+        filepath: Optional[str] = None,
+        enable_lazy_commit=True,
+        profile: str = DEFAULT_PROFILE,
+        pragmas: Optional[Mapping[str, Union[int, str]]] = None,
+        rollup_keys: Optional[Sequence[Sequence[str]]] = None,
+        indexed_keys: Optional[Mapping[str, Sequence[str]]] = None,
+        search_keys: Optional[Sequence[str]] = None,
+    ) -> None:
+        ds_name = self.sid + ("-testing" if testing else "")
+        if not filepath:
+            data_dir = get_data_dir("aw-server")
+            filepath = os.path.join(data_dir, ds_name + f".v{LATEST_VERSION}")
+        os.makedirs(filepath, exist_ok=True)
+        self.dirpath = filepath
+
+        # Set before initializing SqliteStorage, which starts the flush thread
+        self._partitions: Dict[int, sqlite3.Connection] = {}
+        self._partition_data_ids: Dict[int, Dict[str, int]] = {}
+        self._partition_keys: List[int] = []
+        self._partition_indexed: Dict[int, FrozenSet[str]] = {}
+        self._partition_searchable: Dict[int, FrozenSet[str]] = {}
+        self._sealed: Set[int] = set()
+        for filename in os.listdir(filepath):
+            match = PARTITION_FILENAME_RE.match(filename)
+            if match:
+                key = int(match.group(1)) * 12 + int(match.group(2)) - 1
+                insort(self._partition_keys, key)
+                # Checks the mode rather than os.access, which is always True for root
+                mode = os.stat(os.path.join(filepath, filename)).st_mode
+                if not mode & stat.S_IWUSR:
+                    self._sealed.add(key)
+
+        super().__init__(
+            testing,
+            filepath=os.path.join(filepath, "buckets.db"),
+            enable_lazy_commit=enable_lazy_commit,
+            profile=profile,
+            pragmas=pragmas,
+            rollup_keys=rollup_keys,
+            indexed_keys=indexed_keys,
+            search_keys=search_keys,
+        )
+        self._partitions_finalizer = weakref.finalize(
+            self, _close_partitions, self._lock, self._partitions
+        )
+        logger.info(
+            f"Found {len(self._partition_keys)} partitions, {len(self._sealed)} of them sealed"
+        )
+
+    def _partition_path(self, key: int) -> str:
+        year, month = divmod(key, 12)
+        return os.path.join(self.dirpath, PARTITION_FILENAME.format(year, month + 1))
+
+    def _partition(
+        self, key: int, write: bool = False, create: bool = False
+    ) -> Optional[sqlite3.Connection]:
+        """
+        Returns the connection to the partition, or None if it doesn't exist and
+        ``create`` isn't set. Raises ValueError when writing to a sealed partition.
+        """
+        if write and key in self._sealed:
+            raise ValueError(
+                f"Partition {self._partition_path(key)} is sealed and can't be modified"
+            )
+        conn = self._partitions.get(key)
+        if conn is not None:
+            return conn
+        path = self._partition_path(key)
+        if key in self._sealed:
+            uri = Path(path).resolve().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            # Sealed partitions keep the columns and index they had when sealed
+            indexed = get_indexed_keys(conn)
+            searchable = get_search_keys(conn)
+        elif key in self._partition_keys or create:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            for statement in CREATE_PARTITION_TABLES:
+                conn.execute(statement)
+            indexed = searchable = frozenset()
+            if HAS_GENERATED_COLUMNS:
+                indexed = sync_indexed_keys(conn, self.indexed_keys)
+            if HAS_FTS5:
+                searchable = sync_search_keys(conn, self.search_keys)
+            conn.commit()
+            if key not in self._partition_keys:
+                insort(self._partition_keys, key)
+        else:
+            return None
+        register_functions(conn)
+        _apply_pragmas(conn, self._pragmas)
+        self._partitions[key] = conn
+        self._partition_indexed[key] = indexed
+        self._partition_searchable[key] = searchable
+        return conn
+
+    def _sync_indexed_keys(self) -> None:
+        # The data is in the partitions, which are synced when they're opened
+        pass
+
+    def _sync_search_keys(self) -> None:
+        # Synced when the partitions are opened too. Sealed partitions without these
+        # keys in their index are searched by reading their events
+        if HAS_FTS5:
+            self._searchable = frozenset(self.search_keys)
+            self.supports_search = bool(self._searchable)
+
+    def _max_duration(self, bucketrow: Optional[int]) -> int:
+        query = "SELECT max_duration FROM buckets WHERE rowid = ?"
+        row = self.conn.execute(query, [bucketrow]).fetchone()
+        return row[0] if row else 0
+
+    def _range_keys(
+        self,
+        bucketrow: Optional[int],
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+    ) -> List[int]:
+        """Keys of the partitions that can contain events in the range, newest first"""
+        lo = -1
+        hi = MAX_TIMESTAMP
+        if starttime:
+            lo = _partition_key(_to_us(starttime) - self._max_duration(bucketrow))
+        if endtime:
+            hi = _partition_key(_to_us(endtime))
+        return [key for key in reversed(self._partition_keys) if lo <= key <= hi]
+
+    def _where_range(
+        self,
+        bucketrow: Optional[int],
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+    ) -> Tuple[str, list]:
+        # Same as sqlite._where_range, with max_duration from the buckets database
+        starttime_i = _to_us(starttime) if starttime else 0
+        endtime_i = _to_us(endtime) if endtime else MAX_TIMESTAMP
+        where = "bucketrow = ? AND endtime >= ? AND starttime <= ?"
+        params: list = [bucketrow, starttime_i, endtime_i]
+        if starttime and endtime:
+            where += " AND starttime >= ?"
+            params.append(starttime_i - self._max_duration(bucketrow))
+        return where, params
+
+    def _select_partition_events(
+        self,
+        conn: sqlite3.Connection,
+        bucketrow: Optional[int],
+        limit: int,
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+        where_data: Optional[FilterSQL] = None,
+    ) -> sqlite3.Cursor:
+        # Same as SqliteStorage._select_events
+        starttime_i = _to_us(starttime) if starttime else 0
+        endtime_i = _to_us(endtime) if endtime else MAX_TIMESTAMP
+        where, params = self._where_range(bucketrow, starttime, endtime)
+        if where_data is not None:
+            where += _where_data(where_data)
+            params += where_data.params
+        query = f"""
+            SELECT id, max(starttime, ?), min(endtime, ?), dataid
+            FROM events
+            WHERE {where}
+            ORDER BY endtime DESC LIMIT ?
+        """
+        return conn.execute(query, [starttime_i, endtime_i, *params, limit])
+
+    @staticmethod
+    def _globalize(key: int, rows: List[tuple]) -> List[tuple]:
+        return [(_global_id(key, row[0]), *row[1:]) for row in rows]
+
+    @_synchronized
+    def commit(self):
+        for conn in self._partitions.values():
+            if conn.in_transaction:
+                conn.commit()
+        super().commit()
+
+    def close(self) -> None:
+        super().close()
+        self._partitions_finalizer()
+
+    @_synchronized
+    def seal_partitions(self, before: datetime) -> List[str]:
+        """
+        Compacts the partitions of months that ended before ``before`` and makes
+        their files read-only. Returns the paths of the newly sealed partitions.
+
+        To modify a sealed partition again, make its file writable.
+        """
+        self.commit()
+        sealed = []
+        for key in self._partition_keys:
+            if key in self._sealed or _partition_start(key + 1) > _to_us(before):
+                continue
+            conn = self._partition(key, write=True)
+            assert conn is not None
+            conn.execute("VACUUM")
+            # Read-only connections can't open databases in WAL mode without its -shm file
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.close()
+            del self._partitions[key]
+            path = self._partition_path(key)
+            os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            self._sealed.add(key)
+            sealed.append(path)
+        return sealed
+
+    @_synchronized
+    def compact_partitions(self, before: Optional[datetime] = None) -> List[str]:
+        """
+        Runs VACUUM on the writable partitions of months that ended before ``before``
+        (or all of them). Returns the paths of the compacted partitions.
+        """
+        self.commit()
+        compacted = []
+        for key in self._partition_keys:
+            if key in self._sealed:
+                continue
+            if before and _partition_start(key + 1) > _to_us(before):
+                continue
+            conn = self._partition(key, write=True)
+            assert conn is not None
+            conn.execute("VACUUM")
+            compacted.append(self._partition_path(key))
+        return compacted
+
+    @_synchronized
+    def delete_bucket(self, bucket_id: str):
+        bucketrow = self._bucket_row(bucket_id)
+        for key in self._partition_keys:
+            if key in self._sealed:
+                logger.warning(
+                    f"Not deleting events of {bucket_id} in sealed partition {self._partition_path(key)}"
+                )
+                continue
+            conn = self._partition(key, write=True)
+            assert conn is not None
+            _delete_bucket_events(conn, bucketrow)
+            self._partition_data_ids.pop(key, None)
+        self.conn.execute("DELETE FROM rollups WHERE bucketrow = ?", [bucketrow])
+        cursor = self.conn.execute("DELETE FROM buckets WHERE id = ?", [bucket_id])
+        self.commit()
+        self.update_bucket_keys()
+        if cursor.rowcount != 1:
+            raise ValueError("Bucket did not exist, could not delete")
+
+    def _iter_spans(self, bucketrow: int) -> Iterator[Span]:
+        for key in self._partition_keys:
+            conn = self._partition(key)
+            assert conn is not None
+            yield from _iter_bucket_spans(conn, bucketrow)
+
+    def _insert(self, bucketrow: Optional[int], event: Event) -> Tuple[int, int, int]:
+        """Inserts the event into its partition, returns its id, starttime and endtime"""
+        starttime = _to_us(event.timestamp)
+        endtime = starttime + _duration_us(event.duration)
+        key = _partition_key(starttime)
+        conn = self._partition(key, write=True, create=True)
+        assert conn is not None
+        data_ids = self._partition_data_ids.setdefault(key, {})
+        c = conn.execute(
+            "INSERT INTO events(bucketrow, starttime, endtime, dataid) VALUES (?, ?, ?, ?)",
+            [bucketrow, starttime, endtime, _get_data_id(conn, data_ids, event.data)],
+        )
+        assert c.lastrowid is not None
+        return _global_id(key, c.lastrowid), starttime, endtime
+
+    @_synchronized
+    def insert_one(self, bucket_id: str, event: Event) -> Event:
+        bucketrow = self._bucket_row(bucket_id)
+        event.id, starttime, endtime = self._insert(bucketrow, event)
+        self._update_last_event_id(bucketrow, event.id, endtime)
+        self._update_max_duration(bucketrow, endtime - starttime)
+        self._update_rollups(bucketrow, [(starttime, endtime, event.data)])
+        self.conditional_commit(1)
+        return event
+
+    @_synchronized
+    def insert_many(self, bucket_id, events: List[Event]) -> None:
+        # First, upsert events with id's set
+        for e in events:
+            if e.id is not None:
+                self.replace(bucket_id, e.id, e)
+
+        # Then insert events without id's set
+        bucketrow = self._bucket_row(bucket_id)
+        spans: List[Span] = []
+        for e in events:
+            if e.id is None:
+                _, starttime, endtime = self._insert(bucketrow, e)
+                spans.append((starttime, endtime, e.data))
+        if spans:
+            self._refresh_last_event_id(bucketrow)
+            self._update_max_duration(
+                bucketrow, max(end - start for start, end, _ in spans)
+            )
+            self._update_rollups(bucketrow, spans)
+        self.conditional_commit(len(spans))
+
+    def _event_endtime(self, event_id: int) -> Optional[int]:
+        key, local_id = _split_id(event_id)
+        conn = self._partition(key)
+        if conn is None:
+            return None
+        query = "SELECT endtime FROM events WHERE id = ?"
+        row = conn.execute(query, [local_id]).fetchone()
+        return row[0] if row else None
+
+    def _last_event_id(self, bucketrow: Optional[int]) -> Optional[int]:
+        query = "SELECT last_event_id FROM buckets WHERE rowid = ?"
+        row = self.conn.execute(query, [bucketrow]).fetchone()
+        return row[0] if row else None
+
+    def _update_last_event_id(
+        self, bucketrow: Optional[int], event_id: Optional[int], endtime
+    ) -> None:
+        last_event_id = self._last_event_id(bucketrow)
+        if last_event_id is not None and last_event_id != event_id:
+            last_endtime = self._event_endtime(last_event_id)
+            if last_endtime is not None and endtime < last_endtime:
+                return
+        self.conn.execute(
+            "UPDATE buckets SET last_event_id = ? WHERE rowid = ?",
+            [event_id, bucketrow],
+        )
+
+    def _refresh_last_event_id(
+        self, bucketrow: Optional[int], if_event_id: Optional[int] = None
+    ) -> None:
+        if if_event_id is not None and self._last_event_id(bucketrow) != if_event_id:
+            return
+        max_duration = self._max_duration(bucketrow)
+        last: Optional[Tuple[int, int]] = None
+        for key in reversed(self._partition_keys):
+            # Events in this partition, or older ones, can't end later than this
+            if last is not None and last[0] >= _partition_start(key + 1) + max_duration:
+                break
+            conn = self._partition(key)
+            assert conn is not None
+            row = conn.execute(
+                """SELECT endtime, id FROM events WHERE bucketrow = ?
+                   ORDER BY endtime DESC, id DESC LIMIT 1""",
+                [bucketrow],
+            ).fetchone()
+            if row is not None:
+                candidate = (row[0], _global_id(key, row[1]))
+                if last is None or candidate > last:
+                    last = candidate
+        self.conn.execute(
+            "UPDATE buckets SET last_event_id = ? WHERE rowid = ?",
+            [last[1] if last else None, bucketrow],
+        )
+
+    @_synchronized
+    def replace_last(self, bucket_id, event):
+        last_event_id = self._last_event_id(self._bucket_row(bucket_id))
+        if last_event_id is not None:
+            self.replace(bucket_id, last_event_id, event)
+        return True
+
+    @_synchronized
+    def update_last(self, bucket_id, event_id, event):
+        key, local_id = _split_id(event_id)
+        starttime = _to_us(event.timestamp)
+        if key not in self._partition_keys or _partition_key(starttime) != key:
+            # Moved to another partition, which gives it a new id
+            self.replace(bucket_id, event_id, event)
+            return
+        endtime = starttime + _duration_us(event.duration)
+        bucketrow = self._bucket_row(bucket_id)
+        conn = self._partition(key, write=True)
+        assert conn is not None
+        old = _get_event_span(conn, local_id) if self.rollup_keys else None
+        data_ids = self._partition_data_ids.setdefault(key, {})
+        dataid = _get_data_id(conn, data_ids, event.data)
+        query = """UPDATE events SET starttime = ?, endtime = ?, dataid = ?
+                   WHERE id = ? AND bucketrow = ?"""
+        c = conn.execute(query, [starttime, endtime, dataid, local_id, bucketrow])
+        self._update_max_duration(bucketrow, endtime - starttime)
+        if c.rowcount == 1:
+            self._update_event_rollups(old, bucketrow, (starttime, endtime, event.data))
+        self.conditional_commit(1)
+
+    @_synchronized
+    def delete(self, bucket_id, event_id):
+        bucketrow = self._bucket_row(bucket_id)
+        key, local_id = _split_id(event_id)
+        if key not in self._partition_keys:
+            return False
+        conn = self._partition(key, write=True)
+        assert conn is not None
+        old = _get_event_span(conn, local_id) if self.rollup_keys else None
+        old_dataid = _get_event_data_id(conn, local_id, bucketrow)
+        query = "DELETE FROM events WHERE id = ? AND bucketrow = ?"
+        deleted = conn.execute(query, [local_id, bucketrow]).rowcount == 1
+        if deleted:
+            data_ids = self._partition_data_ids.setdefault(key, {})
+            _delete_unused_data(conn, data_ids, old_dataid)
+            self._refresh_last_event_id(bucketrow, if_event_id=event_id)
+            if old is not None:
+                self._update_rollups(bucketrow, removed=[old[1]])
+        self.conditional_commit(1)
+        return deleted
+
+    @_synchronized
+    def replace(self, bucket_id, event_id, event) -> bool:
+        bucketrow = self._bucket_row(bucket_id)
+        key, local_id = _split_id(event_id)
+        starttime = _to_us(event.timestamp)
+        endtime = starttime + _duration_us(event.duration)
+        if key not in self._partition_keys:
+            return True
+        conn = self._partition(key, write=True)
+        assert conn is not None
+        old = _get_event_span(conn, local_id) if self.rollup_keys else None
+        old_dataid = _get_event_data_id(conn, local_id)
+        data_ids = self._partition_data_ids.setdefault(key, {})
+        if _partition_key(starttime) == key:
+            query = """UPDATE events
+                         SET bucketrow = ?,
+                             starttime = ?,
+                             endtime = ?,
+                             dataid = ?
+                         WHERE id = ?"""
+            dataid = _get_data_id(conn, data_ids, event.data)
+            c = conn.execute(query, [bucketrow, starttime, endtime, dataid, local_id])
+            if c.rowcount == 0:
+                return True
+            if old_dataid != dataid:
+                _delete_unused_data(conn, data_ids, old_dataid)
+            new_id = event_id
+        else:
+            # Moves the event to the partition of its new start
+            query = "DELETE FROM events WHERE id = ?"
+            if conn.execute(query, [local_id]).rowcount == 0:
+                return True
+            _delete_unused_data(conn, data_ids, old_dataid)
+            new_id, _, _ = self._insert(bucketrow, event)
+            event.id = new_id
+        # The event might have been moved earlier than another one, or to another bucket
+        self._refresh_last_event_ids(event_id)
+        self._update_last_event_id(bucketrow, new_id, endtime)
+        self._update_max_duration(bucketrow, endtime - starttime)
+        self._update_event_rollups(old, bucketrow, (starttime, endtime, event.data))
+        self.conditional_commit(1)
+        return True
+
+    @_synchronized
+    def get_event(
+        self,
+        bucket_id: str,
+        event_id: int,
+    ) -> Optional[Event]:
+        key, local_id = _split_id(event_id)
+        conn = self._partition(key)
+        if conn is None:
+            return None
+        query = """
+            SELECT id, starttime, endtime, dataid
+            FROM events
+            WHERE bucketrow = ? AND id = ?
+            LIMIT 1
+        """
+        rows = conn.execute(query, [self._bucket_row(bucket_id), local_id]).fetchall()
+        datastrs: Dict[int, str] = {}
+        _fetch_datastrs(conn, (row[3] for row in rows), datastrs)
+        events = _rows_to_events(self._globalize(key, rows), datastrs)
+        return events[0] if events else None
+
+    @_synchronized
+    def get_events(
+        self,
+        bucket_id: str,
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ):
+        if limit == 0:
+            return []
+        elif limit < 0:
+            limit = -1
+        bucketrow = self._bucket_row(bucket_id)
+        max_duration = self._max_duration(bucketrow)
+        # Pairs of (trimmed endtime, event), to merge the partitions by endtime
+        results: List[Tuple[int, Event]] = []
+        for key in self._range_keys(bucketrow, starttime, endtime):
+            if limit > 0 and len(results) >= limit:
+                # Events in this partition, or older ones, can't end later than this
+                if results[-1][0] >= _partition_start(key + 1) + max_duration:
+                    break
+            conn = self._partition(key)
+            assert conn is not None
+            cursor = self._select_partition_events(
+                conn, bucketrow, limit, starttime, endtime
+            )
+            rows = self._globalize(key, cursor.fetchall())
+            datastrs: Dict[int, str] = {}
+            _fetch_datastrs(conn, (row[3] for row in rows), datastrs)
+            events = _rows_to_events(rows, datastrs)
+            results.extend((row[2], e) for row, e in zip(rows, events))
+            results.sort(key=lambda pair: pair[0], reverse=True)
+            if limit > 0:
+                del results[limit:]
+        return [e for _, e in results]
+
+    def iter_events(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+    ) -> Iterator[Event]:
+        return self._iter_events(bucket_id, starttime, endtime, chunksize)
+
+    def _iter_events(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+        chunksize: int,
+        filters: Sequence[DataFilter] = (),
+        search: Optional[SearchFilter] = None,
+    ) -> Iterator[Event]:
+        with self._lock:
+            bucketrow = self._bucket_row(bucket_id)
+            keys = self._range_keys(bucketrow, starttime, endtime)
+        partition_iters = [
+            self._iter_partition(
+                key, bucketrow, starttime, endtime, chunksize, filters, search
+            )
+            for key in keys
+        ]
+        for _, event in heapq.merge(*partition_iters, key=lambda pair: -pair[0]):
+            yield event
+
+    def _iter_partition(
+        self,
+        key: int,
+        bucketrow: Optional[int],
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+        chunksize: int,
+        filters: Sequence[DataFilter] = (),
+        search: Optional[SearchFilter] = None,
+    ) -> Iterator[Tuple[int, Event]]:
+        datastrs: Dict[int, str] = {}
+        decoded: Dict[int, Optional[dict]] = {}
+        with self._lock:
+            self._partition(key)
+            where_data = self._filters_sql(key, filters, search)
+            where, params = self._where_range(bucketrow, starttime, endtime)
+        # Like SqliteStorage._iter_events, no cursor is kept open between chunks,
+        # as it would keep a read transaction on the partition (blocking checkpoints)
+        after: Optional[Tuple[int, int, int]] = None
+        while True:
+            with self._lock:
+                # Reopened if it was sealed in between
+                conn = self._partition(key)
+                assert conn is not None
+                chunk = _select_chunk(
+                    conn,
+                    where,
+                    params,
+                    chunksize,
+                    starttime,
+                    endtime,
+                    where_data,
+                    after,
+                )
+                _fetch_datastrs(conn, (row[3] for row in chunk), datastrs)
+            rows = self._globalize(key, [row[:4] for row in chunk])
+            events = _rows_to_events(rows, datastrs, decoded)
+            yield from ((row[2], e) for row, e in zip(rows, events))
+            if len(chunk) < chunksize:
+                break
+            after = chunk[-1][4:]
+
+    @_synchronized
+    def _select_groups(
+        self,
+        bucketrow: Optional[int],
+        keys: Sequence[str],
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+        filters: Sequence[DataFilter],
+    ) -> List[tuple]:
+        # The groups of each partition are merged by SqliteStorage.get_aggregate
+        where, params = self._where_range(bucketrow, starttime, endtime)
+        rows = []
+        for key in self._range_keys(bucketrow, starttime, endtime):
+            conn = self._partition(key)
+            assert conn is not None
+            where_data = self._filters_sql(key, filters)
+            rows += _select_groups(
+                conn, keys, where, params, starttime, endtime, where_data
+            )
+        return rows
+
+    def _filters_sql(
+        self,
+        key: int,
+        filters: Sequence[DataFilter],
+        search: Optional[SearchFilter] = None,
+    ) -> Optional[FilterSQL]:
+        # Partitions can have different indexed keys, if some were sealed before
+        return _filters_where(
+            filters,
+            search,
+            self._partition_indexed[key],
+            self._partition_searchable[key],
+        )
+
+    @_synchronized
+    def get_eventcount(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ):
+        bucketrow = self._bucket_row(bucket_id)
+        starttime_i = _to_us(starttime) if starttime else 0
+        endtime_i = _to_us(endtime) if endtime else MAX_TIMESTAMP
+        query = "SELECT count(*) FROM events WHERE bucketrow = ? AND endtime >= ? AND starttime <= ?"
+        eventcount = 0
+        for key in self._range_keys(bucketrow, starttime, endtime):
+            conn = self._partition(key)
+            assert conn is not None
+            row = conn.execute(query, [bucketrow, starttime_i, endtime_i]).fetchone()
+            eventcount += row[0]
+        return eventcount
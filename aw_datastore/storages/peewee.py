@@ -5,6 +5,7 @@ from datetime import datetime, timedelta, timezone
 from typing import (
     Any,
     Dict,
+    Iterator,
     List,
     Optional,
 )
@@ -26,7 +27,7 @@ from peewee import (
     Model,
 )
 
-from .abstract import AbstractStorage
+from .abstract import AbstractStorage, _trim_event
 
 logger = logging.getLogger(__name__)
 
@@ -364,19 +365,31 @@ class PeeweeStorage(AbstractStorage):
         events = [Event(**e) for e in list(map(EventModel.json, res))]
 
         # Trim events that are out of range (as done in aw-server-rust)
-        # TODO: Do the same for the other storage methods
         for e in events:
-            if starttime:
-                if e.timestamp < starttime:
-                    e_end = e.timestamp + e.duration
-                    e.timestamp = starttime
-                    e.duration = e_end - e.timestamp
-            if endtime:
-                if e.timestamp + e.duration > endtime:
-                    e.duration = endtime - e.timestamp
+            _trim_event(e, starttime, endtime)
 
         return events
 
+    def iter_events(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+    ) -> Iterator[Event]:
+        q = (
+            EventModel.select()
+            .where(EventModel.bucket == self.bucket_keys[bucket_id])
+            .order_by(EventModel.timestamp.desc())
+        )
+        q = self._where_range(q, starttime, endtime)
+
+        # Using .iterator() avoids peewee caching every row in the result
+        for res in q.iterator():
+            e = Event(**EventModel.json(res))
+            _trim_event(e, starttime, endtime)
+            yield e
+
     def get_eventcount(
         self,
         bucket_id: str,
@@ -0,0 +1,128 @@
+"""
+Pre-aggregated durations of events per hour, by the values of some of their data keys.
+
+For each configured set of keys, the ``rollups`` table has a row per bucket, hour and
+distinct value of the keys (stored as the JSON of the merged data, like the data of the
+events returned by ``aw_transform.merge_events_by_keys``) with the total duration of the
+events in that hour and the number of events contributing to it.
+
+Events spanning several hours are split at the hour boundaries, so summing the rows of
+a range of whole hours gives the same durations as merging the events trimmed to it.
+"""
+
+import json
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+HOUR_US = 3600 * 1000000
+
+# A set of keys to roll up, such as ("app", "title")
+RollupKeys = Tuple[str, ...]
+
+# An event as (starttime, endtime, data), with times in microseconds since the epoch
+Span = Tuple[int, int, dict]
+
+# Changes to rollup rows, (keys, hour, datastr) -> [duration, count]
+RollupDiff = Dict[Tuple[str, int, str], List[int]]
+
+
+def keys_str(keys: Sequence[str]) -> str:
+    """The set of keys as stored in the rollup tables"""
+    return json.dumps(list(keys))
+
+
+def group_datastr(data: dict, keys: Sequence[str]) -> str:
+    """The data of the merged event that the data is rolled up into"""
+    return json.dumps({key: data[key] for key in keys if key in data})
+
+
+def add_spans(
+    diff: RollupDiff,
+    keysets: Sequence[RollupKeys],
+    spans: Iterable[Span],
+    sign: int = 1,
+) -> None:
+    """Adds (or with ``sign=-1``, subtracts) the events to the diff, split by hour"""
+    for starttime, endtime, data in spans:
+        first_hour = starttime // HOUR_US
+        # Zero-duration events still count towards the hour they're in
+        last_hour = max(starttime, endtime - 1) // HOUR_US
+        for keys in keysets:
+            ks = keys_str(keys)
+            datastr = group_datastr(data, keys)
+            for hour in range(first_hour, last_hour + 1):
+                hour_start = hour * HOUR_US
+                duration = min(endtime, hour_start + HOUR_US) - max(
+                    starttime, hour_start
+                )
+                change = diff.setdefault((ks, hour, datastr), [0, 0])
+                change[0] += sign * duration
+                change[1] += sign
+
+
+def apply_diff(conn: sqlite3.Connection, bucketrow: int, diff: RollupDiff) -> None:
+    """Adds the changes in the diff to the rollup rows of the bucket"""
+    rows = [
+        (bucketrow, ks, hour, datastr, duration, count)
+        for (ks, hour, datastr), (duration, count) in diff.items()
+        if duration != 0 or count != 0
+    ]
+    conn.executemany(
+        """INSERT INTO rollups(bucketrow, keys, hour, datastr, duration, count)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT(bucketrow, keys, hour, datastr) DO UPDATE SET
+               duration = duration + excluded.duration,
+               count = count + excluded.count""",
+        rows,
+    )
+    # Rows that no longer have any events
+    conn.executemany(
+        """DELETE FROM rollups
+           WHERE bucketrow = ? AND keys = ? AND hour = ? AND datastr = ? AND count <= 0""",
+        [row[:4] for row in rows if row[5] < 0],
+    )
+
+
+def sync_keysets(
+    conn: sqlite3.Connection, keysets: Sequence[RollupKeys]
+) -> List[RollupKeys]:
+    """
+    Makes the sets of keys rolled up in the database match ``keysets``, removing
+    the rollups of the others. Returns the new sets of keys, which need to be filled.
+    """
+    stored: Set[str] = {row[0] for row in conn.execute("SELECT keys FROM rollup_keys")}
+    wanted = {keys_str(keys): keys for keys in keysets}
+    for ks in stored - set(wanted):
+        conn.execute("DELETE FROM rollups WHERE keys = ?", [ks])
+        conn.execute("DELETE FROM rollup_keys WHERE keys = ?", [ks])
+    added = [keys for ks, keys in wanted.items() if ks not in stored]
+    conn.executemany(
+        "INSERT INTO rollup_keys(keys) VALUES (?)", [(keys_str(k),) for k in added]
+    )
+    return added
+
+
+def query_rollup(
+    conn: sqlite3.Connection,
+    bucketrow: Optional[int],
+    keys: Sequence[str],
+    first_hour: Optional[int],
+    end_hour: Optional[int],
+) -> Dict[str, List[int]]:
+    """
+    Sums the rollup rows of the hours in [first_hour, end_hour), returns
+    datastr -> [duration, first hour, last hour] for each distinct value of the keys.
+    """
+    where = "bucketrow = ? AND keys = ?"
+    params: list = [bucketrow, keys_str(keys)]
+    if first_hour is not None:
+        where += " AND hour >= ?"
+        params.append(first_hour)
+    if end_hour is not None:
+        where += " AND hour < ?"
+        params.append(end_hour)
+    query = f"SELECT datastr, sum(duration), min(hour), max(hour) FROM rollups WHERE {where} GROUP BY datastr"
+    return {
+        datastr: [duration, first, last]
+        for datastr, duration, first, last in conn.execute(query, params)
+    }
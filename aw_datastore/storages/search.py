@@ -0,0 +1,147 @@
+"""
+Full-text search of the data of events, which SQLite storages can do with an FTS5 index.
+
+The ``eventdata_search`` table has a column per searchable key, holding its value in
+each row of the eventdata table (if it's a string), and is kept up to date by triggers
+on eventdata. Since the data of events is only stored once, inserting, replacing and
+deleting events only updates the index when data is added or removed.
+
+The words of the values are split like SQLite's unicode61 tokenizer does, which is
+approximated in Python by runs of letters and digits. The index is only used to look
+up the data that can match, events read with it are checked with ``SearchFilter.match``.
+"""
+
+import re
+import sqlite3
+from typing import FrozenSet, List, NamedTuple, Sequence, Tuple
+
+from .filters import FilterSQL
+
+_WORD_RE = re.compile(r"[^\W_]+")
+
+# Folds case like unicode61, but keeps diacritics so that they match as in Python
+SEARCH_TOKENIZER = "unicode61 remove_diacritics 0"
+
+# Keys searched by default, those of window titles and URLs
+DEFAULT_SEARCH_KEYS = ("title", "url")
+
+
+def _has_fts5() -> bool:
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE test USING fts5(text)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+HAS_FTS5 = _has_fts5()
+
+
+def search_words(text: str) -> List[str]:
+    """Splits a text into lowercase words"""
+    return _WORD_RE.findall(text.lower())
+
+
+class SearchFilter(NamedTuple):
+    """
+    Selects events with all the words of ``text`` in the values of ``keys`` in their
+    data, each as the start of a word (ignoring case). Values that aren't strings are
+    not searched.
+    """
+
+    text: str
+    keys: Tuple[str, ...] = DEFAULT_SEARCH_KEYS
+
+    @property
+    def terms(self) -> List[str]:
+        return search_words(self.text)
+
+    def match(self, data: dict) -> bool:
+        words = [
+            word
+            for key in self.keys
+            if isinstance(data.get(key), str)
+            for word in search_words(data[key])
+        ]
+        return all(any(w.startswith(term) for w in words) for term in self.terms)
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def search_sql(search: SearchFilter) -> FilterSQL:
+    """
+    Returns a condition on the eventdata table that is true for the data matching
+    the search (and maybe others), looked up with the search index.
+    """
+    terms = " AND ".join(f'"{term}"*' for term in search.terms)
+    columns = " ".join(_quote(key) for key in search.keys)
+    query = f"{{{columns}}}: ({terms})"
+    condition = (
+        "id IN (SELECT rowid FROM eventdata_search WHERE eventdata_search MATCH ?)"
+    )
+    return FilterSQL(condition, [query], seek=True)
+
+
+def get_search_keys(conn: sqlite3.Connection) -> FrozenSet[str]:
+    """Returns the keys in the search index, none if there's no index"""
+    rows = conn.execute("PRAGMA table_info(eventdata_search)").fetchall()
+    return frozenset(row[1] for row in rows)
+
+
+def _values_sql(keys: Sequence[str], datastr: str) -> str:
+    values = []
+    for key in keys:
+        path = f'$."{key}"'.replace("'", "''")
+        values.append(
+            f"CASE json_type({datastr}, '{path}')"
+            f" WHEN 'text' THEN json_extract({datastr}, '{path}') END"
+        )
+    return ", ".join(values)
+
+
+def sync_search_keys(conn: sqlite3.Connection, keys: Sequence[str]) -> FrozenSet[str]:
+    """
+    Makes the search index have the keys, rebuilding it from the eventdata table if
+    it had others, or dropping it if there are none. Returns the keys in the index.
+    Keys containing '"' can't be searched.
+    """
+    rows = conn.execute("PRAGMA table_info(eventdata_search)").fetchall()
+    if [row[1] for row in rows] == list(keys):
+        return frozenset(keys)
+    conn.execute("DROP TRIGGER IF EXISTS eventdata_search_insert")
+    conn.execute("DROP TRIGGER IF EXISTS eventdata_search_delete")
+    conn.execute("DROP TABLE IF EXISTS eventdata_search")
+    if not keys:
+        return frozenset()
+    columns = ", ".join(_quote(key) for key in keys)
+    conn.execute(
+        f"CREATE VIRTUAL TABLE eventdata_search USING fts5({columns},"
+        f" tokenize = '{SEARCH_TOKENIZER}')"
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER eventdata_search_insert AFTER INSERT ON eventdata BEGIN
+            INSERT INTO eventdata_search(rowid, {columns})
+            VALUES (new.id, {_values_sql(keys, "new.datastr")});
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER eventdata_search_delete AFTER DELETE ON eventdata BEGIN
+            DELETE FROM eventdata_search WHERE rowid = old.id;
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        INSERT INTO eventdata_search(rowid, {columns})
+        SELECT id, {_values_sql(keys, "datastr")} FROM eventdata
+        """
+    )
+    return frozenset(keys)
@@ -1,22 +1,136 @@
+import functools
+import hashlib
 import json
 import logging
 import os
+import queue
+import re
 import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Iterable, List, Optional
+from pathlib import Path
+from typing import (
+    AbstractSet,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 from aw_core.dirs import get_data_dir
 from aw_core.models import Event
 
 from .abstract import AbstractStorage
+from .filters import (
+    DataFilter,
+    FilterSQL,
+    filters_sql,
+    register_functions,
+    sync_indexed_keys,
+)
+from .rollups import (
+    HOUR_US,
+    RollupDiff,
+    RollupKeys,
+    Span,
+    add_spans,
+    apply_diff,
+    group_datastr,
+    query_rollup,
+    sync_keysets,
+)
+from .search import HAS_FTS5, SearchFilter, search_sql, sync_search_keys
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    # Optional, decoding the event data is faster with it
+    orjson = None  # type: ignore
 
 logger = logging.getLogger(__name__)
 
-LATEST_VERSION = 1
+# Bumped to 2 when the data of events moved to the eventdata table, which older
+# versions of aw-core can't read (see aw_datastore.migration.sqlite_v1_to_v2)
+LATEST_VERSION = 2
 
 # The max integer value in SQLite is signed 8 Bytes / 64 bits
 MAX_TIMESTAMP = 2**63 - 1
 
+# Number of data ids that are cached by their datastr, to avoid looking them up on insert
+MAX_CACHED_DATA_IDS = 10_000
+
+# Max number of parameters in a statement on older SQLite versions is 999
+MAX_PARAMETERS = 500
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+TD1US = timedelta(microseconds=1)
+
+# The -> operator, used to group events by the JSON of values in their data
+HAS_JSON_OPERATORS = sqlite3.sqlite_version_info >= (3, 38, 0)
+
+# Generated columns, for indexed keys (and dropping them when they aren't anymore)
+HAS_GENERATED_COLUMNS = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# With lazy commits enabled, pending writes are committed by a background
+# thread once there are this many of them, or they are this old.
+MAX_UNCOMMITTED_STATEMENTS = 1000
+MAX_COMMIT_DELAY = timedelta(seconds=10)
+
+# Seconds to wait for a connection of the read pool, before reading on the writer
+READ_POOL_TIMEOUT = 5
+
+# Presets of performance related PRAGMAs, selected with the `profile` argument.
+#  - durable: the SQLite defaults, every commit is synced to disk
+#  - balanced: commits are only synced on checkpoints, which in WAL mode can lose the
+#    last commits on power loss but never corrupts the database
+#  - fast: like balanced but never syncs, and uses more memory for caching
+# See: https://www.sqlite.org/pragma.html
+PRAGMA_PROFILES: Dict[str, Dict[str, Union[int, str]]] = {
+    "durable": {
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+    },
+    "balanced": {
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 256 * 2**20,
+        "temp_store": "MEMORY",
+    },
+    "fast": {
+        "synchronous": "OFF",
+        "cache_size": -64000,
+        "mmap_size": 2**30,
+        "temp_store": "MEMORY",
+    },
+}
+DEFAULT_PROFILE = "durable"
+
+# PRAGMAs that can be overridden with the `pragmas` argument
+TUNABLE_PRAGMAS = [
+    "synchronous",
+    "cache_size",
+    "mmap_size",
+    "temp_store",
+    "journal_size_limit",
+    "wal_autocheckpoint",
+]
+
+# Names of the values that PRAGMAs read back as integers
+_PRAGMA_VALUE_NAMES = {
+    "synchronous": ["OFF", "NORMAL", "FULL", "EXTRA"],
+    "temp_store": ["DEFAULT", "FILE", "MEMORY"],
+}
+
 CREATE_BUCKETS_TABLE = """
     CREATE TABLE IF NOT EXISTS buckets (
         rowid INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -41,38 +155,533 @@ CREATE_EVENTS_TABLE = """
     )
 """
 
-INDEX_BUCKETS_TABLE_ID = """
-    CREATE INDEX IF NOT EXISTS event_index_id ON events(id);
-"""
 
-INDEX_EVENTS_TABLE_STARTTIME = """
-    CREATE INDEX IF NOT EXISTS event_index_starttime ON events(bucketrow, starttime);
-"""
-INDEX_EVENTS_TABLE_ENDTIME = """
-    CREATE INDEX IF NOT EXISTS event_index_endtime ON events(bucketrow, endtime);
-"""
+def _to_us(dt: datetime) -> int:
+    """Converts a datetime to integer microseconds since the epoch, as stored in the database"""
+    return round(dt.timestamp() * 1000000)
+
+
+def _duration_us(duration: timedelta) -> int:
+    return duration // TD1US
+
+
+def _loads(datastr: str) -> dict:
+    if orjson is not None:
+        try:
+            return orjson.loads(datastr)
+        except orjson.JSONDecodeError:
+            # Such as NaN, which json.dumps writes but orjson doesn't accept
+            pass
+    return json.loads(datastr)
+
+
+def data_hash(datastr: str) -> bytes:
+    """Content hash identifying a datastr in the eventdata table"""
+    return hashlib.blake2b(datastr.encode("utf-8"), digest_size=16).digest()
+
+
+def _fetch_datastrs(
+    conn: sqlite3.Connection, dataids: Iterable[int], datastrs: Dict[int, str]
+) -> None:
+    """Adds the datastr of the data ids that aren't in datastrs yet"""
+    missing = list({dataid for dataid in dataids if dataid not in datastrs})
+    for i in range(0, len(missing), MAX_PARAMETERS):
+        chunk = missing[i : i + MAX_PARAMETERS]
+        query = "SELECT id, datastr FROM eventdata WHERE id IN ({})".format(
+            ", ".join("?" * len(chunk))
+        )
+        datastrs.update(conn.execute(query, chunk))
+
+
+def _get_data_id(conn: sqlite3.Connection, cache: Dict[str, int], data: dict) -> int:
+    """Returns the id of the data in the eventdata table, inserting it if needed"""
+    datastr = json.dumps(data)
+    dataid = cache.get(datastr)
+    if dataid is None:
+        h = data_hash(datastr)
+        c = conn.execute(
+            "INSERT OR IGNORE INTO eventdata(hash, datastr) VALUES (?, ?)",
+            [h, datastr],
+        )
+        if c.rowcount == 1:
+            dataid = c.lastrowid
+        else:
+            query = "SELECT id FROM eventdata WHERE hash = ?"
+            dataid = conn.execute(query, [h]).fetchone()[0]
+        assert dataid is not None
+        if len(cache) >= MAX_CACHED_DATA_IDS:
+            cache.clear()
+        cache[datastr] = dataid
+    return dataid
+
+
+def _get_event_data_id(
+    conn: sqlite3.Connection, event_id: Optional[int], bucketrow: Optional[int] = None
+) -> Optional[int]:
+    """Returns the data id of the event (in the bucket, if given)"""
+    query = "SELECT dataid FROM events WHERE id = ?"
+    params = [event_id]
+    if bucketrow is not None:
+        query += " AND bucketrow = ?"
+        params.append(bucketrow)
+    row = conn.execute(query, params).fetchone()
+    return row[0] if row else None
+
+
+def _delete_unused_data(
+    conn: sqlite3.Connection, cache: Dict[str, int], dataid: Optional[int]
+) -> None:
+    """Deletes the data from the eventdata table if no event uses it anymore"""
+    if dataid is None:
+        return
+    row = conn.execute(
+        """SELECT datastr FROM eventdata WHERE id = ?
+           AND NOT EXISTS (SELECT 1 FROM events WHERE dataid = eventdata.id)""",
+        [dataid],
+    ).fetchone()
+    if row is not None:
+        conn.execute("DELETE FROM eventdata WHERE id = ?", [dataid])
+        # Inserting the data again must not give the deleted id
+        cache.pop(row[0], None)
+
+
+def _delete_bucket_events(conn: sqlite3.Connection, bucketrow: Optional[int]) -> None:
+    """Deletes the events of the bucket, and the data that only they used"""
+    query = "SELECT dataid FROM events WHERE bucketrow = ?"
+    dataids = list({row[0] for row in conn.execute(query, [bucketrow])})
+    conn.execute("DELETE FROM events WHERE bucketrow = ?", [bucketrow])
+    for i in range(0, len(dataids), MAX_PARAMETERS):
+        chunk = dataids[i : i + MAX_PARAMETERS]
+        conn.execute(
+            "DELETE FROM eventdata WHERE id IN ({}) ".format(
+                ", ".join("?" * len(chunk))
+            )
+            + "AND NOT EXISTS (SELECT 1 FROM events WHERE dataid = eventdata.id)",
+            chunk,
+        )
+
+
+def _get_event_span(
+    conn: sqlite3.Connection, event_id: Optional[int]
+) -> Optional[Tuple[int, Span]]:
+    """Returns the bucketrow of the event, and the event as a span"""
+    row = conn.execute(
+        """SELECT e.bucketrow, e.starttime, e.endtime, d.datastr
+           FROM events e JOIN eventdata d ON d.id = e.dataid
+           WHERE e.id = ?""",
+        [event_id],
+    ).fetchone()
+    if row is None:
+        return None
+    bucketrow, starttime, endtime, datastr = row
+    return bucketrow, (round(starttime), round(endtime), _loads(datastr))
+
+
+def _iter_bucket_spans(conn: sqlite3.Connection, bucketrow: int) -> Iterator[Span]:
+    """Yields all events of the bucket as spans"""
+    decoded: Dict[int, dict] = {}
+    query = "SELECT starttime, endtime, dataid FROM events WHERE bucketrow = ?"
+    for starttime, endtime, dataid in conn.execute(query, [bucketrow]):
+        data = decoded.get(dataid)
+        if data is None:
+            if len(decoded) >= MAX_CACHED_DATA_IDS:
+                decoded.clear()
+            datastr = conn.execute(
+                "SELECT datastr FROM eventdata WHERE id = ?", [dataid]
+            ).fetchone()[0]
+            data = decoded[dataid] = _loads(datastr)
+        yield round(starttime), round(endtime), data
+
 
+def _rows_to_events(
+    rows: Iterable,
+    datastrs: Mapping[int, str],
+    decoded: Optional[Dict[int, Optional[dict]]] = None,
+) -> List[Event]:
+    """
+    Decodes rows of (id, starttime, endtime, dataid) into events, with the data
+    looked up in datastrs.
 
-def _rows_to_events(rows: Iterable) -> List[Event]:
+    Since event data repeats a lot (consecutive heartbeats of the same window, for
+    example), each distinct data is only decoded once. Every event still gets its
+    own copy of the data, since transforms modify events in place.
+    """
     events = []
-    for row in rows:
-        eid = row[0]
-        starttime = datetime.fromtimestamp(row[1] / 1000000, timezone.utc)
-        endtime = datetime.fromtimestamp(row[2] / 1000000, timezone.utc)
-        duration = endtime - starttime
-        data = json.loads(row[3])
-        events.append(Event(id=eid, timestamp=starttime, duration=duration, data=data))
+    # Decoded data for each dataid, or None if it contains nested values
+    # (in which case a shallow copy isn't enough, and it's decoded every time)
+    if decoded is None:
+        decoded = {}
+    for eid, starttime, endtime, dataid in rows:
+        # Older databases may contain floats, newer ones integers
+        start_us = round(starttime)
+        duration_us = round(endtime) - start_us
+        try:
+            flat_data = decoded[dataid]
+        except KeyError:
+            data = _loads(datastrs[dataid])
+            flat = not any(isinstance(v, (dict, list)) for v in data.values())
+            decoded[dataid] = data if flat else None
+            if flat:
+                data = dict(data)
+        else:
+            if flat_data is not None:
+                data = dict(flat_data)
+            else:
+                data = _loads(datastrs[dataid])
+        events.append(
+            Event.from_trusted(
+                id=eid,
+                # Truncated to millisecond resolution like the Event initializer does
+                timestamp=EPOCH + timedelta(microseconds=start_us - start_us % 1000),
+                duration=timedelta(microseconds=duration_us),
+                data=data,
+            )
+        )
     return events
 
 
+def _resolve_pragmas(
+    profile: str, overrides: Optional[Mapping[str, Union[int, str]]]
+) -> Dict[str, Union[int, str]]:
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError(
+            f"Unknown profile '{profile}', must be one of: {', '.join(PRAGMA_PROFILES)}"
+        )
+    pragmas = dict(PRAGMA_PROFILES[profile])
+    for name, value in (overrides or {}).items():
+        # Values are formatted into the statement, so only allow plain keywords and integers
+        if name not in TUNABLE_PRAGMAS:
+            raise ValueError(f"Unsupported pragma '{name}'")
+        if isinstance(value, bool) or not (
+            isinstance(value, int)
+            or (isinstance(value, str) and re.fullmatch(r"[A-Za-z]+", value))
+        ):
+            raise ValueError(f"Invalid value for pragma '{name}': {value!r}")
+        pragmas[name] = int(value) if isinstance(value, int) else str(value)
+    return pragmas
+
+
+def _apply_pragmas(
+    conn: sqlite3.Connection, pragmas: Mapping[str, Union[int, str]]
+) -> None:
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+def _range_us(
+    starttime: Optional[datetime], endtime: Optional[datetime]
+) -> Tuple[int, int]:
+    """Converts a range to microseconds, with missing bounds being unbounded"""
+    starttime_i = _to_us(starttime) if starttime else 0
+    endtime_i = _to_us(endtime) if endtime else MAX_TIMESTAMP
+    return starttime_i, endtime_i
+
+
+def _where_range(
+    bucketrow: Optional[int],
+    starttime: Optional[datetime],
+    endtime: Optional[datetime],
+) -> Tuple[str, list]:
+    """
+    Returns the WHERE clause (and its parameters) selecting the events of the
+    bucket that intersect the range.
+
+    Since no event in the bucket is longer than its max_duration, events that
+    end after the start of the range must also start after start - max_duration.
+    This bounds starttime from both sides, so the range can be looked up
+    with an index seek even if the bucket is huge.
+
+    Only done if the range has an end, for open ranges the index on endtime
+    is already tight and also gives the events in the order they're returned.
+    """
+    starttime_i, endtime_i = _range_us(starttime, endtime)
+    where = "bucketrow = ? AND endtime >= ? AND starttime <= ?"
+    params: list = [bucketrow, starttime_i, endtime_i]
+    if starttime and endtime:
+        where += (
+            " AND starttime >= ? - (SELECT max_duration FROM buckets WHERE rowid = ?)"
+        )
+        params += [starttime_i, bucketrow]
+    return where, params
+
+
+def _where_data(where_data: FilterSQL) -> str:
+    """Adds a condition on the data of events (see ``filters.filters_sql``)"""
+    if where_data.seek:
+        # Looks up the matching data with the index on the column, then their events
+        return f" AND dataid IN (SELECT id FROM eventdata WHERE {where_data.condition})"
+    return f" AND (SELECT {where_data.condition} FROM eventdata WHERE eventdata.id = dataid)"
+
+
+def _select_chunk(
+    conn: sqlite3.Connection,
+    where: str,
+    params: list,
+    chunksize: int,
+    starttime: Optional[datetime],
+    endtime: Optional[datetime],
+    where_data: Optional[FilterSQL],
+    after: Optional[Tuple[int, int, int]],
+) -> List[tuple]:
+    """
+    Like ``SqliteStorage._select_events`` with the range condition ``where``, but
+    returns the next chunk of events after the (endtime, starttime, id) of the last
+    one read, which are added to the rows.
+    """
+    starttime_i, endtime_i = _range_us(starttime, endtime)
+    params = list(params)
+    if where_data is not None:
+        where += _where_data(where_data)
+        params += where_data.params
+    if after is not None:
+        where += " AND (endtime, starttime, id) < (?, ?, ?)"
+        params += after
+    query = f"""
+        SELECT id, max(starttime, ?), min(endtime, ?), dataid, endtime, starttime, id
+        FROM events
+        WHERE {where}
+        ORDER BY endtime DESC, starttime DESC, id DESC LIMIT ?
+    """
+    return conn.execute(query, [starttime_i, endtime_i, *params, chunksize]).fetchall()
+
+
+def _filters_where(
+    filters: Sequence[DataFilter],
+    search: Optional[SearchFilter],
+    indexed: AbstractSet[str],
+    searchable: AbstractSet[str],
+) -> Optional[FilterSQL]:
+    """
+    Returns the condition on the eventdata table for the filters and the search, or
+    None if there's none. The search is left out if its keys aren't all searchable,
+    the events then have to be checked with ``SearchFilter.match``.
+    """
+    where_data = filters_sql(filters, indexed=indexed) if filters else None
+    if search is None or not search.terms or not set(search.keys) <= searchable:
+        return where_data
+    search_data = search_sql(search)
+    if where_data is None:
+        return search_data
+    return FilterSQL(
+        f"{where_data.condition} AND {search_data.condition}",
+        where_data.params + search_data.params,
+        seek=True,
+    )
+
+
+def _select_groups(
+    conn: sqlite3.Connection,
+    keys: Sequence[str],
+    where: str,
+    params: list,
+    starttime: Optional[datetime],
+    endtime: Optional[datetime],
+    where_data: Optional[FilterSQL] = None,
+) -> List[tuple]:
+    """
+    Groups the events selected by the WHERE clause by the JSON of the value of each
+    of the keys in their data. Returns a row of (*values, duration, latest endtime,
+    starttime of the latest event) per group, with the events trimmed to the range.
+    """
+    starttime_i, endtime_i = _range_us(starttime, endtime)
+    if where_data is not None:
+        if where_data.seek:
+            where += _where_data(where_data)
+        else:
+            where += f" AND {where_data.condition}"
+        params = params + where_data.params
+    columns = "".join("datastr -> ?, " for _ in keys)
+    group_by = ", ".join(str(i + 1) for i in range(len(keys)))
+    # With a single max(), SQLite takes the bare starttime from the row with that max
+    query = f"""
+        SELECT {columns}sum(min(endtime, ?) - max(starttime, ?)), max(endtime), starttime
+        FROM events JOIN eventdata ON eventdata.id = events.dataid
+        WHERE {where}
+        {"GROUP BY " + group_by if keys else ""}
+    """
+    paths = [f'$."{key}"' for key in keys]
+    rows = conn.execute(query, [*paths, endtime_i, starttime_i, *params]).fetchall()
+    # Without keys there's always a row, even if no event matched
+    return [row for row in rows if row[len(keys)] is not None]
+
+
+def _composite_key(data: dict) -> tuple:
+    """The key merge_events_by_keys merges events by, so values such as 1 and 1.0 are merged"""
+    return tuple(
+        tuple(value) if isinstance(value, list) else value for value in data.values()
+    )
+
+
+def _merge_groups(
+    rows: Iterable[tuple], keys: Sequence[str], starttime: Optional[datetime]
+) -> List[Event]:
+    """
+    Merges the groups returned by ``_select_groups`` (possibly from several
+    databases) into the events that ``aw_transform.merge_events_by_keys`` would
+    return for the events in them, or a single event if there are no keys.
+    """
+    starttime_i = _range_us(starttime, None)[0]
+    merged: Dict[tuple, Event] = {}
+    # The data and timestamp of a merged event are those of its latest event
+    for row in sorted(rows, key=lambda row: row[len(keys) + 1], reverse=True):
+        values = row[: len(keys)]
+        duration_us, _, start_us = row[len(keys) :]
+        data = {
+            key: json.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+        composite_key = _composite_key(data)
+        duration = timedelta(microseconds=round(duration_us))
+        event = merged.get(composite_key)
+        if event is None:
+            start_us = max(round(start_us), starttime_i)
+            merged[composite_key] = Event.from_trusted(
+                id=None,
+                timestamp=EPOCH + timedelta(microseconds=start_us - start_us % 1000),
+                duration=duration,
+                data=data,
+            )
+        else:
+            event.duration += duration
+    return list(merged.values())
+
+
+def _synchronized(f):
+    """Serializes access to the connection, which is shared with the flush thread"""
+
+    @functools.wraps(f)
+    def g(self, *args, **kwargs):
+        with self._lock:
+            return f(self, *args, **kwargs)
+
+    return g
+
+
+def _close_storage(
+    lock: threading.RLock,
+    stop: threading.Event,
+    wakeup: threading.Event,
+    flush_thread: Optional[threading.Thread],
+    conn: sqlite3.Connection,
+    read_pool: Optional[queue.Queue],
+) -> None:
+    """
+    Stops the flush thread, commits pending writes and closes the connections of a
+    SqliteStorage. Run by ``close``, or when the storage is garbage collected or the
+    interpreter exits without it being closed, which is why it doesn't take the storage.
+    """
+    stop.set()
+    wakeup.set()
+    # The flush thread may be the one dropping the last reference to the storage
+    if flush_thread is not None and flush_thread is not threading.current_thread():
+        flush_thread.join()
+    with lock:
+        conn.commit()
+        conn.close()
+    if read_pool is not None:
+        while not read_pool.empty():
+            read_pool.get().close()
+
+
+def _flush_loop(
+    storage_ref: "weakref.ref[SqliteStorage]",
+    stop: threading.Event,
+    wakeup: threading.Event,
+) -> None:
+    # Only holds a weak reference so that the storage can be garbage collected
+    poll_interval = min(1.0, MAX_COMMIT_DELAY.total_seconds())
+    while not stop.is_set():
+        wakeup.wait(poll_interval)
+        wakeup.clear()
+        storage = storage_ref()
+        if storage is None:
+            return
+        try:
+            storage._flush_if_due()
+        except sqlite3.Error as e:  # pragma: no cover
+            logger.error(f"Failed to flush pending writes: {e}")
+        del storage
+
+
 class SqliteStorage(AbstractStorage):
+    """
+    Stores buckets and events in an SQLite database.
+
+    All writes go through a single connection, serialized by a lock. If
+    ``read_connections`` is set, reads are done on a pool of that many read-only
+    connections instead, so that they can run in parallel with each other and
+    with writes (the database is in WAL mode). Pending writes are committed
+    before reading from the pool, so that the readers see them.
+
+    Performance related PRAGMAs are set from one of the presets in
+    ``PRAGMA_PROFILES``, selected with ``profile``, and can be overridden
+    individually with ``pragmas``.
+
+    For each list of keys in ``rollup_keys``, the durations of the events are
+    also kept summed per hour and value of the keys, updated on every write.
+    ``get_rollup`` uses them to merge events by those keys without reading the
+    events (see aw_datastore.storages.rollups).
+
+    ``indexed_keys`` maps bucket types to the keys of their data that are looked up
+    often (such as {"currentwindow": ["app", "title"]}). Each of them gets a virtual
+    generated column on the eventdata table, with an index, so that filters on them
+    look up the matching events through the index. Since the data of all buckets is
+    in the same table, the keys of all types are indexed for all buckets.
+
+    The values of the keys in ``search_keys`` (such as ["title", "url"]) are kept in
+    a full-text search index (see aw_datastore.storages.search), which
+    ``search_events`` uses to find the events containing some words.
+    """
+
     sid = "sqlite"
 
     def __init__(
-        self, testing, filepath: Optional[str] = None, enable_lazy_commit=True
+        self,
+        testing,
+        filepath: Optional[str] = None,
+        enable_lazy_commit=True,
+        read_connections: int = 0,
+        profile: str = DEFAULT_PROFILE,
+        pragmas: Optional[Mapping[str, Union[int, str]]] = None,
+        rollup_keys: Optional[Sequence[Sequence[str]]] = None,
+        indexed_keys: Optional[Mapping[str, Sequence[str]]] = None,
+        search_keys: Optional[Sequence[str]] = None,
     ) -> None:
         self.testing = testing
         self.enable_lazy_commit = enable_lazy_commit
+        self._lock = threading.RLock()
+        self.last_commit = datetime.now()
+        self.num_uncommitted_statements = 0
+        self.bucket_keys: Dict[str, int] = {}
+        self._data_ids: Dict[str, int] = {}
+        self.profile = profile
+        self._pragmas = _resolve_pragmas(profile, pragmas)
+        self.rollup_keys: List[RollupKeys] = []
+        for keys in rollup_keys or []:
+            if isinstance(keys, str) or not keys:
+                raise ValueError(
+                    f"Invalid rollup keys {keys!r}, must be a list of keys"
+                )
+            self.rollup_keys.append(tuple(str(key) for key in keys))
+        self.indexed_keys: List[str] = []
+        for bucket_type, keys in (indexed_keys or {}).items():
+            if isinstance(keys, str) or any('"' in str(key) for key in keys):
+                raise ValueError(
+                    f"Invalid indexed keys {keys!r} for {bucket_type}, must be a list of keys without '\"'"
+                )
+            for key in keys:
+                if str(key) not in self.indexed_keys:
+                    self.indexed_keys.append(str(key))
+        self._indexed: FrozenSet[str] = frozenset()
+        if isinstance(search_keys, str) or any(
+            '"' in str(k) for k in search_keys or []
+        ):
+            raise ValueError(
+                f"Invalid search keys {search_keys!r}, must be a list of keys without '\"'"
+            )
+        self.search_keys: List[str] = [str(key) for key in search_keys or []]
+        self._searchable: FrozenSet[str] = frozenset()
 
         # Ignore the migration check if custom filepath is set
         ignore_migration_check = filepath is not None
@@ -82,20 +691,29 @@ class SqliteStorage(AbstractStorage):
             data_dir = get_data_dir("aw-server")
             filename = ds_name + f".v{LATEST_VERSION}" + ".db"
             filepath = os.path.join(data_dir, filename)
+            if not os.path.exists(filepath):
+                from aw_datastore.migration import sqlite_v1_to_v2  # fmt: skip
+
+                sqlite_v1_to_v2(data_dir, ds_name, filepath)
 
         new_db_file = not os.path.exists(filepath)
-        self.conn = sqlite3.connect(filepath)
+        # The connection is also used by the flush thread, access is serialized with self._lock
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        register_functions(self.conn)
         logger.info(f"Using database file: {filepath}")
 
-        # Create tables
+        # Create tables, the rest of the schema (including indexes) is added by
+        # the upgrades in aw_datastore.migration
         self.conn.execute(CREATE_BUCKETS_TABLE)
         self.conn.execute(CREATE_EVENTS_TABLE)
-        self.conn.execute(INDEX_BUCKETS_TABLE_ID)
-        self.conn.execute(INDEX_EVENTS_TABLE_STARTTIME)
-        self.conn.execute(INDEX_EVENTS_TABLE_ENDTIME)
         self.conn.execute("PRAGMA journal_mode=WAL;")
+        _apply_pragmas(self.conn, self._pragmas)
         self.commit()
 
+        from aw_datastore.migration import upgrade_sqlite_schema  # fmt: skip
+
+        upgrade_sqlite_schema(self.conn)
+
         if new_db_file and not ignore_migration_check:
             logger.info("Created new SQlite db file")
 
@@ -103,9 +721,55 @@ class SqliteStorage(AbstractStorage):
 
             check_for_migration(self)
 
-        self.last_commit = datetime.now()
-        self.num_uncommitted_statements = 0
+        self.update_bucket_keys()
+
+        self._read_pool: Optional[queue.Queue] = None
+        if read_connections > 0:
+            self._read_pool = queue.Queue()
+            uri = Path(filepath).resolve().as_uri() + "?mode=ro"
+            for _ in range(read_connections):
+                conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                register_functions(conn)
+                _apply_pragmas(conn, self._pragmas)
+                self._read_pool.put(conn)
+
+        effective = self.pragmas()
+        logger.info(f"Using SQLite profile '{profile}' with pragmas: {effective}")
+        for name, value in self._pragmas.items():
+            if str(effective[name]).upper() != str(value).upper():
+                # For example if mmap_size is above the compile-time maximum
+                logger.warning(
+                    f"PRAGMA {name} is {effective[name]}, but {value} was requested"
+                )
 
+        self._sync_rollups()
+        self._sync_indexed_keys()
+        self._sync_search_keys()
+
+        self._stop_flush = threading.Event()
+        self._wakeup_flush = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+        if self.enable_lazy_commit:
+            self._flush_thread = threading.Thread(
+                target=_flush_loop,
+                args=(weakref.ref(self), self._stop_flush, self._wakeup_flush),
+                name="aw-sqlite-flush",
+                daemon=True,
+            )
+            self._flush_thread.start()
+        # Lazy commits would be lost if the storage isn't closed before exiting
+        self._finalizer = weakref.finalize(
+            self,
+            _close_storage,
+            self._lock,
+            self._stop_flush,
+            self._wakeup_flush,
+            self._flush_thread,
+            self.conn,
+            self._read_pool,
+        )
+
+    @_synchronized
     def commit(self):
         """
         Useful for debugging and trying to lower the amount of
@@ -115,6 +779,7 @@ class SqliteStorage(AbstractStorage):
         self.last_commit = datetime.now()
         self.num_uncommitted_statements = 0
 
+    @_synchronized
     def conditional_commit(self, num_statements):
         """
         Only commit transactions if:
@@ -122,22 +787,97 @@ class SqliteStorage(AbstractStorage):
          - Was a while ago since last commit
         This is because sqlite is very slow with small inserts, this
         is a way to batch them together and lower CPU+disk usage
+
+        With lazy commits the statements are left in the open transaction,
+        which is committed by the flush thread. Reads are done on the same
+        connection, so they see the pending writes without having to commit.
         """
         if self.enable_lazy_commit:
             self.num_uncommitted_statements += num_statements
-            if self.num_uncommitted_statements > 50:
-                self.commit()
-            if (self.last_commit - datetime.now()) > timedelta(seconds=10):
-                self.commit()
+            if self.num_uncommitted_statements >= MAX_UNCOMMITTED_STATEMENTS:
+                self._wakeup_flush.set()
         else:
             self.commit()
 
+    @_synchronized
+    def _flush_if_due(self) -> None:
+        if self.num_uncommitted_statements == 0:
+            return
+        if (
+            self.num_uncommitted_statements >= MAX_UNCOMMITTED_STATEMENTS
+            or datetime.now() - self.last_commit >= MAX_COMMIT_DELAY
+        ):
+            self.commit()
+
+    def close(self) -> None:
+        """Commits any pending writes and closes the database"""
+        if not self._finalizer.alive:
+            return
+        with self._lock:
+            # Lets SQLite update the statistics used by the query planner, if needed
+            self.conn.execute("PRAGMA optimize")
+        self._finalizer()
+
+    @_synchronized
+    def pragmas(self) -> Dict[str, Union[int, str]]:
+        """Returns the effective values of the tunable PRAGMAs of the writer connection"""
+        effective: Dict[str, Union[int, str]] = {
+            "journal_mode": self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        }
+        for name in TUNABLE_PRAGMAS:
+            value = self.conn.execute(f"PRAGMA {name}").fetchone()[0]
+            if name in _PRAGMA_VALUE_NAMES:
+                value = _PRAGMA_VALUE_NAMES[name][value]
+            effective[name] = value
+        return effective
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        """Yields a connection to read from, from the read pool if there is one"""
+        if self._read_pool is None:
+            with self._lock:
+                yield self.conn
+            return
+        with self._lock:
+            if self.num_uncommitted_statements > 0:
+                self.commit()
+        try:
+            conn = self._read_pool.get(timeout=READ_POOL_TIMEOUT)
+        except queue.Empty:
+            logger.warning("No read connection available, reading on the writer")
+            with self._lock:
+                yield self.conn
+            return
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
+
+    @_synchronized
+    def update_bucket_keys(self) -> None:
+        """Refreshes the cached mapping from bucket id to rowid"""
+        rows = self.conn.execute("SELECT id, rowid FROM buckets")
+        self.bucket_keys = {bucket_id: rowid for bucket_id, rowid in rows}
+
+    @_synchronized
+    def _bucket_row(self, bucket_id: str) -> Optional[int]:
+        """
+        Returns the rowid of the bucket, or None if it doesn't exist.
+
+        The cache is refreshed on a miss, in case the bucket was created
+        by another process.
+        """
+        if bucket_id not in self.bucket_keys:
+            self.update_bucket_keys()
+        return self.bucket_keys.get(bucket_id)
+
     def buckets(self):
         buckets = {}
-        c = self.conn.cursor()
-        for row in c.execute(
-            "SELECT id, name, type, client, hostname, created, datastr FROM buckets"
-        ):
+        with self._reader() as conn:
+            rows = conn.execute(
+                "SELECT id, name, type, client, hostname, created, datastr FROM buckets"
+            ).fetchall()
+        for row in rows:
             buckets[row[0]] = {
                 "id": row[0],
                 "name": row[1],
@@ -149,6 +889,7 @@ class SqliteStorage(AbstractStorage):
             }
         return buckets
 
+    @_synchronized
     def create_bucket(
         self,
         bucket_id: str,
@@ -173,8 +914,10 @@ class SqliteStorage(AbstractStorage):
             ],
         )
         self.commit()
+        self.update_bucket_keys()
         return self.get_metadata(bucket_id)
 
+    @_synchronized
     def update_bucket(
         self,
         bucket_id: str,
@@ -202,25 +945,27 @@ class SqliteStorage(AbstractStorage):
         )
         self.conn.execute(sql, (*values, bucket_id))
         self.commit()
+        self.update_bucket_keys()
         return self.get_metadata(bucket_id)
 
+    @_synchronized
     def delete_bucket(self, bucket_id: str):
-        self.conn.execute(
-            "DELETE FROM events WHERE bucketrow IN (SELECT rowid FROM buckets WHERE id = ?)",
-            [bucket_id],
-        )
+        bucketrow = self._bucket_row(bucket_id)
+        _delete_bucket_events(self.conn, bucketrow)
+        self.conn.execute("DELETE FROM rollups WHERE bucketrow = ?", [bucketrow])
+        self._data_ids.clear()
         cursor = self.conn.execute("DELETE FROM buckets WHERE id = ?", [bucket_id])
         self.commit()
+        self.update_bucket_keys()
         if cursor.rowcount != 1:
             raise ValueError("Bucket did not exist, could not delete")
 
     def get_metadata(self, bucket_id: str):
-        c = self.conn.cursor()
-        res = c.execute(
-            "SELECT id, name, type, client, hostname, created, datastr FROM buckets WHERE id = ?",
-            [bucket_id],
-        )
-        row = res.fetchone()
+        with self._reader() as conn:
+            row = conn.execute(
+                "SELECT id, name, type, client, hostname, created, datastr FROM buckets WHERE id = ?",
+                [bucket_id],
+            ).fetchone()
         if row is not None:
             return {
                 "id": row[0],
@@ -234,20 +979,30 @@ class SqliteStorage(AbstractStorage):
         else:
             raise ValueError("Bucket did not exist, could not get metadata")
 
+    def _data_id(self, data: dict) -> int:
+        """Returns the id of the data in the eventdata table, inserting it if needed"""
+        return _get_data_id(self.conn, self._data_ids, data)
+
+    @_synchronized
     def insert_one(self, bucket_id: str, event: Event) -> Event:
         c = self.conn.cursor()
-        starttime = event.timestamp.timestamp() * 1000000
-        endtime = starttime + (event.duration.total_seconds() * 1000000)
-        datastr = json.dumps(event.data)
+        starttime = _to_us(event.timestamp)
+        endtime = starttime + _duration_us(event.duration)
+        dataid = self._data_id(event.data)
+        bucketrow = self._bucket_row(bucket_id)
         c.execute(
-            "INSERT INTO events(bucketrow, starttime, endtime, datastr) "
-            + "VALUES ((SELECT rowid FROM buckets WHERE id = ?), ?, ?, ?)",
-            [bucket_id, starttime, endtime, datastr],
+            "INSERT INTO events(bucketrow, starttime, endtime, dataid) "
+            + "VALUES (?, ?, ?, ?)",
+            [bucketrow, starttime, endtime, dataid],
         )
         event.id = c.lastrowid
+        self._update_last_event_id(bucketrow, event.id, endtime)
+        self._update_max_duration(bucketrow, endtime - starttime)
+        self._update_rollups(bucketrow, [(starttime, endtime, event.data)])
         self.conditional_commit(1)
         return event
 
+    @_synchronized
     def insert_many(self, bucket_id, events: List[Event]) -> None:
         # FIXME: Is this true not only for peewee but sqlite aswell?
         # Chunking into lists of length 100 is needed here due to SQLITE_MAX_COMPOUND_SELECT
@@ -261,52 +1016,238 @@ class SqliteStorage(AbstractStorage):
 
         # Then insert events without id's set
         events_insert = [e for e in events if e.id is None]
+        bucketrow = self._bucket_row(bucket_id)
         event_rows = []
         for event in events_insert:
-            starttime = event.timestamp.timestamp() * 1000000
-            endtime = starttime + (event.duration.total_seconds() * 1000000)
-            datastr = json.dumps(event.data)
-            event_rows.append((bucket_id, starttime, endtime, datastr))
+            starttime = _to_us(event.timestamp)
+            endtime = starttime + _duration_us(event.duration)
+            dataid = self._data_id(event.data)
+            event_rows.append((bucketrow, starttime, endtime, dataid))
         query = (
-            "INSERT INTO events(bucketrow, starttime, endtime, datastr) "
-            + "VALUES ((SELECT rowid FROM buckets WHERE id = ?), ?, ?, ?)"
+            "INSERT INTO events(bucketrow, starttime, endtime, dataid) "
+            + "VALUES (?, ?, ?, ?)"
         )
         self.conn.executemany(query, event_rows)
+        if event_rows:
+            self._refresh_last_event_id(bucketrow)
+            self._update_max_duration(
+                bucketrow, max(row[2] - row[1] for row in event_rows)
+            )
+            self._update_rollups(
+                bucketrow,
+                [
+                    (row[1], row[2], event.data)
+                    for row, event in zip(event_rows, events_insert)
+                ],
+            )
         self.conditional_commit(len(event_rows))
 
+    def _update_last_event_id(
+        self, bucketrow: Optional[int], event_id: Optional[int], endtime
+    ) -> None:
+        """Points last_event_id at the event if it ends at least as late as the current last event"""
+        self.conn.execute(
+            """UPDATE buckets SET last_event_id = ?
+               WHERE rowid = ? AND (
+                   last_event_id IS NULL
+                   OR ? >= (SELECT endtime FROM events WHERE id = buckets.last_event_id)
+               )""",
+            [event_id, bucketrow, endtime],
+        )
+
+    def _update_max_duration(self, bucketrow: Optional[int], duration) -> None:
+        """Raises max_duration of the bucket if the duration is longer"""
+        # Never lowered when events are shortened or deleted, it only needs to be an upper bound
+        self.conn.execute(
+            "UPDATE buckets SET max_duration = ? WHERE rowid = ? AND max_duration < ?",
+            [duration, bucketrow, duration],
+        )
+
+    def _refresh_last_event_id(
+        self, bucketrow: Optional[int], if_event_id: Optional[int] = None
+    ) -> None:
+        """
+        Looks up the last event of the bucket, using the (bucketrow, endtime) index.
+        If ``if_event_id`` is given, only does so if it is the current last event.
+        """
+        query = """UPDATE buckets SET last_event_id = (
+                       SELECT id FROM events WHERE bucketrow = buckets.rowid
+                       ORDER BY endtime DESC, id DESC LIMIT 1
+                   )
+                   WHERE rowid = ?"""
+        params: list = [bucketrow]
+        if if_event_id is not None:
+            query += " AND last_event_id = ?"
+            params.append(if_event_id)
+        self.conn.execute(query, params)
+
+    def _refresh_last_event_ids(self, event_id: int) -> None:
+        """Looks up the last event again in the buckets whose last event is the event"""
+        query = "SELECT rowid FROM buckets WHERE last_event_id = ?"
+        for (bucketrow,) in self.conn.execute(query, [event_id]).fetchall():
+            self._refresh_last_event_id(bucketrow)
+
+    @_synchronized
+    def _sync_rollups(self) -> None:
+        """Updates the rolled up sets of keys to rollup_keys, and fills the new ones"""
+        added = sync_keysets(self.conn, self.rollup_keys)
+        for keys in added:
+            logger.info(f"Rolling up the events of all buckets by {list(keys)}")
+            for bucketrow in self.bucket_keys.values():
+                diff: RollupDiff = {}
+                for span in self._iter_spans(bucketrow):
+                    add_spans(diff, [keys], [span])
+                    # Bounds memory use on large buckets
+                    if len(diff) >= 100_000:
+                        apply_diff(self.conn, bucketrow, diff)
+                        diff = {}
+                apply_diff(self.conn, bucketrow, diff)
+        self.commit()
+
+    @_synchronized
+    def _sync_indexed_keys(self) -> None:
+        """Adds the generated columns of indexed_keys, and drops those of other keys"""
+        if not HAS_GENERATED_COLUMNS:
+            if self.indexed_keys:
+                logger.warning(
+                    f"SQLite {sqlite3.sqlite_version} doesn't support generated columns, not indexing {self.indexed_keys}"
+                )
+            return
+        self._indexed = sync_indexed_keys(self.conn, self.indexed_keys)
+        self.commit()
+
+    @_synchronized
+    def _sync_search_keys(self) -> None:
+        """Updates the search index to search_keys, filling it if they changed"""
+        if not HAS_FTS5:
+            if self.search_keys:
+                logger.warning(
+                    f"SQLite {sqlite3.sqlite_version} doesn't support FTS5, not indexing {self.search_keys} for search"
+                )
+            return
+        self._searchable = sync_search_keys(self.conn, self.search_keys)
+        self.supports_search = bool(self._searchable)
+        self.commit()
+
+    def _iter_spans(self, bucketrow: int) -> Iterator[Span]:
+        return _iter_bucket_spans(self.conn, bucketrow)
+
+    def _update_rollups(
+        self,
+        bucketrow: Optional[int],
+        added: Iterable[Span] = (),
+        removed: Iterable[Span] = (),
+    ) -> None:
+        if not self.rollup_keys or bucketrow is None:
+            return
+        diff: RollupDiff = {}
+        add_spans(diff, self.rollup_keys, removed, sign=-1)
+        add_spans(diff, self.rollup_keys, added)
+        apply_diff(self.conn, bucketrow, diff)
+
+    def _update_event_rollups(
+        self, old: Optional[Tuple[int, Span]], bucketrow: Optional[int], new: Span
+    ) -> None:
+        """Moves the rollups of the event from its old span (as read by _get_event_span)"""
+        if old is not None and old[0] != bucketrow:
+            self._update_rollups(old[0], removed=[old[1]])
+            old = None
+        self._update_rollups(bucketrow, [new], [old[1]] if old else [])
+
+    @_synchronized
     def replace_last(self, bucket_id, event):
-        starttime = event.timestamp.timestamp() * 1000000
-        endtime = starttime + (event.duration.total_seconds() * 1000000)
-        datastr = json.dumps(event.data)
-        query = """UPDATE events
-                   SET starttime = ?, endtime = ?, datastr = ?
-                   WHERE id = (
-                        SELECT id FROM events WHERE endtime =
-                            (SELECT max(endtime) FROM events WHERE bucketrow =
-                                (SELECT rowid FROM buckets WHERE id = ?) LIMIT 1))"""
-        self.conn.execute(query, [starttime, endtime, datastr, bucket_id])
+        starttime = _to_us(event.timestamp)
+        endtime = starttime + _duration_us(event.duration)
+        dataid = self._data_id(event.data)
+        bucketrow = self._bucket_row(bucket_id)
+        row = self.conn.execute(
+            """SELECT e.id, e.dataid FROM buckets b JOIN events e ON e.id = b.last_event_id
+               WHERE b.rowid = ? AND e.bucketrow = b.rowid""",
+            [bucketrow],
+        ).fetchone()
+        last_event_id, old_dataid = row if row else (None, None)
+        old = _get_event_span(self.conn, last_event_id) if self.rollup_keys else None
+        query = """UPDATE events SET starttime = ?, endtime = ?, dataid = ?
+                   WHERE id = ? AND bucketrow = ?"""
+        params = [starttime, endtime, dataid, last_event_id, bucketrow]
+        c = self.conn.execute(query, params)
+        self._update_max_duration(bucketrow, endtime - starttime)
+        if c.rowcount == 1:
+            self._update_event_rollups(old, bucketrow, (starttime, endtime, event.data))
+            # If the event now ends before another one, that one is the last event.
+            # Only an index seek when it still ends last (as when extended by heartbeats).
+            self.conn.execute(
+                """UPDATE buckets SET last_event_id = (
+                       SELECT id FROM events WHERE bucketrow = buckets.rowid
+                       ORDER BY endtime DESC, id DESC LIMIT 1
+                   )
+                   WHERE rowid = ? AND EXISTS (
+                       SELECT 1 FROM events WHERE bucketrow = ? AND endtime > ?
+                   )""",
+                [bucketrow, bucketrow, endtime],
+            )
+            if old_dataid != dataid:
+                _delete_unused_data(self.conn, self._data_ids, old_dataid)
         self.conditional_commit(1)
         return True
 
+    @_synchronized
+    def update_last(self, bucket_id, event_id, event):
+        starttime = _to_us(event.timestamp)
+        endtime = starttime + _duration_us(event.duration)
+        dataid = self._data_id(event.data)
+        bucketrow = self._bucket_row(bucket_id)
+        old = _get_event_span(self.conn, event_id) if self.rollup_keys else None
+        # last_event_id already points at the event, and it still ends last.
+        # Its data is the same (heartbeats are only merged into events with the same
+        # data), so no data becomes unused.
+        query = """UPDATE events SET starttime = ?, endtime = ?, dataid = ?
+                   WHERE id = ? AND bucketrow = ?"""
+        c = self.conn.execute(query, [starttime, endtime, dataid, event_id, bucketrow])
+        self._update_max_duration(bucketrow, endtime - starttime)
+        if c.rowcount == 1:
+            self._update_event_rollups(old, bucketrow, (starttime, endtime, event.data))
+        self.conditional_commit(1)
+
+    @_synchronized
     def delete(self, bucket_id, event_id):
-        query = (
-            "DELETE FROM events "
-            + "WHERE id = ? AND bucketrow = (SELECT b.rowid FROM buckets b WHERE b.id = ?)"
-        )
-        cursor = self.conn.execute(query, [event_id, bucket_id])
-        return cursor.rowcount == 1
+        bucketrow = self._bucket_row(bucket_id)
+        old = _get_event_span(self.conn, event_id) if self.rollup_keys else None
+        old_dataid = _get_event_data_id(self.conn, event_id, bucketrow)
+        query = "DELETE FROM events WHERE id = ? AND bucketrow = ?"
+        cursor = self.conn.execute(query, [event_id, bucketrow])
+        deleted = cursor.rowcount == 1
+        if deleted:
+            _delete_unused_data(self.conn, self._data_ids, old_dataid)
+            self._refresh_last_event_id(bucketrow, if_event_id=event_id)
+            if old is not None:
+                self._update_rollups(bucketrow, removed=[old[1]])
+        self.conditional_commit(1)
+        return deleted
 
+    @_synchronized
     def replace(self, bucket_id, event_id, event) -> bool:
-        starttime = event.timestamp.timestamp() * 1000000
-        endtime = starttime + (event.duration.total_seconds() * 1000000)
-        datastr = json.dumps(event.data)
+        starttime = _to_us(event.timestamp)
+        endtime = starttime + _duration_us(event.duration)
+        dataid = self._data_id(event.data)
+        bucketrow = self._bucket_row(bucket_id)
         query = """UPDATE events
-                     SET bucketrow = (SELECT rowid FROM buckets WHERE id = ?),
+                     SET bucketrow = ?,
                          starttime = ?,
                          endtime = ?,
-                         datastr = ?
+                         dataid = ?
                      WHERE id = ?"""
-        self.conn.execute(query, [bucket_id, starttime, endtime, datastr, event_id])
+        old = _get_event_span(self.conn, event_id) if self.rollup_keys else None
+        old_dataid = _get_event_data_id(self.conn, event_id)
+        c = self.conn.execute(query, [bucketrow, starttime, endtime, dataid, event_id])
+        if c.rowcount == 1:
+            self._update_event_rollups(old, bucketrow, (starttime, endtime, event.data))
+            if old_dataid != dataid:
+                _delete_unused_data(self.conn, self._data_ids, old_dataid)
+        # The event might have been moved earlier than another one, or to another bucket
+        self._refresh_last_event_ids(event_id)
+        self._update_last_event_id(bucketrow, event_id, endtime)
+        self._update_max_duration(bucketrow, endtime - starttime)
         self.conditional_commit(1)
         return True
 
@@ -315,16 +1256,18 @@ class SqliteStorage(AbstractStorage):
         bucket_id: str,
         event_id: int,
     ) -> Optional[Event]:
-        self.commit()
-        c = self.conn.cursor()
         query = """
-            SELECT id, starttime, endtime, datastr
+            SELECT id, starttime, endtime, dataid
             FROM events
-            WHERE bucketrow = (SELECT rowid FROM buckets WHERE id = ?) AND id = ?
+            WHERE bucketrow = ? AND id = ?
             LIMIT 1
         """
-        rows = c.execute(query, [bucket_id, event_id])
-        events = _rows_to_events(rows)
+        bucketrow = self._bucket_row(bucket_id)
+        datastrs: Dict[int, str] = {}
+        with self._reader() as conn:
+            rows = conn.execute(query, [bucketrow, event_id]).fetchall()
+            _fetch_datastrs(conn, (row[3] for row in rows), datastrs)
+        events = _rows_to_events(rows, datastrs)
         if events:
             return events[0]
         else:
@@ -341,20 +1284,118 @@ class SqliteStorage(AbstractStorage):
             return []
         elif limit < 0:
             limit = -1
-        self.commit()
-        c = self.conn.cursor()
-        starttime_i = starttime.timestamp() * 1000000 if starttime else 0
-        endtime_i = endtime.timestamp() * 1000000 if endtime else MAX_TIMESTAMP
-        query = """
-            SELECT id, starttime, endtime, datastr
+        bucketrow = self._bucket_row(bucket_id)
+        datastrs: Dict[int, str] = {}
+        with self._reader() as conn:
+            cursor = self._select_events(conn, bucketrow, limit, starttime, endtime)
+            rows = cursor.fetchall()
+            _fetch_datastrs(conn, (row[3] for row in rows), datastrs)
+        return _rows_to_events(rows, datastrs)
+
+    def iter_events(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+    ) -> Iterator[Event]:
+        return self._iter_events(bucket_id, starttime, endtime, chunksize)
+
+    def iter_events_filtered(
+        self,
+        bucket_id: str,
+        filters: Sequence[DataFilter],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        chunksize: int = 1000,
+    ) -> Optional[Iterator[Event]]:
+        if filters_sql(filters) is None:
+            return None
+        events = self._iter_events(bucket_id, starttime, endtime, chunksize, filters)
+        return (e for e in events if all(f.match(e.data) for f in filters))
+
+    def search_events(
+        self,
+        bucket_id: str,
+        search: SearchFilter,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        filters: Sequence[DataFilter] = (),
+        chunksize: int = 1000,
+    ) -> Optional[Iterator[Event]]:
+        if not search.terms or not set(search.keys) <= self._searchable:
+            return None
+        if filters_sql(filters) is None:
+            return None
+        events = self._iter_events(
+            bucket_id, starttime, endtime, chunksize, filters, search
+        )
+        return (
+            e
+            for e in events
+            if search.match(e.data) and all(f.match(e.data) for f in filters)
+        )
+
+    def _iter_events(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+        chunksize: int,
+        filters: Sequence[DataFilter] = (),
+        search: Optional[SearchFilter] = None,
+    ) -> Iterator[Event]:
+        bucketrow = self._bucket_row(bucket_id)
+        where_data = _filters_where(filters, search, self._indexed, self._searchable)
+        # Kept between chunks, so that each distinct data is only fetched and decoded once
+        datastrs: Dict[int, str] = {}
+        decoded: Dict[int, Optional[dict]] = {}
+        # Each chunk is a query of its own, continuing after the last event of the
+        # previous one. No connection or cursor is held while the events are consumed,
+        # so iterators that are abandoned don't keep a read connection (or a statement
+        # open on the writer).
+        after: Optional[Tuple[int, int, int]] = None
+        while True:
+            with self._reader() as conn:
+                where, params = _where_range(bucketrow, starttime, endtime)
+                rows = _select_chunk(
+                    conn,
+                    where,
+                    params,
+                    chunksize,
+                    starttime,
+                    endtime,
+                    where_data,
+                    after,
+                )
+                _fetch_datastrs(conn, (row[3] for row in rows), datastrs)
+            yield from _rows_to_events((row[:4] for row in rows), datastrs, decoded)
+            if len(rows) < chunksize:
+                break
+            after = rows[-1][4:]
+
+    @staticmethod
+    def _select_events(
+        conn: sqlite3.Connection,
+        bucketrow: Optional[int],
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        where_data: Optional[FilterSQL] = None,
+    ) -> sqlite3.Cursor:
+        # Events are trimmed to the range in the query, as done in aw-server-rust
+        starttime_i, endtime_i = _range_us(starttime, endtime)
+        where, params = _where_range(bucketrow, starttime, endtime)
+        if where_data is not None:
+            where += _where_data(where_data)
+            params += where_data.params
+        query = f"""
+            SELECT id, max(starttime, ?), min(endtime, ?), dataid
             FROM events
-            WHERE bucketrow = (SELECT rowid FROM buckets WHERE id = ?)
-            AND endtime >= ? AND starttime <= ?
+            WHERE {where}
             ORDER BY endtime DESC LIMIT ?
         """
-        rows = c.execute(query, [bucket_id, starttime_i, endtime_i, limit])
-        events = _rows_to_events(rows)
-        return events
+        return conn.execute(query, [starttime_i, endtime_i, *params, limit])
 
     def get_eventcount(
         self,
@@ -362,17 +1403,104 @@ class SqliteStorage(AbstractStorage):
         starttime: Optional[datetime] = None,
         endtime: Optional[datetime] = None,
     ):
-        self.commit()
-        c = self.conn.cursor()
-        starttime_i = starttime.timestamp() * 1000000 if starttime else 0
-        endtime_i = endtime.timestamp() * 1000000 if endtime else MAX_TIMESTAMP
-        query = (
-            "SELECT count(*) "
-            + "FROM events "
-            + "WHERE bucketrow = (SELECT rowid FROM buckets WHERE id = ?) "
-            + "AND endtime >= ? AND starttime <= ?"
-        )
-        rows = c.execute(query, [bucket_id, starttime_i, endtime_i])
-        row = rows.fetchone()
+        bucketrow = self._bucket_row(bucket_id)
+        where, params = _where_range(bucketrow, starttime, endtime)
+        query = f"SELECT count(*) FROM events WHERE {where}"
+        with self._reader() as conn:
+            row = conn.execute(query, params).fetchone()
         eventcount = row[0]
         return eventcount
+
+    def get_aggregate(
+        self,
+        bucket_id: str,
+        keys: Sequence[str],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        filters: Sequence[DataFilter] = (),
+    ) -> Optional[List[Event]]:
+        if not HAS_JSON_OPERATORS or any('"' in key for key in keys):
+            return None
+        # Regexes can't be checked exactly in SQL (see filters.py)
+        if any(f.regex is not None for f in filters):
+            return None
+        if filters_sql(filters) is None:
+            return None
+        bucketrow = self._bucket_row(bucket_id)
+        rows = self._select_groups(bucketrow, keys, starttime, endtime, filters)
+        return _merge_groups(rows, keys, starttime)
+
+    def _select_groups(
+        self,
+        bucketrow: Optional[int],
+        keys: Sequence[str],
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+        filters: Sequence[DataFilter],
+    ) -> List[tuple]:
+        where, params = _where_range(bucketrow, starttime, endtime)
+        where_data = _filters_where(filters, None, self._indexed, self._searchable)
+        with self._reader() as conn:
+            return _select_groups(
+                conn, keys, where, params, starttime, endtime, where_data
+            )
+
+    def get_rollup(
+        self,
+        bucket_id: str,
+        keys: Sequence[str],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> Optional[List[Event]]:
+        if tuple(keys) not in self.rollup_keys:
+            return None
+        bucketrow = self._bucket_row(bucket_id)
+        starttime_i, endtime_i = _range_us(starttime, endtime)
+        # Whole hours are read from the rollups, the partial hours at the ends of
+        # the range from the events
+        first_hour = -(-starttime_i // HOUR_US) if starttime else None
+        end_hour = endtime_i // HOUR_US if endtime else None
+        edges: List[Tuple[Optional[datetime], Optional[datetime]]] = []
+        if first_hour is not None and end_hour is not None and first_hour >= end_hour:
+            edges.append((starttime, endtime))
+            groups: Dict[str, List[int]] = {}
+        else:
+            with self._reader() as conn:
+                groups = query_rollup(conn, bucketrow, keys, first_hour, end_hour)
+            if first_hour is not None:
+                edges.append((starttime, EPOCH + first_hour * HOUR_US * TD1US))
+            if end_hour is not None:
+                edges.append((EPOCH + end_hour * HOUR_US * TD1US, endtime))
+        for edge_start, edge_end in edges:
+            for e in self.get_events(bucket_id, -1, edge_start, edge_end):
+                hour = _to_us(e.timestamp) // HOUR_US
+                datastr = group_datastr(e.data, keys)
+                group = groups.setdefault(datastr, [0, hour, hour])
+                group[0] += _duration_us(e.duration)
+                group[1] = min(group[1], hour)
+                group[2] = max(group[2], hour)
+
+        # Groups are by the JSON of the values, merged like merge_events_by_keys does
+        # (which keeps the data of the latest event)
+        merged: Dict[tuple, Tuple[int, int, int, dict]] = {}
+        for datastr, (duration, first, last) in groups.items():
+            data = json.loads(datastr)
+            composite_key = _composite_key(data)
+            other = merged.get(composite_key)
+            if other is not None:
+                if other[2] > last:
+                    data = other[3]
+                duration += other[0]
+                first = min(first, other[1])
+                last = max(last, other[2])
+            merged[composite_key] = (duration, first, last, data)
+        events = [
+            Event(
+                timestamp=max(EPOCH + first * HOUR_US * TD1US, starttime or EPOCH),
+                duration=duration * TD1US,
+                data=data,
+            )
+            for duration, first, _, data in merged.values()
+        ]
+        events.sort(key=lambda e: e.duration, reverse=True)
+        return events
@@ -1,3 +1,4 @@
+from .cache import QueryCache
 from .query2 import query
 
-__all__ = ["query"]
+__all__ = ["query", "QueryCache"]
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the canonical query2 queries used by aw-webui against synthetic data.
+
+Generates window, AFK and web buckets with a realistic distribution of heartbeats
+and times each stage of the query separately: parsing, bucket fetching, each
+transform and the serialization of the result.
+
+Usage:
+
+    python -m aw_query.benchmark [--days 30] [--storage SqliteStorage]
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from time import perf_counter
+from typing import Any, Dict, Iterator, List
+
+from aw_core.models import Event
+from aw_datastore import Datastore, get_storage_methods
+
+from . import query2
+from .functions import functions
+from .stream import CHUNKSIZE, EventStream
+
+HOSTNAME = "benchmark-host"
+
+BUCKET_WINDOW = f"aw-watcher-window_{HOSTNAME}"
+BUCKET_AFK = f"aw-watcher-afk_{HOSTNAME}"
+BUCKET_WEB = f"aw-watcher-web-chrome_{HOSTNAME}"
+
+BROWSER_APPS = ["Google-chrome", "chrome.exe", "Google Chrome"]
+
+# (app, titles) pairs with weights roughly matching a developer's workday
+WINDOW_APPS = [
+    ("Google-chrome", ["{site} - Google Chrome"], 30),
+    ("Code", ["● {file} - aw-core - Visual Studio Code", "{file} - aw-core"], 25),
+    ("Alacritty", ["~/Programming/aw-core", "vim {file}", "htop"], 15),
+    ("Slack", ["Slack | general", "Slack | random", "Slack | {person}"], 10),
+    ("Spotify", ["Spotify Premium", "{person} - Song"], 5),
+    ("zoom", ["Zoom Meeting", "Zoom"], 5),
+    ("Thunderbird", ["Inbox - Mozilla Thunderbird", "(3) Inbox"], 5),
+    ("Nautilus", ["Downloads", "Documents"], 5),
+]
+
+SITES = [
+    ("github.com", "https://github.com/ActivityWatch/aw-core/pull/{n}"),
+    ("stackoverflow.com", "https://stackoverflow.com/questions/{n}"),
+    ("docs.python.org", "https://docs.python.org/3/library/{file}.html"),
+    ("youtube.com", "https://www.youtube.com/watch?v={n}"),
+    ("reddit.com", "https://www.reddit.com/r/programming/comments/{n}"),
+    ("news.ycombinator.com", "https://news.ycombinator.com/item?id={n}"),
+]
+
+FILES = ["query2.py", "datastore.py", "sqlite.py", "models.py", "flood.py"]
+PEOPLE = ["Erik", "Johan", "Alice", "Bob"]
+
+CATEGORIES = [
+    [["Work"], {"type": "regex", "regex": "Visual Studio Code|aw-core|vim"}],
+    [["Work", "Programming"], {"type": "regex", "regex": "Code|Alacritty|github"}],
+    [["Work", "Programming", "ActivityWatch"], {"type": "regex", "regex": "aw-"}],
+    [["Work", "Meetings"], {"type": "regex", "regex": "Zoom|Meet"}],
+    [["Comms", "IM"], {"type": "regex", "regex": "Slack|Discord|Signal"}],
+    [["Comms", "Email"], {"type": "regex", "regex": "Thunderbird|Gmail|Inbox"}],
+    [["Media", "Music"], {"type": "regex", "regex": "Spotify|Song"}],
+    [["Media", "Video"], {"type": "regex", "regex": "YouTube|youtube|Netflix"}],
+    [["Media", "Social"], {"type": "regex", "regex": "reddit|Hacker News"}],
+    [
+        ["Reference"],
+        {"type": "regex", "regex": "stackoverflow|docs\\.python", "ignore_case": True},
+    ],
+]
+
+QUERY_WINDOW = f"""
+events = flood(query_bucket(find_bucket("aw-watcher-window_", "{HOSTNAME}")));
+not_afk = flood(query_bucket(find_bucket("aw-watcher-afk_", "{HOSTNAME}")));
+not_afk = filter_keyvals(not_afk, "status", ["not-afk"]);
+events = filter_period_intersect(events, not_afk);
+events = categorize(events, {json.dumps(CATEGORIES)});
+title_events = sort_by_duration(merge_events_by_keys(events, ["app", "title"]));
+app_events = sort_by_duration(merge_events_by_keys(title_events, ["app"]));
+cat_events = sort_by_duration(merge_events_by_keys(events, ["$category"]));
+app_events = limit_events(app_events, 100);
+title_events = limit_events(title_events, 100);
+duration = sum_durations(events);
+RETURN = {{"app_events": app_events, "title_events": title_events, "cat_events": cat_events, "duration": duration}};
+"""
+
+QUERY_BROWSER = f"""
+events = flood(query_bucket(find_bucket("aw-watcher-window_", "{HOSTNAME}")));
+not_afk = flood(query_bucket(find_bucket("aw-watcher-afk_", "{HOSTNAME}")));
+not_afk = filter_keyvals(not_afk, "status", ["not-afk"]);
+events = filter_period_intersect(events, not_afk);
+window_browser = filter_keyvals(events, "app", {json.dumps(BROWSER_APPS)});
+browser_events = flood(query_bucket(find_bucket("aw-watcher-web-chrome_", "{HOSTNAME}")));
+browser_events = filter_period_intersect(browser_events, window_browser);
+browser_events = split_url_events(browser_events);
+domains = sort_by_duration(merge_events_by_keys(browser_events, ["$domain"]));
+urls = sort_by_duration(merge_events_by_keys(browser_events, ["url"]));
+RETURN = {{"domains": limit_events(domains, 100), "urls": limit_events(urls, 100), "duration": sum_durations(browser_events)}};
+"""
+
+QUERIES = {"window": QUERY_WINDOW, "browser": QUERY_BROWSER}
+
+
+def _fill(template: str, rng: random.Random) -> str:
+    return template.format(
+        site=rng.choice(SITES)[0],
+        file=rng.choice(FILES),
+        person=rng.choice(PEOPLE),
+        n=rng.randint(1, 500),
+    )
+
+
+def generate_events(
+    start: datetime, days: int, seed: int = 0
+) -> Dict[str, List[Event]]:
+    """
+    Generates synthetic events as they would look after heartbeat merging.
+
+    Every day has 8 hours of activity, which alternates between not-afk periods
+    (mean 25min) and afk periods (mean 5min). During not-afk periods the user
+    switches between windows with exponentially distributed durations (mean 40s),
+    the browser also reports the active tab.
+    """
+    rng = random.Random(seed)
+    apps, titles, weights = zip(*WINDOW_APPS)
+    window: List[Event] = []
+    afk: List[Event] = []
+    web: List[Event] = []
+
+    for day in range(days):
+        t = start + timedelta(days=day, hours=9)
+        day_end = t + timedelta(hours=8)
+        while t < day_end:
+            active = timedelta(seconds=rng.expovariate(1 / (25 * 60)))
+            afk.append(Event(timestamp=t, duration=active, data={"status": "not-afk"}))
+            active_end = t + active
+            while t < active_end:
+                duration = timedelta(seconds=max(1, rng.expovariate(1 / 40)))
+                i = rng.choices(range(len(apps)), weights=weights)[0]
+                title = _fill(rng.choice(titles[i]), rng)
+                window.append(
+                    Event(
+                        timestamp=t,
+                        duration=duration,
+                        data={"app": apps[i], "title": title},
+                    )
+                )
+                if apps[i] in BROWSER_APPS:
+                    _, url = rng.choice(SITES)
+                    web.append(
+                        Event(
+                            timestamp=t,
+                            duration=duration,
+                            data={
+                                "url": _fill(url, rng),
+                                "title": title,
+                                "audible": False,
+                                "incognito": False,
+                            },
+                        )
+                    )
+                t += duration
+            away = timedelta(seconds=rng.expovariate(1 / (5 * 60)))
+            afk.append(Event(timestamp=t, duration=away, data={"status": "afk"}))
+            t += away
+
+    return {BUCKET_WINDOW: window, BUCKET_AFK: afk, BUCKET_WEB: web}
+
+
+def populate(ds: Datastore, start: datetime, days: int, seed: int = 0) -> None:
+    bucket_types = {
+        BUCKET_WINDOW: ("currentwindow", "aw-watcher-window"),
+        BUCKET_AFK: ("afkstatus", "aw-watcher-afk"),
+        BUCKET_WEB: ("web.tab.current", "aw-client-web"),
+    }
+    for bucket_id, events in generate_events(start, days, seed).items():
+        type_id, client = bucket_types[bucket_id]
+        bucket = ds.create_bucket(bucket_id, type_id, client, HOSTNAME)
+        bucket.insert(events)
+
+
+@contextmanager
+def _instrument_functions(stats: Dict[str, Dict[str, float]]) -> Iterator[None]:
+    """
+    Temporarily wraps every query2 function to record the time spent in it.
+
+    Functions like query_bucket return event streams, which are only read once a
+    later function uses them. The time spent reading a stream from its source is
+    charged to the function that returned it, and not to the one reading it.
+    """
+    originals = dict(functions)
+    # Time spent in nested timed calls, for each timed call running
+    nested: List[float] = []
+
+    def run(name, f, *args, **kwargs):
+        nested.append(0.0)
+        start = perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            stats[name]["total_s"] += elapsed - nested.pop()
+            if nested:
+                nested[-1] += elapsed
+
+    def timed_stream(
+        name: str, stream: EventStream, inputs: List[EventStream]
+    ) -> EventStream:
+        if stream._events is not None:
+            return stream
+        # Streams returned by transforms share the source and transforms of their input
+        sources = {id(i._source) for i in inputs}
+        transforms = {id(t) for i in inputs for t in i._transforms}
+        source, aggregate = stream._source, stream._aggregate
+        if id(source) in sources:
+            timed_source = source
+        else:
+
+            def timed_source(filters):
+                events = iter(run(name, source, filters))
+                while True:
+                    # Timed per chunk, timing each event would add too much overhead
+                    chunk = run(name, lambda: list(islice(events, CHUNKSIZE)))
+                    if not chunk:
+                        return
+                    yield from chunk
+
+            if aggregate is not None:
+                base_aggregate = aggregate
+
+                def aggregate(keys, filters):
+                    return run(name, base_aggregate, keys, filters)
+
+        def timed_transform(transform):
+            if id(transform) in transforms:
+                return transform
+            return lambda chunk: run(name, transform, chunk)
+
+        return EventStream(
+            timed_source,
+            tuple(timed_transform(t) for t in stream._transforms),
+            stream._filters,
+            aggregate,
+        )
+
+    def timed(name, f):
+        def g(*args, **kwargs):
+            stats[name]["calls"] += 1
+            result = run(name, f, *args, **kwargs)
+            if isinstance(result, EventStream):
+                inputs = [a for a in args if isinstance(a, EventStream)]
+                result = timed_stream(name, result, inputs)
+            return result
+
+        return g
+
+    for name, f in originals.items():
+        functions[name] = timed(name, f)
+    try:
+        yield
+    finally:
+        functions.update(originals)
+
+
+def _to_json(value: Any) -> Any:
+    # Mirrors how aw-server serializes query results
+    if isinstance(value, Event):
+        return value.to_json_dict()
+    elif isinstance(value, list):
+        return [_to_json(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    elif isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def benchmark_query(
+    ds: Datastore, query: str, starttime: datetime, endtime: datetime
+) -> dict:
+    """Runs a query once and returns the time spent in each stage"""
+    stats: Dict[str, Dict[str, float]] = defaultdict(
+        lambda: {"calls": 0, "total_s": 0.0}
+    )
+    namespace = query2.create_namespace()
+    namespace["NAME"] = "benchmark"
+    namespace["STARTTIME"] = starttime.isoformat()
+    namespace["ENDTIME"] = endtime.isoformat()
+
+    # Compile without the cache of compiled queries, to measure the parser
+    start = perf_counter()
+    program = query2._compile(query)
+    parse_s = perf_counter() - start
+
+    start = perf_counter()
+    with _instrument_functions(stats):
+        result = program.interpret(ds, namespace)
+    execute_s = perf_counter() - start
+
+    start = perf_counter()
+    json.dumps(_to_json(result))
+    serialize_s = perf_counter() - start
+
+    return {
+        "parse_s": parse_s,
+        "execute_s": execute_s,
+        "serialize_s": serialize_s,
+        "functions": dict(stats),
+    }
+
+
+def benchmark(
+    storage_name: str = "SqliteStorage", days: int = 30, runs: int = 3, seed: int = 0
+) -> dict:
+    storage = {s.__name__: s for s in get_storage_methods().values()}[storage_name]
+    endtime = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    starttime = endtime - timedelta(days=days)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if storage_name in ["PeeweeStorage", "SqliteStorage"]:
+            filepath = os.path.join(tmpdir, "benchmark.db")
+            ds = Datastore(storage, testing=True, filepath=filepath)
+        elif storage_name == "PartitionedSqliteStorage":
+            # Takes a directory, with a database file per month of events
+            filepath = os.path.join(tmpdir, "benchmark")
+            ds = Datastore(storage, testing=True, filepath=filepath)
+        else:
+            ds = Datastore(storage, testing=True)
+
+        start = perf_counter()
+        populate(ds, starttime, days, seed)
+        populate_s = perf_counter() - start
+
+        results = {}
+        for name, query in QUERIES.items():
+            results[name] = [
+                benchmark_query(ds, query, starttime, endtime) for _ in range(runs)
+            ]
+
+        eventcounts = {
+            bucket_id: ds[bucket_id].get_eventcount() for bucket_id in ds.buckets()
+        }
+        ds.close()
+
+    return {
+        "storage": storage_name,
+        "days": days,
+        "eventcounts": eventcounts,
+        "populate_s": populate_s,
+        "queries": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the canonical query2 queries on synthetic data"
+    )
+    parser.add_argument(
+        "--storage",
+        default="SqliteStorage",
+        choices=[s.__name__ for s in get_storage_methods().values()],
+    )
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to a file")
+    args = parser.parse_args()
+
+    report = benchmark(args.storage, args.days, args.runs, args.seed)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import copy
+import logging
+import sys
+import threading
+from datetime import date, datetime, timedelta
+from typing import Any, Optional, OrderedDict, Set, Tuple
+
+from aw_datastore import Datastore
+
+from .query2 import query as _query
+
+logger = logging.getLogger(__name__)
+
+# Default max total size of the cached results, in bytes
+DEFAULT_MAX_SIZE = 64 * 2**20
+
+ROUNDING = timedelta(milliseconds=1)
+
+
+def _sizeof(obj: Any) -> int:
+    """Approximate memory used by a query result, in bytes"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_sizeof(v) for v in obj)
+    elif not isinstance(obj, (str, int, float, bool, datetime, date, timedelta)):
+        size += sum(_sizeof(v) for v in getattr(obj, "__dict__", {}).values())
+    return size
+
+
+class _Entry:
+    __slots__ = ("datastore", "result", "version", "buckets", "size")
+
+    def __init__(
+        self,
+        datastore: Datastore,
+        result: Any,
+        version: int,
+        buckets: Set[Optional[str]],
+        size: int,
+    ) -> None:
+        self.datastore = datastore
+        self.result = result
+        self.version = version
+        self.buckets = buckets
+        self.size = size
+
+
+class QueryCache:
+    """
+        Caches the results of ``aw_query.query``, by the query, its name (which queries
+    can read as NAME) and its time range.
+
+        While running a query, the datastore keeps track of the buckets it reads from.
+        A cached result is used as long as none of these buckets were modified in the
+        queried range since it was computed (see ``Datastore.modified_since``). Since
+        new events are only ever inserted at the current time, results for ranges
+        entirely in the past stay valid until older events are modified.
+
+        Least recently used results are evicted once the results take more than
+        ``max_size`` bytes. Results are copied in and out of the cache, so they can
+        be modified by the caller.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple[str, str, str, str], _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def query(
+        self,
+        name: str,
+        query: str,
+        starttime: datetime,
+        endtime: datetime,
+        datastore: Datastore,
+    ) -> Any:
+        """Same as ``aw_query.query``, but returns cached results when possible"""
+        key = (name, query, starttime.isoformat(), endtime.isoformat())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_valid(
+                entry, datastore, starttime, endtime
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry.result)
+            self.misses += 1
+
+        # Modifications made while the query runs invalidate the result
+        version = datastore.version
+        with datastore.track_access() as accessed:
+            result = _query(name, query, starttime, endtime, datastore)
+        stored = copy.deepcopy(result)
+        entry = _Entry(datastore, stored, version, set(accessed), _sizeof(stored))
+
+        with self._lock:
+            self._remove(key)
+            if entry.size <= self.max_size:
+                self._entries[key] = entry
+                self.size += entry.size
+                while self.size > self.max_size:
+                    self._remove(next(iter(self._entries)))
+            else:
+                logger.debug(f"Not caching result of {entry.size} bytes")
+        return result
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _is_valid(
+        self,
+        entry: _Entry,
+        datastore: Datastore,
+        starttime: datetime,
+        endtime: datetime,
+    ) -> bool:
+        if entry.datastore is not datastore:
+            return False
+        # Buckets read events in a range rounded to milliseconds
+        starttime -= ROUNDING
+        endtime += ROUNDING
+        return not any(
+            datastore.modified_since(bucket_id, entry.version, starttime, endtime)
+            for bucket_id in entry.buckets
+        )
+
+    def _remove(self, key: Tuple[str, str, str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
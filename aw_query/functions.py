@@ -12,6 +12,7 @@ from typing import (
 import iso8601
 from aw_core.models import Event
 from aw_datastore import Datastore
+from aw_datastore.storages import DataFilter, SearchFilter
 from aw_transform import (
     Rule,
     categorize,
@@ -34,6 +35,7 @@ from aw_transform import (
 )
 
 from .exceptions import QueryFunctionException
+from .stream import EventStream, Transform
 
 
 def _verify_bucket_exists(datastore, bucketname):
@@ -44,6 +46,11 @@ def _verify_bucket_exists(datastore, bucketname):
 
 
 def _verify_variable_is_type(variable, t):
+    if t is EventList:
+        # Streams are accepted by the functions that don't materialize them
+        if isinstance(variable, EventStream):
+            return
+        t = list
     if not isinstance(variable, t):
         raise QueryFunctionException(
             f"Variable '{variable}' passed to function call is of invalid type. Expected {t} but was {type(variable)}"
@@ -54,6 +61,8 @@ def _verify_variable_is_type(variable, t):
 
 
 TNamespace = Dict[str, Any]
+# Parameters with events, which can also be passed as an event stream
+EventList = List[Event]
 TQueryFunction = Callable[..., Any]
 
 
@@ -63,12 +72,15 @@ TQueryFunction = Callable[..., Any]
 functions: Dict[str, TQueryFunction] = {}
 
 
-def q2_function(transform_func=None):
+def q2_function(transform_func=None, streaming=False):
     """
     Decorator used to register query functions.
 
     Automatically adds mock arguments for Datastore and TNamespace
     if not in function signature.
+
+    Event streams passed to the function are materialized into lists,
+    unless it's ``streaming`` (see ``_pipe``).
     """
 
     def h(f):
@@ -79,6 +91,10 @@ def q2_function(transform_func=None):
 
         @wraps(f)
         def g(datastore: Datastore, namespace: TNamespace, *args, **kwargs):
+            if not streaming:
+                args = tuple(
+                    a.materialize() if isinstance(a, EventStream) else a for a in args
+                )
             # Remove datastore and namespace argument for functions that don't need it
             args = (datastore, namespace, *args)
             if TNamespace not in (sig.parameters[p].annotation for p in sig.parameters):
@@ -109,7 +125,7 @@ def q2_typecheck(f):
             # print(f"Checking that param ({param}) was {param.annotation}, value: {args[i]}")
             # FIXME: Won't check keyword arguments
             if (
-                param.annotation in [list, str, int, float]
+                param.annotation in [EventList, list, str, int, float]
                 and param.default == param.empty
             ):
                 _verify_variable_is_type(args[i], param.annotation)
@@ -119,6 +135,23 @@ def q2_typecheck(f):
     return g
 
 
+def _pipe(events, transform: Transform):
+    """
+    Applies an order-preserving transform to a list of events, or lazily to a stream
+    of events. Chained transforms of a stream are then done in a single pass.
+    """
+    if isinstance(events, EventStream):
+        return events.pipe(transform)
+    return transform(events)
+
+
+def _filter(events, data_filter: DataFilter, transform: Transform):
+    """Same as ``_pipe``, but the filter is done by the storage when possible"""
+    if isinstance(events, EventStream):
+        return events.filter(data_filter, transform)
+    return transform(events)
+
+
 """
     Getting buckets
 """
@@ -152,7 +185,7 @@ def q2_find_bucket(
 @q2_typecheck
 def q2_query_bucket(
     datastore: Datastore, namespace: TNamespace, bucketname: str
-) -> List[Event]:
+) -> EventStream:
     _verify_bucket_exists(datastore, bucketname)
     try:
         starttime = iso8601.parse_date(namespace["STARTTIME"])
@@ -161,7 +194,74 @@ def q2_query_bucket(
         raise QueryFunctionException(
             "Unable to parse starttime/endtime for query_bucket"
         ) from None
-    return datastore[bucketname].get(starttime=starttime, endtime=endtime)
+    bucket = datastore[bucketname]
+    return EventStream(
+        lambda filters: bucket.iter_events(starttime, endtime, filters=filters),
+        aggregate=lambda keys, filters: bucket.get_aggregate(
+            keys, starttime, endtime, filters
+        ),
+    )
+
+
+@q2_function()
+@q2_typecheck
+def q2_search_bucket(
+    datastore: Datastore,
+    namespace: TNamespace,
+    bucketname: str,
+    text: str,
+    keys: Optional[list] = None,
+) -> EventStream:
+    """
+    Same as ``query_bucket(bucketname)``, but only returns the events with all the
+    words of ``text`` in the values of ``keys`` (by default "title" and "url"), each
+    as the start of a word, ignoring case. Storages with a full-text index on these
+    keys look up the events in it, instead of reading all the events of the bucket.
+    """
+    _verify_bucket_exists(datastore, bucketname)
+    if keys is not None:
+        _verify_variable_is_type(keys, list)
+    try:
+        starttime = iso8601.parse_date(namespace["STARTTIME"])
+        endtime = iso8601.parse_date(namespace["ENDTIME"])
+    except iso8601.ParseError:
+        raise QueryFunctionException(
+            "Unable to parse starttime/endtime for search_bucket"
+        ) from None
+    bucket = datastore[bucketname]
+    search = SearchFilter(text) if keys is None else SearchFilter(text, tuple(keys))
+    return EventStream(
+        lambda filters: bucket.search(search, starttime, endtime, filters=filters)
+    )
+
+
+@q2_function()
+@q2_typecheck
+def q2_query_bucket_merged(
+    datastore: Datastore, namespace: TNamespace, bucketname: str, keys: list
+) -> List[Event]:
+    """
+    Same as ``merge_events_by_keys(query_bucket(bucketname), keys)``, but served from
+    the rollups of the storage if it keeps them for these keys, which is much faster
+    for long ranges. The results are sorted by duration (descending), and the
+    timestamps of the merged events are not meaningful.
+    """
+    _verify_bucket_exists(datastore, bucketname)
+    try:
+        starttime = iso8601.parse_date(namespace["STARTTIME"])
+        endtime = iso8601.parse_date(namespace["ENDTIME"])
+    except iso8601.ParseError:
+        raise QueryFunctionException(
+            "Unable to parse starttime/endtime for query_bucket_merged"
+        ) from None
+    bucket = datastore[bucketname]
+    events = bucket.get_rollup(keys, starttime=starttime, endtime=endtime)
+    if events is None:
+        events = merge_events_by_keys(
+            bucket.get(starttime=starttime, endtime=endtime), keys
+        )
+        events = sort_by_duration(events)
+    return events
 
 
 @q2_function()
@@ -180,39 +280,53 @@ def q2_query_bucket_eventcount(
 """
 
 
-@q2_function(filter_keyvals)
+@q2_function(filter_keyvals, streaming=True)
 @q2_typecheck
-def q2_filter_keyvals(events: list, key: str, vals: list) -> List[Event]:
-    return filter_keyvals(events, key, vals, False)
+def q2_filter_keyvals(events: EventList, key: str, vals: list) -> List[Event]:
+    return _filter(
+        events,
+        DataFilter(key, vals=tuple(vals)),
+        lambda chunk: filter_keyvals(chunk, key, vals, False),
+    )
 
 
-@q2_function(filter_keyvals)
+@q2_function(filter_keyvals, streaming=True)
 @q2_typecheck
-def q2_exclude_keyvals(events: list, key: str, vals: list) -> List[Event]:
-    return filter_keyvals(events, key, vals, True)
+def q2_exclude_keyvals(events: EventList, key: str, vals: list) -> List[Event]:
+    return _filter(
+        events,
+        DataFilter(key, vals=tuple(vals), exclude=True),
+        lambda chunk: filter_keyvals(chunk, key, vals, True),
+    )
 
 
-@q2_function(filter_keyvals_regex)
+@q2_function(filter_keyvals_regex, streaming=True)
 @q2_typecheck
-def q2_filter_keyvals_regex(events: list, key: str, regex: str) -> List[Event]:
-    return filter_keyvals_regex(events, key, regex)
+def q2_filter_keyvals_regex(events: EventList, key: str, regex: str) -> List[Event]:
+    return _filter(
+        events,
+        DataFilter(key, regex=regex),
+        lambda chunk: filter_keyvals_regex(chunk, key, regex),
+    )
 
 
 @q2_function(filter_period_intersect)
 @q2_typecheck
-def q2_filter_period_intersect(events: list, filterevents: list) -> List[Event]:
+def q2_filter_period_intersect(
+    events: EventList, filterevents: EventList
+) -> List[Event]:
     return filter_period_intersect(events, filterevents)
 
 
 @q2_function(period_union)
 @q2_typecheck
-def q2_period_union(events1: list, events2: list) -> List[Event]:
+def q2_period_union(events1: EventList, events2: EventList) -> List[Event]:
     return period_union(events1, events2)
 
 
 @q2_function(limit_events)
 @q2_typecheck
-def q2_limit_events(events: list, count: int) -> List[Event]:
+def q2_limit_events(events: EventList, count: int) -> List[Event]:
     return limit_events(events, count)
 
 
@@ -221,15 +335,21 @@ def q2_limit_events(events: list, count: int) -> List[Event]:
 """
 
 
-@q2_function(merge_events_by_keys)
+@q2_function(merge_events_by_keys, streaming=True)
 @q2_typecheck
-def q2_merge_events_by_keys(events: list, keys: list) -> List[Event]:
+def q2_merge_events_by_keys(events: EventList, keys: list) -> List[Event]:
+    if isinstance(events, EventStream):
+        # Without keys the events are returned as they are
+        merged = events.merge_by_keys(keys) if keys else None
+        if merged is not None:
+            return merged
+        events = events.materialize()
     return merge_events_by_keys(events, keys)
 
 
 @q2_function(chunk_events_by_key)
 @q2_typecheck
-def q2_chunk_events_by_key(events: list, key: str) -> List[Event]:
+def q2_chunk_events_by_key(events: EventList, key: str) -> List[Event]:
     return chunk_events_by_key(events, key)
 
 
@@ -240,13 +360,13 @@ def q2_chunk_events_by_key(events: list, key: str) -> List[Event]:
 
 @q2_function(sort_by_timestamp)
 @q2_typecheck
-def q2_sort_by_timestamp(events: list) -> List[Event]:
+def q2_sort_by_timestamp(events: EventList) -> List[Event]:
     return sort_by_timestamp(events)
 
 
 @q2_function(sort_by_duration)
 @q2_typecheck
-def q2_sort_by_duration(events: list) -> List[Event]:
+def q2_sort_by_duration(events: EventList) -> List[Event]:
     return sort_by_duration(events)
 
 
@@ -255,21 +375,26 @@ def q2_sort_by_duration(events: list) -> List[Event]:
 """
 
 
-@q2_function(sum_durations)
+@q2_function(sum_durations, streaming=True)
 @q2_typecheck
-def q2_sum_durations(events: list) -> timedelta:
+def q2_sum_durations(events: EventList) -> timedelta:
+    if isinstance(events, EventStream):
+        merged = events.merge_by_keys([])
+        if merged is not None:
+            return sum_durations(merged)
+        events = events.materialize()
     return sum_durations(events)
 
 
 @q2_function(concat)
 @q2_typecheck
-def q2_concat(events1: list, events2: list) -> List[Event]:
+def q2_concat(events1: EventList, events2: EventList) -> List[Event]:
     return concat(events1, events2)
 
 
 @q2_function(union_no_overlap)
 @q2_typecheck
-def q2_union_no_overlap(events1: list, events2: list) -> List[Event]:
+def q2_union_no_overlap(events1: EventList, events2: EventList) -> List[Event]:
     return union_no_overlap(events1, events2)
 
 
@@ -280,7 +405,7 @@ def q2_union_no_overlap(events1: list, events2: list) -> List[Event]:
 
 @q2_function(flood)
 @q2_typecheck
-def q2_flood(events: list) -> List[Event]:
+def q2_flood(events: EventList) -> List[Event]:
     return flood(events)
 
 
@@ -289,16 +414,16 @@ def q2_flood(events: list) -> List[Event]:
 """
 
 
-@q2_function(split_url_events)
+@q2_function(split_url_events, streaming=True)
 @q2_typecheck
-def q2_split_url_events(events: list) -> List[Event]:
-    return split_url_events(events)
+def q2_split_url_events(events: EventList) -> List[Event]:
+    return _pipe(events, split_url_events)
 
 
-@q2_function(simplify_string)
+@q2_function(simplify_string, streaming=True)
 @q2_typecheck
-def q2_simplify_window_titles(events: list, key: str) -> List[Event]:
-    return simplify_string(events, key=key)
+def q2_simplify_window_titles(events: EventList, key: str) -> List[Event]:
+    return _pipe(events, lambda chunk: simplify_string(chunk, key=key))
 
 
 """
@@ -318,15 +443,15 @@ def q2_nop():
 """
 
 
-@q2_function(categorize)
+@q2_function(categorize, streaming=True)
 @q2_typecheck
-def q2_categorize(events: list, classes: list):
+def q2_categorize(events: EventList, classes: list):
     classes = [(_cls, Rule(rule_dict)) for _cls, rule_dict in classes]
-    return categorize(events, classes)
+    return _pipe(events, lambda chunk: categorize(chunk, classes))
 
 
-@q2_function(tag)
+@q2_function(tag, streaming=True)
 @q2_typecheck
-def q2_tag(events: list, classes: list):
+def q2_tag(events: EventList, classes: list):
     classes = [(_cls, Rule(rule_dict)) for _cls, rule_dict in classes]
-    return tag(events, classes)
+    return _pipe(events, lambda chunk: tag(chunk, classes))
@@ -1,286 +1,203 @@
+import functools
 import logging
-from abc import abstractmethod
+import re
 from datetime import datetime
 from typing import (
     Any,
     Dict,
+    Iterator,
     List,
+    NamedTuple,
     Optional,
-    Sequence,
+    Set,
     Tuple,
-    Type,
 )
 
+from aw_core.models import Event
 from aw_datastore import Datastore
 
 from .exceptions import QueryInterpretException, QueryParseException
 from .functions import functions
+from .stream import EventStream, copy_event, materialize
 
 logger = logging.getLogger(__name__)
 
+# Number of compiled queries kept by compile_query
+MAX_CACHED_PROGRAMS = 128
+
+# Functions whose results are reused when called several times with the same
+# arguments in a query, since they only read from the datastore
+MEMOIZED_FUNCTIONS = {"find_bucket", "query_bucket"}
+
+# Variables that functions read from the namespace without being passed them (such
+# as query_bucket reading the range), so assignments to them are never removed
+IMPLICIT_VARIABLES = {"NAME", "STARTTIME", "ENDTIME"}
+
+# Key of the results of memoized calls in the namespace, which isn't a valid
+# variable name so it can't be assigned by queries
+_MEMO = "$memo"
+
 
 class QToken:
-    @abstractmethod
-    def interpret(self, datastore: Datastore, namespace: dict):
-        raise NotImplementedError
+    """
+    A node of the syntax tree of a query.
 
-    @staticmethod
-    @abstractmethod
-    def parse(string: str, namespace: dict):
-        raise NotImplementedError
+    Nodes can't be modified once parsed, so that compiled queries can be
+    cached and shared between threads.
+    """
+
+    __slots__: Tuple[str, ...] = ()
+
+    def __init__(self, **fields) -> None:
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
 
-    @staticmethod
-    @abstractmethod
-    def check(string: str) -> Tuple[Optional[str], str]:
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __hash__(self) -> int:
+        return hash((type(self), *(getattr(self, name) for name in self.__slots__)))
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def interpret(self, datastore: Datastore, namespace: dict):
         raise NotImplementedError
 
+    @classmethod
+    def parse(cls, string: str, namespace: Optional[dict] = None) -> "QToken":
+        """Parses a single expression, which has to be of this type"""
+        parser = _Parser(string)
+        node = parser.expression()
+        parser.expect("end")
+        if not isinstance(node, cls):
+            raise QueryParseException(f"Expected a {cls.__name__}, got: {string}")
+        return node
+
 
 class QInteger(QToken):
-    def __init__(self, value) -> None:
-        self.value = value
+    __slots__ = ("value",)
+    value: int
+
+    def __init__(self, value: int) -> None:
+        super().__init__(value=value)
 
     def interpret(self, datastore: Datastore, namespace: dict):
         return self.value
 
-    @staticmethod
-    def parse(string: str, namespace: dict) -> QToken:
-        return QInteger(int(string))
-
-    @staticmethod
-    def check(string: str):
-        token = ""
-        for char in string:
-            if char.isdigit():
-                token += char
-            else:
-                break
-        return token, string[len(token) :]
-
 
 class QVariable(QToken):
-    def __init__(self, name, value) -> None:
-        self.name = name
-        self.value = value
+    __slots__ = ("name",)
+    name: str
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name=name)
 
     def interpret(self, datastore: Datastore, namespace: dict):
         if self.name not in namespace:
             raise QueryInterpretException(
                 f"Tried to reference variable '{self.name}' which is not defined"
             )
-        namespace[self.name] = self.value
-        return self.value
-
-    @staticmethod
-    def parse(string: str, namespace: dict) -> QToken:
-        val = None
-        if string in namespace:
-            val = namespace[string]
-        return QVariable(string, val)
-
-    @staticmethod
-    def check(string: str):
-        token = ""
-        for i, char in enumerate(string):
-            if char.isalpha() or char == "_":
-                token += char
-            elif i != 0 and char.isdigit():
-                token += char
-            else:
-                break
-        return token, string[len(token) :]
+        return namespace[self.name]
 
 
 class QString(QToken):
-    def __init__(self, value):
-        self.value = value
+    __slots__ = ("value",)
+    value: str
+
+    def __init__(self, value: str) -> None:
+        super().__init__(value=value)
 
     def interpret(self, datastore: Datastore, namespace: dict):
         return self.value
 
-    @staticmethod
-    def parse(string: str, namespace: dict) -> "QString":
-        quotes_type = string[0]
-        string = string.replace("\\" + quotes_type, quotes_type)
-        string = string[1:-1]
-        return QString(string)
-
-    @staticmethod
-    def check(string: str):
-        token = ""
-        quotes_type = string[0]
-        if quotes_type != '"' and quotes_type != "'":
-            return token, string
-        token += quotes_type
-        prev_char = None
-        for char in string[1:]:
-            token += char
-            if (
-                char == quotes_type and prev_char != "\\"
-            ):  # escape quote_type with backslash
-                break
-            prev_char = char
-        if token[-1] != quotes_type or len(token) < 2:
-            # Unclosed string?
-            raise QueryParseException("Failed to parse string")
-        return token, string[len(token) :]
-
 
 class QFunction(QToken):
-    def __init__(self, name, args):
-        self.name = name
-        self.args = args
+    __slots__ = ("name", "args")
+    name: str
+    args: Tuple[QToken, ...]
+
+    def __init__(self, name: str, args: Tuple[QToken, ...]) -> None:
+        super().__init__(name=name, args=tuple(args))
 
     def interpret(self, datastore: Datastore, namespace: dict):
         if self.name not in functions:
             raise QueryInterpretException(
                 f"Tried to call function '{self.name}' which doesn't exist"
             )
-        call_args = [datastore, namespace]
-        for arg in self.args:
-            call_args.append(arg.interpret(datastore, namespace))
-        # logger.debug("Arguments for functioncall to {} is {}".format(self.name, call_args))
+        args = [arg.interpret(datastore, namespace) for arg in self.args]
+        return self._call(datastore, namespace, args)
+
+    def _call(self, datastore: Datastore, namespace: dict, args: list):
         try:
-            result = functions[self.name](*call_args)  # type: ignore
+            result = functions[self.name](datastore, namespace, *args)  # type: ignore
         except TypeError:
             raise QueryInterpretException(
                 f"Tried to call function {self.name} with invalid amount of arguments"
             ) from None
         return result
 
-    @staticmethod
-    def parse(string: str, namespace: dict) -> QToken:
-        arg_start = 0
-        arg_end = len(string) - 1
-        # Find opening bracket
-        for char in string:
-            if char == "(":
-                break
-            arg_start = arg_start + 1
-        # Parse name
-        name = string[:arg_start]
-        # Parse arguments
-        args = []
-        args_str = string[arg_start + 1 : arg_end]
-        while args_str:
-            (arg_t, arg), args_str = _parse_token(args_str, namespace)
-            comma = args_str.find(",")
-            if comma != -1:
-                args_str = args_str[comma + 1 :]
-            args.append(arg_t.parse(arg, namespace))
-        return QFunction(name, args)
-
-    @staticmethod
-    def check(string: str):
-        i = 0
-        # Find opening bracket
-        found = False
-        for char in string:
-            if char.isalpha() or char == "_":
-                i = i + 1
-            elif i != 0 and char.isdigit():
-                i = i + 1
-            elif char == "(":
-                i = i + 1
-                found = True
-                break
-            else:
-                break
-        if not found:
-            return None, string
-        to_consume = 1
-        single_quote = False
-        double_quote = False
-        prev_char = None
-        for char in string[i:]:
-            i = i + 1
-            if char == "'" and prev_char != "\\" and not double_quote:
-                single_quote = not single_quote
-            elif char == '"' and prev_char != "\\" and not single_quote:
-                double_quote = not double_quote
-            elif single_quote or double_quote:
-                pass
-            elif i != 0 and char.isdigit():
-                pass
-            elif char == "(":
-                to_consume += 1
-            elif char == ")":
-                to_consume -= 1
-            if to_consume == 0:
-                break
-            prev_char = char
-        if to_consume != 0:
-            return None, string
-        return string[:i], string[i + 1 :]
+
+class QMemoizedFunction(QFunction):
+    """
+    A call to one of ``MEMOIZED_FUNCTIONS`` made several times by a query, the
+    result of which is reused by calls with the same arguments while the query runs.
+    """
+
+    __slots__ = ()
+
+    def _call(self, datastore: Datastore, namespace: dict, args: list):
+        memo = namespace.setdefault(_MEMO, {})
+        # Functions reading events depend on the time range of the query
+        key = (self.name, namespace.get("STARTTIME"), namespace.get("ENDTIME"), *args)
+        try:
+            if key in memo:
+                return _copy_result(memo[key])
+        except TypeError:
+            # Not hashable, such as a list passed by mistake
+            return super()._call(datastore, namespace, args)
+        result = super()._call(datastore, namespace, args)
+        memo[key] = result
+        return _copy_result(result)
+
+
+def _copy_result(value: Any) -> Any:
+    # Transforms such as categorize assign to the data of events in place, so each
+    # call gets its own events
+    if isinstance(value, EventStream):
+        return value.share()
+    elif isinstance(value, list):
+        return [copy_event(e) if isinstance(e, Event) else e for e in value]
+    return value
 
 
 class QDict(QToken):
-    def __init__(self, value: dict) -> None:
-        self.value = value
+    __slots__ = ("value",)
+    # Pairs of keys and values, in order
+    value: Tuple[Tuple[str, QToken], ...]
+
+    def __init__(self, value: Tuple[Tuple[str, QToken], ...]) -> None:
+        super().__init__(value=tuple(value))
 
     def interpret(self, datastore: Datastore, namespace: dict):
         expanded_dict = {}
-        for key, value in self.value.items():
+        for key, value in self.value:
             expanded_dict[key] = value.interpret(datastore, namespace)
         return expanded_dict
 
-    @staticmethod
-    def parse(string: str, namespace: dict) -> QToken:
-        entries_str = string[1:-1]
-        d: Dict[str, QToken] = {}
-        while len(entries_str) > 0:
-            entries_str = entries_str.strip()
-            if len(d) > 0 and entries_str[0] == ",":
-                entries_str = entries_str[1:]
-            # parse key
-            (key_t, key_str), entries_str = _parse_token(entries_str, namespace)
-            if key_t != QString:
-                raise QueryParseException("Key in dict is not a str")
-            key = QString.parse(key_str, {}).value
-            entries_str = entries_str.strip()
-            # Remove :
-            if entries_str[0] != ":":
-                raise QueryParseException("Key in dict is not followed by a :")
-            entries_str = entries_str[1:]
-            # parse val
-            (val_t, val_str), entries_str = _parse_token(entries_str, namespace)
-            if not val_t:
-                raise QueryParseException("Dict expected a value, got nothing")
-            val = val_t.parse(val_str, namespace)
-            # set
-            d[key] = val
-        return QDict(d)
-
-    @staticmethod
-    def check(string: str):
-        if string[0] != "{":
-            return None, string
-        # Find closing bracket
-        i = 1
-        to_consume = 1
-        single_quote = False
-        double_quote = False
-        prev_char = None
-        for char in string[i:]:
-            i += 1
-            if char == "'" and prev_char != "\\" and not double_quote:
-                single_quote = not single_quote
-            elif char == '"' and prev_char != "\\" and not single_quote:
-                double_quote = not double_quote
-            elif single_quote or double_quote:
-                pass
-            elif char == "}":
-                to_consume = to_consume - 1
-            elif char == "{":
-                to_consume = to_consume + 1
-            if to_consume == 0:
-                break
-            prev_char = char
-        return string[:i], string[i + 1 :]
-
 
 class QList(QToken):
-    def __init__(self, value: list) -> None:
-        self.value = value
+    __slots__ = ("value",)
+    value: Tuple[QToken, ...]
+
+    def __init__(self, value: Tuple[QToken, ...]) -> None:
+        super().__init__(value=tuple(value))
 
     def interpret(self, datastore: Datastore, namespace: dict):
         expanded_list = []
@@ -288,72 +205,320 @@ class QList(QToken):
             expanded_list.append(value.interpret(datastore, namespace))
         return expanded_list
 
-    @staticmethod
-    def parse(string: str, namespace: dict) -> QToken:
-        entries_str = string[1:-1]
-        ls: List[QToken] = []
-        while len(entries_str) > 0:
-            entries_str = entries_str.strip()
-            if len(ls) > 0 and entries_str[0] == ",":
-                entries_str = entries_str[1:]
-            # parse
-            (val_t, val_str), entries_str = _parse_token(entries_str, namespace)
-            if not val_t:
-                raise QueryParseException("List expected a value, got nothing")
-            val = val_t.parse(val_str, namespace)
-            # set
-            ls.append(val)
-        return QList(ls)
-
-    @staticmethod
-    def check(string: str):
-        if string[0] != "[":
-            return None, string
-        # Find closing bracket
-        i = 1
-        to_consume = 1
-        single_quote = False
-        double_quote = False
-        prev_char = None
-        for char in string[i:]:
-            i += 1
-            if char == "'" and prev_char != "\\" and not double_quote:
-                single_quote = not single_quote
-            elif char == '"' and prev_char != "\\" and not single_quote:
-                double_quote = not double_quote
-            elif double_quote or single_quote:
-                pass
-            elif char == "]":
-                to_consume = to_consume - 1
-            elif char == "[":
-                to_consume = to_consume + 1
-            if to_consume == 0:
-                break
-            prev_char = char
-        return string[:i], string[i + 1 :]
-
-
-qtypes: Sequence[Type[QToken]] = [QString, QInteger, QFunction, QDict, QList, QVariable]
+
+class QMaterialize(QToken):
+    """Materializes the event streams in a value, which is used several times"""
+
+    __slots__ = ("value",)
+    value: QToken
+
+    def __init__(self, value: QToken) -> None:
+        super().__init__(value=value)
+
+    def interpret(self, datastore: Datastore, namespace: dict):
+        return materialize(self.value.interpret(datastore, namespace))
+
+
+class QAssignment(QToken):
+    __slots__ = ("name", "value")
+    name: str
+    value: QToken
+
+    def __init__(self, name: str, value: QToken) -> None:
+        super().__init__(name=name, value=value)
+
+    def interpret(self, datastore: Datastore, namespace: dict):
+        namespace[self.name] = self.value.interpret(datastore, namespace)
+
+
+class QProgram(QToken):
+    __slots__ = ("statements",)
+    statements: Tuple[QAssignment, ...]
+
+    def __init__(self, statements: Tuple[QAssignment, ...]) -> None:
+        super().__init__(statements=tuple(statements))
+
+    def interpret(self, datastore: Datastore, namespace: dict):
+        for statement in self.statements:
+            statement.interpret(datastore, namespace)
+        return materialize(get_return(namespace))
+
+
+class _Token(NamedTuple):
+    kind: str
+    value: Any
+    start: int
+    end: int
+
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<name>[^\W\d]\w*)
+    | (?P<int>\d+)
+    | (?P<quote>["'])
+    | (?P<op>[()\[\]{},:=;])
+    """,
+    re.VERBOSE,
+)
+
+
+def _tokenize(string: str) -> Iterator[_Token]:
+    """Splits the query into tokens, lazily and in a single pass"""
+    pos = 0
+    length = len(string)
+    while pos < length:
+        match = _TOKEN_RE.match(string, pos)
+        if match is None:
+            raise QueryParseException(f"Syntax error: {string[pos:]}")
+        kind = match.lastgroup
+        if kind == "space":
+            pos = match.end()
+        elif kind == "quote":
+            quote = match.group()
+            # A quote escaped with a backslash doesn't close the string
+            end = string.find(quote, pos + 1)
+            while end != -1 and string[end - 1] == "\\" and end > pos + 1:
+                end = string.find(quote, end + 1)
+            if end == -1:
+                raise QueryParseException("Failed to parse string")
+            value = string[pos + 1 : end].replace("\\" + quote, quote)
+            yield _Token("string", value, pos, end + 1)
+            pos = end + 1
+        elif kind == "op":
+            yield _Token(match.group(), None, pos, match.end())
+            pos = match.end()
+        else:
+            yield _Token(str(kind), match.group(), pos, match.end())
+            pos = match.end()
+    yield _Token("end", None, length, length)
+
+
+class _Parser:
+    """Recursive descent parser of query2, with a single token of lookahead"""
+
+    def __init__(self, string: str) -> None:
+        self.string = string
+        self.tokens = _tokenize(string)
+        self.token = next(self.tokens)
+
+    def advance(self) -> _Token:
+        token = self.token
+        if token.kind != "end":
+            self.token = next(self.tokens)
+        return token
+
+    def accept(self, kind: str) -> Optional[_Token]:
+        if self.token.kind == kind:
+            return self.advance()
+        return None
+
+    def expect(self, kind: str, message: Optional[str] = None) -> _Token:
+        if self.token.kind != kind:
+            raise QueryParseException(
+                message or f"Syntax error: {self.string[self.token.start :]}"
+            )
+        return self.advance()
+
+    def program(self) -> QProgram:
+        statements = []
+        while self.token.kind != "end":
+            if self.accept(";"):
+                continue
+            statements.append(self.statement())
+            if self.token.kind != "end":
+                self.expect(";", "Invalid syntax for value to assign")
+        return QProgram(tuple(statements))
+
+    def statement(self) -> QAssignment:
+        if self.token.kind != "name":
+            raise QueryParseException("Cannot assign to a non-variable")
+        name = self.advance().value
+        self.expect("=", "Invalid syntax for assignment variable")
+        if self.token.kind in (";", "end"):
+            raise QueryParseException("Nothing to assign")
+        return QAssignment(name, self.expression())
+
+    def expression(self) -> QToken:
+        token = self.advance()
+        if token.kind == "int":
+            return QInteger(int(token.value))
+        elif token.kind == "string":
+            return QString(token.value)
+        elif token.kind == "name":
+            if self.accept("("):
+                return QFunction(token.value, self.items(")"))
+            return QVariable(token.value)
+        elif token.kind == "[":
+            return QList(self.items("]"))
+        elif token.kind == "{":
+            return self.dict()
+        elif token.kind == "end":
+            raise QueryParseException("Expected a value, got nothing")
+        raise QueryParseException(f"Syntax error: {self.string[token.start :]}")
+
+    def items(self, close: str) -> Tuple[QToken, ...]:
+        """Parses comma separated expressions up to the closing bracket"""
+        items: List[QToken] = []
+        if self.accept(close):
+            return tuple(items)
+        while True:
+            if self.token.kind in (",", close):
+                raise QueryParseException("Expected a value, got nothing")
+            items.append(self.expression())
+            if self.accept(close):
+                return tuple(items)
+            self.expect(",")
+
+    def dict(self) -> QDict:
+        entries: List[Tuple[str, QToken]] = []
+        if self.accept("}"):
+            return QDict(tuple(entries))
+        while True:
+            key = self.accept("string")
+            if key is None:
+                raise QueryParseException("Key in dict is not a str")
+            self.expect(":", "Key in dict is not followed by a :")
+            if self.token.kind in (",", "}"):
+                raise QueryParseException("Dict expected a value, got nothing")
+            entries.append((key.value, self.expression()))
+            if self.accept("}"):
+                return QDict(tuple(entries))
+            self.expect(",")
 
 
 def _parse_token(string: str, namespace: dict) -> Tuple[Tuple[Any, str], str]:
-    # TODO: The whole parsing thing is shoddily written, needs a rewrite from ground-up
+    """
+    Parses the expression at the start of the string, returns its type and
+    source, and the rest of the string.
+    """
     if not isinstance(string, str):
         raise QueryParseException(
             "Reached unreachable, cannot parse something that isn't a string"
         )
+    string = string.strip()
     if len(string) == 0:
         return (None, ""), string
-    string = string.strip()
-    token = None
-    t = None  # Declare so we can return it
-    for t in qtypes:
-        token, string = t.check(string)
-        if token:
-            break
-    if not token:
-        raise QueryParseException(f"Syntax error: {string}")
-    return (t, token), string
+    parser = _Parser(string)
+    start = parser.token.start
+    node = parser.expression()
+    end = parser.token.start
+    return (type(node), string[start:end].rstrip()), string[end:]
+
+
+def _parse_program(query: str) -> QProgram:
+    return _Parser(query).program()
+
+
+def _variables(node: QToken) -> Iterator[str]:
+    """Names of the variables read by an expression"""
+    if isinstance(node, QVariable):
+        yield node.name
+    elif isinstance(node, QFunction):
+        for arg in node.args:
+            yield from _variables(arg)
+    elif isinstance(node, QList):
+        for value in node.value:
+            yield from _variables(value)
+    elif isinstance(node, QDict):
+        for _, value in node.value:
+            yield from _variables(value)
+
+
+def _calls(node: QToken) -> Iterator[QFunction]:
+    """Function calls in an expression, including those in arguments"""
+    if isinstance(node, QFunction):
+        yield node
+        for arg in node.args:
+            yield from _calls(arg)
+    elif isinstance(node, QList):
+        for value in node.value:
+            yield from _calls(value)
+    elif isinstance(node, QDict):
+        for _, value in node.value:
+            yield from _calls(value)
+
+
+def _memoize(node: QToken, repeated: Set[QFunction]) -> QToken:
+    """Replaces the repeated calls in the expression with memoized calls"""
+    if isinstance(node, QFunction):
+        args = tuple(_memoize(arg, repeated) for arg in node.args)
+        if node in repeated:
+            return QMemoizedFunction(node.name, args)
+        return QFunction(node.name, args)
+    elif isinstance(node, QList):
+        return QList(tuple(_memoize(value, repeated) for value in node.value))
+    elif isinstance(node, QDict):
+        return QDict(tuple((k, _memoize(v, repeated)) for k, v in node.value))
+    return node
+
+
+def plan(program: QProgram) -> QProgram:
+    """
+    Optimizes a parsed query before running it:
+
+     - statements assigning variables that never flow into RETURN are removed,
+       except for ``IMPLICIT_VARIABLES``
+     - calls to ``MEMOIZED_FUNCTIONS`` made several times with the same arguments
+       only read from the datastore once
+     - variables read several times are materialized (see ``EventStream``) when
+       assigned, while the others can be streamed through the transforms using them
+    """
+    # Walk the statements backwards, keeping those assigning a variable read later
+    live = {"RETURN"}
+    statements: List[QAssignment] = []
+    for statement in reversed(program.statements):
+        if statement.name in live or statement.name in IMPLICIT_VARIABLES:
+            live.discard(statement.name)
+            live.update(_variables(statement.value))
+            statements.append(statement)
+    statements.reverse()
+    if len(statements) < len(program.statements):
+        logger.debug(
+            f"Removed {len(program.statements) - len(statements)} unused statements"
+        )
+
+    # Identical calls may still get different arguments if the variables they
+    # read are reassigned in between, so results are reused by argument values
+    counts: Dict[QFunction, int] = {}
+    for statement in statements:
+        for call in _calls(statement.value):
+            if call.name in MEMOIZED_FUNCTIONS:
+                counts[call] = counts.get(call, 0) + 1
+    repeated = {call for call, count in counts.items() if count > 1}
+    if repeated:
+        statements = [
+            QAssignment(s.name, _memoize(s.value, repeated)) for s in statements
+        ]
+
+    # Event streams are read every time they're materialized, so values read by
+    # several statements are materialized once when assigned
+    reads = [0] * len(statements)
+    assigned: Dict[str, int] = {}
+    for i, statement in enumerate(statements):
+        for name in _variables(statement.value):
+            if name in assigned:
+                reads[assigned[name]] += 1
+        assigned[statement.name] = i
+    statements = [
+        QAssignment(s.name, QMaterialize(s.value)) if reads[i] > 1 else s
+        for i, s in enumerate(statements)
+    ]
+    return QProgram(tuple(statements))
+
+
+def _compile(query: str) -> QProgram:
+    return plan(_parse_program(query))
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_PROGRAMS)
+def compile_query(query: str) -> QProgram:
+    """
+    Parses and plans a query (see ``plan``). The results are cached by the text of
+    the query, so that large queries (such as with many category rules) that are
+    run repeatedly are only parsed once.
+    """
+    return _compile(query)
 
 
 def create_namespace() -> dict:
@@ -366,33 +531,6 @@ def create_namespace() -> dict:
     return namespace
 
 
-def parse(line, namespace):
-    separator_i = line.find("=")
-    var_str = line[:separator_i]
-    val_str = line[separator_i + 1 :]
-    if not val_str:
-        # TODO: Proper message
-        raise QueryParseException("Nothing to assign")
-    (var_t, var), var_str = _parse_token(var_str, namespace)
-    var_str = var_str.strip()
-    if var_str:  # Didn't consume whole var string
-        raise QueryParseException("Invalid syntax for assignment variable")
-    if var_t is not QVariable:
-        raise QueryParseException("Cannot assign to a non-variable")
-    (val_t, val), var_str = _parse_token(val_str, namespace)
-    if var_str:  # Didn't consume whole val string
-        raise QueryParseException("Invalid syntax for value to assign")
-    # Parse token
-    var = var_t.parse(var, namespace)
-    val = val_t.parse(val, namespace)
-    return var, val
-
-
-def interpret(var, val, namespace, datastore):
-    namespace[var.name] = val.interpret(datastore, namespace)
-    # logger.debug("Set {} to {}".format(var.name, namespace[var.name]))
-
-
 def get_return(namespace):
     if "RETURN" not in namespace:
         raise QueryParseException(
@@ -404,28 +542,12 @@ def get_return(namespace):
 def _split_query_statements(query: str) -> List[str]:
     """Split query into statements on semicolons, ignoring semicolons inside string literals."""
     statements = []
-    current = ""
-    in_single_quote = False
-    in_double_quote = False
-    prev_char = None
-
-    for char in query:
-        if char == "'" and prev_char != "\\" and not in_double_quote:
-            in_single_quote = not in_single_quote
-            current += char
-        elif char == '"' and prev_char != "\\" and not in_single_quote:
-            in_double_quote = not in_double_quote
-            current += char
-        elif char == ";" and not in_single_quote and not in_double_quote:
-            statements.append(current)
-            current = ""
-        else:
-            current += char
-        prev_char = char
-
-    if current:
-        statements.append(current)
-    return statements
+    start = 0
+    for token in _tokenize(query):
+        if token.kind in (";", "end"):
+            statements.append(query[start : token.start])
+            start = token.end
+    return [statement for statement in statements if statement]
 
 
 def query(
@@ -436,13 +558,6 @@ def query(
     namespace["STARTTIME"] = starttime.isoformat()
     namespace["ENDTIME"] = endtime.isoformat()
 
-    query_stmts = _split_query_statements(query)
-    for statement in query_stmts:
-        statement = statement.strip()
-        if statement:
-            logger.debug("Parsing: " + statement)
-            var, val = parse(statement, namespace)
-            interpret(var, val, namespace, datastore)
-
-    result = get_return(namespace)
-    return result
+    program = compile_query(query)
+    logger.debug(f"Running query with {len(program.statements)} statements")
+    return program.interpret(datastore, namespace)
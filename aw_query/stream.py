@@ -0,0 +1,135 @@
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from aw_core.models import Event
+from aw_datastore.storages import DataFilter
+
+# Number of events read from the storage and transformed at a time
+CHUNKSIZE = 1000
+
+# A transform that can be applied to any part of a list of events independently,
+# and keeps them in order (such as filter_keyvals or categorize)
+Transform = Callable[[List[Event]], List[Event]]
+
+# Reads the events matching the filters
+Source = Callable[[Sequence[DataFilter]], Iterable[Event]]
+
+# Merges the events matching the filters by keys, returns None if it can't
+Aggregate = Callable[[Sequence[str], Sequence[DataFilter]], Optional[List[Event]]]
+
+
+class EventStream:
+    """
+    Events read lazily (such as from ``Bucket.iter_events``), with order-preserving
+    transforms applied to them in chunks as they are read.
+
+    Chaining such transforms fuses them into a single pass over the events, so only
+    the output of the chain is ever held in memory. Query functions which need all
+    the events (like sorting and merging) materialize the stream into a list, which
+    is kept so that the events are only read once.
+
+    Filters on the data of the events that come before any transform are passed to
+    the source instead, so that the storage can skip the other events entirely.
+    Likewise, streams without transforms can be merged by ``aggregate``.
+    """
+
+    def __init__(
+        self,
+        source: Source,
+        transforms: Tuple[Transform, ...] = (),
+        filters: Tuple[DataFilter, ...] = (),
+        aggregate: Optional[Aggregate] = None,
+    ) -> None:
+        self._source = source
+        self._transforms = transforms
+        self._filters = filters
+        self._aggregate = aggregate
+        self._events: Optional[List[Event]] = None
+
+    def pipe(self, transform: Transform) -> "EventStream":
+        """Returns a stream of these events with the transform applied"""
+        if self._events is not None:
+            events = self._events
+            return EventStream(lambda _: events, (transform,))
+        return EventStream(self._source, self._transforms + (transform,), self._filters)
+
+    def filter(self, data_filter: DataFilter, transform: Transform) -> "EventStream":
+        """
+        Returns a stream of the events matching the filter. It's done with
+        ``transform`` instead if other transforms come before it.
+        """
+        if self._events is None and not self._transforms:
+            return EventStream(
+                self._source, (), self._filters + (data_filter,), self._aggregate
+            )
+        return self.pipe(transform)
+
+    def merge_by_keys(self, keys: Sequence[str]) -> Optional[List[Event]]:
+        """
+        Returns the events merged by keys like ``merge_events_by_keys``, without
+        reading them, or None if they have to be read. Without keys, all events
+        are merged into one.
+        """
+        if self._aggregate is None or self._events is not None or self._transforms:
+            return None
+        return self._aggregate(keys, self._filters)
+
+    def share(self) -> "EventStream":
+        """
+        Returns a stream of copies of these events, for one of several uses of them.
+        The events are read once for all of them, except when filters or merges of
+        the returned stream can be done by the storage instead.
+        """
+
+        def source(filters: Sequence[DataFilter]) -> Iterable[Event]:
+            if filters and self._events is None and not self._transforms:
+                return self._source(self._filters + tuple(filters))
+            events = (copy_event(e) for e in self.materialize())
+            return (e for e in events if all(f.match(e.data) for f in filters))
+
+        aggregate: Optional[Aggregate] = None
+        if self._aggregate is not None and not self._transforms:
+            base_aggregate, base_filters = self._aggregate, self._filters
+
+            def aggregate(keys, filters):
+                return base_aggregate(keys, base_filters + tuple(filters))
+
+        return EventStream(source, aggregate=aggregate)
+
+    def materialize(self) -> List[Event]:
+        if self._events is None:
+            self._events = list(self._iter())
+        return self._events
+
+    def __iter__(self) -> Iterator[Event]:
+        if self._events is not None:
+            return iter(self._events)
+        return self._iter()
+
+    def _iter(self) -> Iterator[Event]:
+        events = iter(self._source(self._filters))
+        while True:
+            chunk = list(islice(events, CHUNKSIZE))
+            if not chunk:
+                return
+            for transform in self._transforms:
+                chunk = transform(chunk)
+            yield from chunk
+
+
+def copy_event(e: Event) -> Event:
+    """Copies an event, with a copy of its data so that transforms can modify it"""
+    return Event.from_trusted(e.id, e.timestamp, e.duration, dict(e.data))
+
+
+def materialize(value: Any) -> Any:
+    """Replaces the streams in a value, including nested ones, with lists"""
+    if isinstance(value, EventStream):
+        return value.materialize()
+    elif isinstance(value, Event):
+        return value
+    elif isinstance(value, list):
+        return [materialize(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: materialize(v) for k, v in value.items()}
+    return value
@@ -1,4 +1,5 @@
 import logging
+import os
 import random
 from datetime import datetime, timedelta, timezone
 
@@ -337,9 +338,6 @@ def test_get_event_trimming(bucket_cm):
     # (needed in raw data view, among other places where event editing is permitted)
 
     with bucket_cm as bucket:
-        if not isinstance(bucket.ds.storage_strategy, PeeweeStorage):
-            pytest.skip("Trimming not supported for datastore")
-
         eventcount = 2
         # Create 1-day long events
         events = [
@@ -357,6 +355,12 @@ def test_get_event_trimming(bucket_cm):
         total_duration = sum((e.duration for e in fetched_events), timedelta())
         assert td1d == timedelta(seconds=round(total_duration.total_seconds()))
 
+        # Events are trimmed the same way when iterating
+        iterated_events = list(
+            bucket.iter_events(starttime=now + td1d / 2, endtime=now + 1.5 * td1d)
+        )
+        assert iterated_events == fetched_events
+
 
 @pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
 def test_get_datefilter_start(bucket_cm):
@@ -584,3 +588,1119 @@ def test_get_eventcount(bucket_cm):
         )
         assert bucket.get_eventcount(endtime=now + timedelta(seconds=1)) == 5
         assert bucket.get_eventcount(starttime=now + timedelta(seconds=1)) == 1
+
+
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_iter_events(bucket_cm):
+    """
+    Tests that iterating over events yields the same events as get
+    """
+    with bucket_cm as bucket:
+        eventcount = 25
+        events = [
+            Event(timestamp=now + i * td1s, duration=td1s, data={"i": i})
+            for i in range(eventcount)
+        ]
+        bucket.insert(events)
+
+        assert list(bucket.iter_events(chunksize=10)) == bucket.get(-1)
+
+        starttime = now + 5.5 * td1s
+        endtime = now + 14.5 * td1s
+        fetched_events = list(
+            bucket.iter_events(starttime=starttime, endtime=endtime, chunksize=4)
+        )
+        assert fetched_events == bucket.get(-1, starttime=starttime, endtime=endtime)
+        assert [e.data["i"] for e in fetched_events] == list(range(14, 4, -1))
+
+
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_iter_events_filtered(bucket_cm):
+    """
+    Tests that filtered iteration yields the same events as filtering them in Python
+    """
+    from aw_datastore.storages import DataFilter
+    from aw_transform import filter_keyvals, filter_keyvals_regex
+
+    datas = [
+        {"app": "Firefox", "n": 1},
+        {"app": "firefox"},
+        {"app": "1"},
+        {"app": 1},
+        {"app": True},
+        {"app": ["Firefox"]},
+        {"app": '"Firefox"'},
+        {"app": None},
+        {"title": "Firefox"},
+    ]
+    with bucket_cm as bucket:
+        bucket.insert(
+            [
+                Event(timestamp=now + i * td1s, duration=td1s, data=data)
+                for i, data in enumerate(datas)
+            ]
+        )
+        events = bucket.get(-1)
+
+        def filtered(*filters):
+            return list(bucket.iter_events(chunksize=4, filters=filters))
+
+        for vals in (["Firefox", 1], ['"Firefox"', "1"], [True], []):
+            assert filtered(DataFilter("app", vals=tuple(vals))) == filter_keyvals(
+                events, "app", vals
+            )
+            assert filtered(
+                DataFilter("app", vals=tuple(vals), exclude=True)
+            ) == filter_keyvals(events, "app", vals, exclude=True)
+        assert filtered(DataFilter("title", regex="^F")) == filter_keyvals_regex(
+            events, "title", "^F"
+        )
+        assert filtered(
+            DataFilter("app", vals=("Firefox", "firefox")), DataFilter("n", vals=(1,))
+        ) == [events[-1]]
+
+
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_get_aggregate(bucket_cm):
+    """
+    Tests that aggregating in the storage gives the same events as merging them
+    """
+    from aw_datastore.storages import DataFilter
+    from aw_transform import filter_keyvals, merge_events_by_keys
+
+    datas = [
+        {"app": "Firefox", "title": "a"},
+        {"app": "Firefox", "title": "b"},
+        {"app": "Code", "title": "a"},
+        {"app": 1, "title": "a"},
+        {"app": 1.0},
+        {"app": ["Code", "Firefox"], "title": "a"},
+        {"title": "Firefox"},
+        {"app": None},
+        {},
+    ]
+    with bucket_cm as bucket:
+        bucket.insert(
+            [
+                Event(timestamp=now + i * 60 * td1s, duration=(i + 1) * td1s, data=data)
+                for i, data in enumerate(datas * 3)
+            ]
+        )
+        starttime = now + 30 * td1s
+        endtime = now + 20 * 60 * td1s + 5 * td1s
+        events = bucket.get(-1, starttime, endtime)
+        for filters in [(), (DataFilter("app", vals=("Firefox", "Code")),)]:
+            filtered = events
+            for f in filters:
+                filtered = filter_keyvals(filtered, f.key, list(f.vals))
+            for keys in (["app"], ["app", "title"], ["title"]):
+                merged = bucket.get_aggregate(keys, starttime, endtime, filters)
+                if merged is None:
+                    continue
+                assert merged == merge_events_by_keys(filtered, keys)
+            merged = bucket.get_aggregate([], starttime, endtime, filters)
+            if merged is not None:
+                assert len(merged) == 1
+                assert merged[0].duration == sum(
+                    (e.duration for e in filtered), timedelta()
+                )
+        assert bucket.get_aggregate(["app"], now + 1000 * td1d) in ([], None)
+
+
+def test_sqlite_lazy_commit(tmp_path):
+    """
+    Tests that writes are batched by the flush thread, and that reads see pending writes
+    """
+    import sqlite3
+
+    from aw_datastore.storages import SqliteStorage
+
+    filepath = str(tmp_path / "test.db")
+    storage = SqliteStorage(testing=True, filepath=filepath)
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+
+    def committed_eventcount():
+        with sqlite3.connect(filepath) as conn:
+            return conn.execute("SELECT count(*) FROM events").fetchone()[0]
+
+    storage.insert_one("test", Event(timestamp=now, duration=td1s))
+    assert storage.get_eventcount("test") == 1
+    assert len(storage.get_events("test", -1)) == 1
+    assert committed_eventcount() == 0
+
+    # Commit is due once the pending writes are old enough
+    storage._flush_if_due()
+    assert committed_eventcount() == 0
+    storage.last_commit = datetime.now() - timedelta(minutes=1)
+    storage._flush_if_due()
+    assert committed_eventcount() == 1
+
+    storage.insert_one("test", Event(timestamp=now, duration=td1s))
+    storage.close()
+    assert committed_eventcount() == 2
+
+
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_heartbeat(bucket_cm):
+    """
+    Tests that heartbeats get merged, and that the last event is cached between heartbeats
+    """
+    with bucket_cm as bucket:
+        storage = bucket.ds.storage_strategy
+        get_events = storage.get_events
+        reads = []
+
+        def counting_get_events(*args, **kwargs):
+            reads.append(args)
+            return get_events(*args, **kwargs)
+
+        storage.get_events = counting_get_events
+        try:
+            for i in range(5):
+                bucket.heartbeat(
+                    Event(timestamp=now + i * td1s, data={"label": "a"}), pulsetime=2
+                )
+            merged = bucket.heartbeat(
+                Event(timestamp=now + 5 * td1s, data={"label": "a"}), pulsetime=2
+            )
+            assert merged.duration == 5 * td1s
+            # Different data, can't be merged
+            bucket.heartbeat(
+                Event(timestamp=now + 6 * td1s, data={"label": "b"}), pulsetime=2
+            )
+            # Too long since last heartbeat, can't be merged
+            bucket.heartbeat(
+                Event(timestamp=now + 10 * td1s, data={"label": "b"}), pulsetime=2
+            )
+            # Replacing the last event doesn't need to read it to log its range
+            bucket.replace_last(
+                Event(timestamp=now + 10 * td1s, duration=td1s, data={"label": "b"})
+            )
+            # Only the first heartbeat needed to read the last event
+            assert len(reads) == 1
+        finally:
+            del storage.get_events
+
+        events = bucket.get(-1)
+        assert [e.data["label"] for e in events] == ["b", "b", "a"]
+        assert events[2].duration == 5 * td1s
+
+        # Inserting invalidates the cache
+        bucket.insert(Event(timestamp=now + 11 * td1s, data={"label": "c"}))
+        bucket.heartbeat(
+            Event(timestamp=now + 12 * td1s, data={"label": "c"}), pulsetime=2
+        )
+        events = bucket.get(-1)
+        assert len(events) == 4
+        assert events[0].duration == td1s
+
+
+@pytest.mark.parametrize("storage_sid", ["sqlite", "sqlite-partitioned"])
+def test_sqlite_replace_last_shortened(tmp_path, storage_sid):
+    """
+    Tests that replace_last replaces the event that ends last, after the last event
+    was shortened to end before another one
+    """
+    storage = get_storage_methods()[storage_sid](
+        testing=True, filepath=str(tmp_path / "test")
+    )
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+    storage.insert_one(
+        "test", Event(timestamp=now, duration=10 * td1s, data={"label": "A"})
+    )
+    storage.insert_one(
+        "test", Event(timestamp=now + td1s, duration=19 * td1s, data={"label": "B"})
+    )
+    storage.replace_last(
+        "test", Event(timestamp=now + td1s, duration=4 * td1s, data={"label": "B"})
+    )
+    assert storage.get_events("test", 1)[0].data == {"label": "A"}
+    storage.replace_last(
+        "test", Event(timestamp=now, duration=11 * td1s, data={"label": "A-extended"})
+    )
+    events = storage.get_events("test", -1)
+    assert [e.data["label"] for e in events] == ["A-extended", "B"]
+    storage.close()
+
+
+@pytest.mark.parametrize("storage_sid", ["sqlite", "sqlite-partitioned"])
+def test_sqlite_replace_other_bucket(tmp_path, storage_sid):
+    """
+    Tests that the last event of a bucket is looked up again when replace moves it
+    to another bucket
+    """
+    storage = get_storage_methods()[storage_sid](
+        testing=True, filepath=str(tmp_path / "test")
+    )
+    for bid in ["a", "b"]:
+        storage.create_bucket(bid, "test", "test", "test", now.isoformat())
+    storage.insert_one("a", Event(timestamp=now, duration=td1s, data={"label": "a1"}))
+    ea = storage.insert_one(
+        "a", Event(timestamp=now + td1s, duration=td1s, data={"label": "a2"})
+    )
+    storage.replace("b", ea.id, Event(timestamp=now + td1s, data={"label": "b"}))
+    storage.replace_last("a", Event(timestamp=now, data={"label": "a1-replaced"}))
+    assert [e.data["label"] for e in storage.get_events("a", -1)] == ["a1-replaced"]
+    assert [e.data["label"] for e in storage.get_events("b", -1)] == ["b"]
+    storage.close()
+
+
+def test_sqlite_heartbeat_statements(tmp_path):
+    """
+    Tests that merging a heartbeat into the cached last event only updates that
+    event, without looking up the last event of the bucket again
+    """
+    from aw_datastore import Datastore
+    from aw_datastore.storages import SqliteStorage
+
+    datastore = Datastore(
+        SqliteStorage, testing=True, filepath=str(tmp_path / "test.db")
+    )
+    bucket = datastore.create_bucket("test", "test", "test", "test")
+    bucket.heartbeat(Event(timestamp=now, data={"label": "a"}), pulsetime=2)
+    bucket.heartbeat(Event(timestamp=now + td1s, data={"label": "a"}), pulsetime=2)
+
+    statements: list = []
+    datastore.storage_strategy.conn.set_trace_callback(statements.append)
+    merged = bucket.heartbeat(
+        Event(timestamp=now + 2 * td1s, data={"label": "a"}), pulsetime=2
+    )
+    datastore.storage_strategy.conn.set_trace_callback(None)
+    assert merged.duration == 2 * td1s
+    statements = [s for s in statements if s.split()[0].upper() != "BEGIN"]
+    assert len(statements) == 2
+    assert statements[0].split()[:2] == ["UPDATE", "events"]
+    assert "max_duration" in statements[1]
+    assert bucket.get(-1) == [merged]
+    datastore.storage_strategy.close()
+
+
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_heartbeat_threads(bucket_cm):
+    """Tests that heartbeats sent from several threads are all merged"""
+    import threading
+
+    with bucket_cm as bucket:
+        bucket.heartbeat(Event(timestamp=now, data={"label": "a"}), pulsetime=60)
+
+        def send(offset):
+            for i in range(offset, 40, 4):
+                bucket.heartbeat(
+                    Event(timestamp=now + i * td1s, data={"label": "a"}), pulsetime=60
+                )
+
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        events = bucket.get(-1)
+        assert len(events) == 1
+        assert events[0].duration == 39 * td1s
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_replace_last_other_bucket(datastore):
+    """
+    Tests that replace_last doesn't touch the last event of another bucket with the same endtime
+    """
+    buckets = []
+    try:
+        for bid in ["test-replace-last-1", "test-replace-last-2"]:
+            buckets.append(datastore.create_bucket(bid, "test", "test", "test"))
+        bucket1, bucket2 = buckets
+        bucket1.insert(Event(timestamp=now, duration=td1s, data={"label": "1"}))
+        bucket2.insert(Event(timestamp=now, duration=td1s, data={"label": "2"}))
+        bucket2.replace_last(Event(timestamp=now, duration=td1s, data={"label": "3"}))
+        assert bucket1.get(-1)[0].data == {"label": "1"}
+        assert bucket2.get(-1)[0].data == {"label": "3"}
+
+        # The last event changes as events are inserted, replaced and deleted
+        e = bucket2.insert(Event(timestamp=now + td1s, duration=td1s))
+        assert e is not None
+        bucket2.replace_last(Event(timestamp=now + td1s, data={"label": "4"}))
+        assert [e.data for e in bucket2.get(-1)] == [{"label": "4"}, {"label": "3"}]
+        bucket2.delete(e.id)
+        bucket2.replace_last(Event(timestamp=now, data={"label": "5"}))
+        assert [e.data for e in bucket2.get(-1)] == [{"label": "5"}]
+    finally:
+        for bucket in buckets:
+            datastore.delete_bucket(bucket.bucket_id)
+
+
+def test_sqlite_schema_upgrade(tmp_path):
+    """
+    Tests that a database with the original schema gets upgraded on open
+    """
+    import sqlite3
+
+    from aw_datastore.migration import SQLITE_SCHEMA_VERSION
+    from aw_datastore.storages import SqliteStorage
+    from aw_datastore.storages.sqlite import CREATE_BUCKETS_TABLE, CREATE_EVENTS_TABLE
+
+    filepath = str(tmp_path / "test.db")
+    with sqlite3.connect(filepath) as conn:
+        conn.execute(CREATE_BUCKETS_TABLE)
+        conn.execute(CREATE_EVENTS_TABLE)
+        conn.execute(
+            "INSERT INTO buckets(id, name, type, client, hostname, created, datastr) "
+            "VALUES ('test', 'test', 'test', 'test', 'test', ?, '{}')",
+            [now.isoformat()],
+        )
+        for i in range(3):
+            conn.execute(
+                "INSERT INTO events(bucketrow, starttime, endtime, datastr) "
+                "VALUES (1, ?, ?, ?)",
+                [i, i + 1, f'{{"i": {i}}}'],
+            )
+        conn.execute("DELETE FROM events WHERE id = 3")
+    conn.close()
+
+    storage = SqliteStorage(testing=True, filepath=filepath)
+    version = storage.conn.execute("PRAGMA user_version").fetchone()[0]
+    assert version == SQLITE_SCHEMA_VERSION
+    storage.replace_last("test", Event(timestamp=now, data={"i": "last"}))
+    assert [e.data["i"] for e in storage.get_events("test", -1)] == ["last", 0]
+    # Ids of events deleted before the upgrade aren't reused
+    assert storage.insert_one("test", Event(timestamp=now)).id == 4
+    storage.close()
+
+
+def test_sqlite_v1_to_v2(tmp_path):
+    """
+    Tests that the sqlite v1 database is copied to v2 before the schema upgrades,
+    leaving the v1 database readable by older versions
+    """
+    import sqlite3
+
+    from aw_datastore.migration import sqlite_v1_to_v2
+    from aw_datastore.storages import SqliteStorage
+    from aw_datastore.storages.sqlite import CREATE_BUCKETS_TABLE, CREATE_EVENTS_TABLE
+
+    v1_path = str(tmp_path / "sqlite-testing.v1.db")
+    v2_path = str(tmp_path / "sqlite-testing.v2.db")
+    sqlite_v1_to_v2(str(tmp_path), "sqlite-testing", v2_path)
+    assert not os.path.exists(v2_path)
+
+    with sqlite3.connect(v1_path) as conn:
+        conn.execute(CREATE_BUCKETS_TABLE)
+        conn.execute(CREATE_EVENTS_TABLE)
+        conn.execute(
+            "INSERT INTO buckets(id, name, type, client, hostname, created, datastr) "
+            "VALUES ('test', 'test', 'test', 'test', 'test', ?, '{}')",
+            [now.isoformat()],
+        )
+        conn.execute(
+            "INSERT INTO events(bucketrow, starttime, endtime, datastr) "
+            "VALUES (1, 0, 1, '{\"a\": 1}')"
+        )
+    conn.close()
+
+    sqlite_v1_to_v2(str(tmp_path), "sqlite-testing", v2_path)
+    storage = SqliteStorage(testing=True, filepath=v2_path)
+    assert [e.data for e in storage.get_events("test", -1)] == [{"a": 1}]
+    storage.close()
+
+    conn = sqlite3.connect(v1_path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+    assert conn.execute("SELECT datastr FROM events").fetchall() == [('{"a": 1}',)]
+    conn.close()
+
+
+def test_sqlite_bucket_keys(tmp_path):
+    """
+    Tests that the cached bucket rowids are refreshed when buckets change
+    """
+    from aw_datastore.storages import SqliteStorage
+
+    filepath = str(tmp_path / "test.db")
+    storage = SqliteStorage(testing=True, filepath=filepath, enable_lazy_commit=False)
+    other = SqliteStorage(testing=True, filepath=filepath, enable_lazy_commit=False)
+
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+    assert "test" in storage.bucket_keys
+    storage.insert_one("test", Event(timestamp=now, duration=td1s))
+
+    # Created through another connection, found on cache miss
+    other.create_bucket("test-other", "test", "test", "test", now.isoformat())
+    storage.insert_one("test-other", Event(timestamp=now, duration=td1s))
+    assert storage.get_eventcount("test-other") == 1
+
+    storage.delete_bucket("test")
+    assert "test" not in storage.bucket_keys
+    assert storage.get_eventcount("test") == 0
+    assert other.get_eventcount("test-other") == 1
+    storage.close()
+    other.close()
+
+
+@pytest.mark.parametrize("storage_sid", ["sqlite", "sqlite-partitioned"])
+def test_sqlite_exit_without_close(tmp_path, storage_sid):
+    """
+    Tests that lazily committed writes aren't lost when the process exits without
+    closing the storage
+    """
+    import subprocess
+    import sys
+
+    filepath = str(tmp_path / "test")
+    script = f"""
+from datetime import datetime, timedelta, timezone
+from aw_core.models import Event
+from aw_datastore import Datastore, get_storage_methods
+
+ds = Datastore(get_storage_methods()[{storage_sid!r}], testing=True, filepath={filepath!r})
+bucket = ds.create_bucket("test", "test", "test", "test")
+now = datetime.now(timezone.utc)
+for i in range(20):
+    bucket.insert(Event(timestamp=now + i * timedelta(seconds=1)))
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script], check=True, cwd=root)
+
+    storage = get_storage_methods()[storage_sid](testing=True, filepath=filepath)
+    assert storage.get_eventcount("test") == 20
+    storage.close()
+
+
+def test_sqlite_read_connections(tmp_path):
+    """
+    Tests reading through the pool of read-only connections from several threads
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from aw_datastore.storages import SqliteStorage
+
+    filepath = str(tmp_path / "test.db")
+    storage = SqliteStorage(testing=True, filepath=filepath, read_connections=2)
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+    storage.insert_many(
+        "test", [Event(timestamp=now + i * td1s, duration=td1s) for i in range(100)]
+    )
+    # Pending writes are visible to the readers
+    assert storage.num_uncommitted_statements > 0
+    assert storage.get_eventcount("test") == 100
+    assert storage.num_uncommitted_statements == 0
+
+    def read(i):
+        events = storage.get_events("test", -1, starttime=now + i * td1s)
+        assert len(list(storage.iter_events("test", chunksize=7))) == 100
+        return len(events)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(read, range(100))) == [100 - i for i in range(100)]
+    assert storage._read_pool is not None
+    assert storage._read_pool.qsize() == 2
+    storage.close()
+
+
+def test_sqlite_read_connections_abandoned(tmp_path):
+    """
+    Tests that iterators which aren't consumed to the end don't keep a connection
+    of the read pool, nor a statement open on the writer
+    """
+    from aw_datastore.storages import SqliteStorage
+
+    events = [Event(timestamp=now + i * td1s, duration=td1s) for i in range(100)]
+    for read_connections in [0, 1]:
+        filepath = str(tmp_path / f"test{read_connections}.db")
+        storage = SqliteStorage(
+            testing=True, filepath=filepath, read_connections=read_connections
+        )
+        storage.create_bucket("test", "test", "test", "test", now.isoformat())
+        storage.insert_many("test", events)
+        storage.commit()
+        latest = storage.get_events("test", 1)[0]
+        iterators = [storage.iter_events("test", chunksize=7) for _ in range(3)]
+        for it in iterators:
+            assert next(it) == latest
+        if storage._read_pool is not None:
+            assert storage._read_pool.qsize() == 1
+        assert not storage.conn.in_transaction
+        assert storage.get_eventcount("test") == 100
+
+        # Events written in between are seen by the rest of the iteration if older
+        oldest = storage.insert_one("test", Event(timestamp=now - td1s, duration=td1s))
+        storage.insert_one("test", Event(timestamp=now + 100 * td1s, duration=td1s))
+        rest = list(iterators[0])
+        assert len(rest) == 100
+        assert rest[-1].id == oldest.id
+        storage.close()
+
+
+def test_sqlite_profile(tmp_path):
+    """
+    Tests that the PRAGMAs of the profile are in effect, and that invalid ones are rejected
+    """
+    import tomlkit
+    from aw_datastore import Datastore, get_storage_kwargs
+    from aw_datastore.storages import SqliteStorage
+
+    config = tomlkit.parse(
+        """
+        [server.storage.sqlite]
+        profile = "balanced"
+        unknown_option = true
+
+        [server.storage.sqlite.pragmas]
+        cache_size = -4000
+        """
+    )
+    kwargs = get_storage_kwargs(SqliteStorage, config["server"]["storage"]["sqlite"])
+    assert kwargs == {"profile": "balanced", "pragmas": {"cache_size": -4000}}
+
+    filepath = str(tmp_path / "test.db")
+    ds = Datastore(SqliteStorage, testing=True, filepath=filepath, **kwargs)
+    storage = ds.storage_strategy
+    assert isinstance(storage, SqliteStorage)
+    pragmas = storage.pragmas()
+    assert pragmas["journal_mode"] == "wal"
+    assert pragmas["synchronous"] == "NORMAL"
+    assert pragmas["temp_store"] == "MEMORY"
+    assert pragmas["cache_size"] == -4000
+    storage.close()
+
+    with pytest.raises(ValueError):
+        SqliteStorage(testing=True, filepath=filepath, profile="reckless")
+    with pytest.raises(ValueError):
+        SqliteStorage(testing=True, filepath=filepath, pragmas={"journal_mode": "OFF"})
+    with pytest.raises(ValueError):
+        SqliteStorage(testing=True, filepath=filepath, pragmas={"synchronous": "0; --"})
+
+
+def test_sqlite_query_plans(tmp_path):
+    """
+    Runs EXPLAIN QUERY PLAN for every statement SqliteStorage executes on events,
+    and fails if any of them has to scan the whole events table.
+
+    Done before closing the storage, since PRAGMA optimize could gather statistics
+    saying that the events table is tiny, which makes a scan the best plan.
+    """
+    import sqlite3
+
+    from aw_datastore.storages import SqliteStorage
+
+    filepath = str(tmp_path / "test.db")
+    storage = SqliteStorage(testing=True, filepath=filepath)
+    statements = []
+    storage.conn.set_trace_callback(statements.append)
+
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+    storage.create_bucket("test-other", "test", "test", "test", now.isoformat())
+    e = storage.insert_one("test", Event(timestamp=now, duration=td1s))
+    storage.insert_many(
+        "test",
+        [Event(timestamp=now + i * td1s, duration=td1s) for i in range(1, 10)]
+        + [Event(id=e.id, timestamp=now, duration=2 * td1s)],
+    )
+    storage.replace("test", e.id, Event(timestamp=now, duration=td1s))
+    storage.replace_last("test", Event(timestamp=now + 9 * td1s, duration=td1s))
+    storage.get_event("test", e.id)
+    storage.get_events("test", 1)
+    storage.get_events("test", -1, starttime=now + 2 * td1s, endtime=now + 5 * td1s)
+    list(storage.iter_events("test", starttime=now + 2 * td1s))
+    storage.get_eventcount("test", endtime=now + 5 * td1s)
+    storage.delete("test", e.id)
+    storage.delete_bucket("test-other")
+    storage.conn.set_trace_callback(None)
+
+    statements = [
+        s
+        for s in statements
+        if "events" in s and s.split()[0].upper() in ["SELECT", "UPDATE", "DELETE"]
+    ]
+    assert statements
+    conn = sqlite3.connect(filepath)
+    for statement in statements:
+        plan = conn.execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+        details = [row[-1] for row in plan]
+        assert not [d for d in details if d.startswith("SCAN events")], (
+            statement,
+            details,
+        )
+    conn.close()
+    storage.close()
+
+
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_get_datefilter_long_events(bucket_cm):
+    """
+    Tests that events much longer than the queried range are found, including
+    ones that got longer with replace_last
+    """
+    with bucket_cm as bucket:
+        if isinstance(bucket.ds.storage_strategy, PeeweeStorage):
+            pytest.skip("PeeweeStorage assumes events are never longer than 24h")
+
+        bucket.insert(Event(timestamp=now, duration=10 * td1d, data={"label": "long"}))
+        bucket.insert(
+            [
+                Event(timestamp=now + i * td1d, duration=td1s, data={"label": "short"})
+                for i in range(1, 20)
+            ]
+        )
+        bucket.insert(Event(timestamp=now + 20 * td1d, duration=td1s))
+        bucket.replace_last(
+            Event(timestamp=now + 20 * td1d, duration=5 * td1d, data={"label": "last"})
+        )
+
+        starttime = now + 5.5 * td1d
+        endtime = starttime + td1s
+        assert [e.data["label"] for e in bucket.get(-1, starttime, endtime)] == ["long"]
+        assert bucket.get_eventcount(starttime, endtime) == 1
+
+        starttime = now + 24 * td1d
+        endtime = starttime + td1s
+        assert [e.data["label"] for e in bucket.get(-1, starttime, endtime)] == ["last"]
+        assert bucket.get_eventcount(starttime, endtime) == 1
+
+
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_get_shared_data(bucket_cm):
+    """
+    Tests that events with identical data don't share it once fetched,
+    since transforms modify events in place
+    """
+    with bucket_cm as bucket:
+        flat = {"app": "test", "title": "a"}
+        nested = {"app": "test", "tags": ["a"], "meta": {"n": 1}}
+        bucket.insert(
+            [
+                Event(timestamp=now + i * td1s, duration=td1s, data=flat)
+                for i in range(2)
+            ]
+            + [
+                Event(timestamp=now + i * td1s, duration=td1s, data=nested)
+                for i in range(2, 4)
+            ]
+        )
+        events = bucket.get(-1)
+        assert [e.data for e in events] == 2 * [nested] + 2 * [flat]
+        events[0].data["tags"].append("b")
+        events[0].data["meta"]["n"] = 2
+        events[2].data["title"] = "b"
+        assert events[1].data == nested
+        assert events[3].data == flat
+        assert all(e.duration == td1s for e in events)
+        assert events[-1].timestamp == Event(timestamp=now).timestamp
+
+
+def test_sqlite_eventdata(tmp_path):
+    """
+    Tests that identical event data is only stored once, and removed with the last bucket using it
+    """
+    from aw_datastore.storages import SqliteStorage
+
+    filepath = str(tmp_path / "test.db")
+    storage = SqliteStorage(testing=True, filepath=filepath)
+
+    def datastrs():
+        rows = storage.conn.execute("SELECT datastr FROM eventdata ORDER BY id")
+        return [row[0] for row in rows]
+
+    for bucket_id in ["test-1", "test-2"]:
+        storage.create_bucket(bucket_id, "test", "test", "test", now.isoformat())
+        storage.insert_many(
+            bucket_id,
+            [
+                Event(timestamp=now + i * td1s, duration=td1s, data={"i": i % 2})
+                for i in range(10)
+            ],
+        )
+    storage.insert_one("test-2", Event(timestamp=now, data={"only": "test-2"}))
+    assert datastrs() == ['{"i": 0}', '{"i": 1}', '{"only": "test-2"}']
+    assert [e.data["i"] for e in storage.get_events("test-1", -1)] == 5 * [1, 0]
+
+    # Data is looked up again after the cache is cleared
+    storage._data_ids.clear()
+    storage.replace_last("test-1", Event(timestamp=now, data={"i": 0}))
+    assert len(datastrs()) == 3
+
+    storage.delete_bucket("test-2")
+    assert datastrs() == ['{"i": 0}', '{"i": 1}']
+    storage.delete_bucket("test-1")
+    assert datastrs() == []
+    storage.close()
+
+
+@pytest.mark.parametrize("storage_sid", ["sqlite", "sqlite-partitioned"])
+def test_sqlite_eventdata_unused(tmp_path, storage_sid):
+    """
+    Tests that data no event uses anymore is removed when events are deleted or replaced
+    """
+    storage = get_storage_methods()[storage_sid](
+        testing=True, filepath=str(tmp_path / "test")
+    )
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+
+    def datastrs():
+        if storage_sid == "sqlite-partitioned":
+            conn = storage._partition(storage._partition_keys[0])
+        else:
+            conn = storage.conn
+        rows = conn.execute("SELECT datastr FROM eventdata ORDER BY id")
+        return [row[0] for row in rows]
+
+    e1 = storage.insert_one("test", Event(timestamp=now, data={"a": 1}))
+    e2 = storage.insert_one("test", Event(timestamp=now + td1s, data={"a": 1}))
+    storage.insert_one("test", Event(timestamp=now + 2 * td1s, data={"b": 1}))
+    assert datastrs() == ['{"a": 1}', '{"b": 1}']
+
+    # Still used by another event
+    storage.delete("test", e1.id)
+    assert datastrs() == ['{"a": 1}', '{"b": 1}']
+    storage.replace("test", e2.id, Event(timestamp=now + td1s, data={"c": 1}))
+    assert datastrs() == ['{"b": 1}', '{"c": 1}']
+    storage.replace_last("test", Event(timestamp=now + 2 * td1s, data={"d": 1}))
+    assert datastrs() == ['{"c": 1}', '{"d": 1}']
+    storage.delete("test", e2.id)
+    assert datastrs() == ['{"d": 1}']
+
+    # Removed data isn't looked up in the cache when inserted again
+    storage.insert_one("test", Event(timestamp=now + 3 * td1s, data={"c": 1}))
+    assert datastrs() == ['{"d": 1}', '{"c": 1}']
+    assert [e.data for e in storage.get_events("test", -1)] == [{"c": 1}, {"d": 1}]
+    storage.close()
+
+
+def test_sqlite_partitioned(tmp_path):
+    """
+    Tests that events are stored in the partition of the month they start in,
+    and that events are still found across partitions and after sealing them
+    """
+    from aw_datastore.storages import PartitionedSqliteStorage
+
+    dirpath = str(tmp_path / "partitioned")
+    storage = PartitionedSqliteStorage(testing=True, filepath=dirpath)
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+
+    start = datetime(2023, 1, 31, 12, tzinfo=timezone.utc)
+    events = [
+        Event(timestamp=start + i * timedelta(days=1), duration=td1s, data={"i": i})
+        for i in range(40)
+    ]
+    # Starts in January and ends after all other events, in March
+    events.append(Event(timestamp=start, duration=timedelta(days=45), data={"long": 1}))
+    storage.insert_many("test", events)
+    assert sorted(f for f in os.listdir(dirpath) if f.endswith(".db")) == [
+        "buckets.db",
+        "events-2023-01.db",
+        "events-2023-02.db",
+        "events-2023-03.db",
+    ]
+
+    fetched = storage.get_events("test", -1)
+    assert len(fetched) == 41
+    assert fetched[0].data == {"long": 1}
+    assert [e.data["i"] for e in fetched[1:]] == list(reversed(range(40)))
+    assert storage.get_events("test", 3) == fetched[:3]
+    assert list(storage.iter_events("test", chunksize=7)) == fetched
+
+    # The long event is found from its partition when only querying March
+    march = datetime(2023, 3, 1, tzinfo=timezone.utc)
+    in_march = storage.get_events("test", -1, march, march + timedelta(days=31))
+    assert len(in_march) == 12
+    assert in_march[0].data == {"long": 1}
+    assert storage.get_eventcount("test", march, march + timedelta(days=31)) == 12
+
+    # Moving an event to another month gives it a new id
+    moved = Event(**fetched[0])
+    moved.timestamp = march + timedelta(days=20)
+    storage.replace("test", fetched[0].id, moved)
+    assert storage.get_event("test", fetched[0].id) is None
+    assert storage.get_event("test", moved.id) == moved
+
+    # Sealed partitions can still be read, but not modified
+    assert len(storage.seal_partitions(march)) == 2
+    assert len(storage.get_events("test", -1)) == 41
+    with pytest.raises(ValueError):
+        storage.delete("test", fetched[-1].id)
+    storage.close()
+
+    # Sealed partitions are detected when the storage is opened again
+    storage = PartitionedSqliteStorage(testing=True, filepath=dirpath)
+    assert len(storage.get_events("test", -1, march)) == 12
+    assert storage.compact_partitions() == [os.path.join(dirpath, "events-2023-03.db")]
+    storage.close()
+
+
+def test_sqlite_partitioned_iter_checkpoint(tmp_path):
+    """
+    Tests that iterating over the events of a partition doesn't keep its connection
+    reading between chunks, which would block checkpoints of the partition
+    """
+    import sqlite3
+
+    from aw_datastore.storages import PartitionedSqliteStorage
+
+    storage = PartitionedSqliteStorage(testing=True, filepath=str(tmp_path))
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+    start = datetime(2024, 5, 10, tzinfo=timezone.utc)
+    storage.insert_many(
+        "test", [Event(timestamp=start + i * td1s, duration=td1s) for i in range(100)]
+    )
+    storage.commit()
+    events = storage.iter_events("test", chunksize=7)
+    assert next(events).timestamp == start + 99 * td1s
+
+    conn = sqlite3.connect(storage._partition_path(storage._partition_keys[0]))
+    busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    assert busy == 0
+    conn.close()
+    assert len(list(events)) == 99
+    storage.close()
+
+
+@pytest.mark.parametrize("storage_sid", ["sqlite", "sqlite-partitioned"])
+def test_sqlite_rollups(tmp_path, storage_sid):
+    """
+    Tests that merging events by keys from the rollups gives the same durations
+    as merging the events, and that the rollups follow changes to the events
+    """
+    from aw_transform import merge_events_by_keys
+
+    storage_method = get_storage_methods()[storage_sid]
+    filepath = str(tmp_path / "rollups")
+    keys = ["app", "title"]
+    storage = storage_method(testing=True, filepath=filepath, rollup_keys=[keys])
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+
+    start = datetime(2023, 1, 31, 22, 17, 3, 123000, tzinfo=timezone.utc)
+    events = [
+        Event(
+            timestamp=start + i * timedelta(minutes=7),
+            duration=timedelta(minutes=5, seconds=i),
+            data={"app": f"app{i % 3}", "title": f"title{i % 5}"},
+        )
+        for i in range(100)
+    ]
+    # Spans several hours and a month boundary, and misses one of the keys
+    events.append(
+        Event(timestamp=start, duration=timedelta(hours=5), data={"app": "x"})
+    )
+    # Values that are equal in Python but not in JSON are merged
+    for hours, app in [(1, 1), (3, 1.0)]:
+        events.append(
+            Event(
+                timestamp=start + timedelta(hours=hours),
+                duration=timedelta(minutes=3),
+                data={"app": app, "title": "n"},
+            )
+        )
+    storage.insert_many("test", events)
+    storage.insert_one("test", Event(timestamp=start, data={"app": "zero"}))
+
+    def assert_rollup(starttime=None, endtime=None):
+        expected = merge_events_by_keys(
+            storage.get_events("test", -1, starttime, endtime), keys
+        )
+        rollup = storage.get_rollup("test", keys, starttime, endtime)
+        assert rollup is not None
+        assert sorted((e.duration, str(e.data)) for e in rollup) == sorted(
+            (e.duration, str(e.data)) for e in expected
+        )
+
+    def assert_rollups():
+        assert_rollup()
+        assert_rollup(start + timedelta(minutes=50))
+        assert_rollup(None, start + timedelta(hours=3, minutes=1))
+        # Partial hours at both ends
+        assert_rollup(start + timedelta(minutes=50), start + timedelta(hours=6))
+        # Whole hours
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        assert_rollup(hour + timedelta(hours=1), hour + timedelta(hours=4))
+        # Within a single hour
+        assert_rollup(hour + timedelta(minutes=5), hour + timedelta(minutes=55))
+
+    assert_rollups()
+    assert storage.get_rollup("test", ["app"]) is None
+
+    # Heartbeats, replacing and deleting
+    last = storage.get_events("test", 1)[0]
+    last.duration += timedelta(hours=1)
+    storage.replace_last("test", last)
+    first = storage.get_events("test", -1)[-1]
+    first.data = {"app": "replaced", "title": "replaced"}
+    first.timestamp -= timedelta(hours=2)
+    storage.replace("test", first.id, first)
+    storage.delete("test", storage.get_events("test", -1)[5].id)
+    assert_rollups()
+    storage.close()
+
+    # Rollups for new keys are filled from the existing events
+    keys = ["app"]
+    storage = storage_method(testing=True, filepath=filepath, rollup_keys=[keys])
+    assert storage.get_rollup("test", ["app", "title"]) is None
+    assert_rollups()
+    storage.delete_bucket("test")
+    assert storage.conn.execute("SELECT count(*) FROM rollups").fetchone()[0] == 0
+    storage.close()
+
+
+@pytest.mark.parametrize("storage_sid", ["sqlite", "sqlite-partitioned"])
+def test_sqlite_indexed_keys(tmp_path, storage_sid):
+    """
+    Tests that indexed keys get a generated column, which filters look up events
+    with, and that the columns are dropped when the keys aren't indexed anymore
+    """
+    import sqlite3
+
+    from aw_datastore.storages import DataFilter
+    from aw_datastore.storages.filters import get_indexed_keys
+
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        pytest.skip("SQLite doesn't support generated columns")
+
+    storage_method = get_storage_methods()[storage_sid]
+    filepath = str(tmp_path / "indexed")
+    indexed_keys = {"currentwindow": ["app", "title"], "web.tab.current": ["title"]}
+    storage = storage_method(testing=True, filepath=filepath, indexed_keys=indexed_keys)
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+    titles = ["a", 1, {"nested": "a"}, None]
+    storage.insert_many(
+        "test",
+        [
+            Event(
+                timestamp=now + i * td1s,
+                duration=td1s,
+                data={"app": f"app{i % 3}", "title": titles[i % 4]},
+            )
+            for i in range(30)
+        ],
+    )
+
+    def eventdata_conn():
+        if storage_sid == "sqlite-partitioned":
+            return storage._partition(storage._partition_keys[0])
+        return storage.conn
+
+    filters_list = [
+        [DataFilter("app", ("app1", "app2"))],
+        [DataFilter("app", ("app1",)), DataFilter("title", ("a", 1), exclude=True)],
+        [DataFilter("title", ("a",)), DataFilter("title", regex="a")],
+        [DataFilter("title", ("nested",), exclude=True)],
+    ]
+
+    def assert_filtered():
+        events = storage.get_events("test", -1)
+        for filters in filters_list:
+            filtered = storage.iter_events_filtered("test", filters)
+            assert filtered is not None
+            assert list(filtered) == [
+                e for e in events if all(f.match(e.data) for f in filters)
+            ]
+
+    assert get_indexed_keys(eventdata_conn()) == {"app", "title"}
+    statements: list = []
+    eventdata_conn().set_trace_callback(statements.append)
+    assert_filtered()
+    eventdata_conn().set_trace_callback(None)
+
+    # Filters selecting values of indexed keys look up the data with the index
+    seeks = [s for s in statements if "dataid IN" in s]
+    assert len(seeks) == 3
+    for statement in seeks:
+        plan = eventdata_conn().execute("EXPLAIN QUERY PLAN " + statement)
+        assert any("eventdata_index_data." in row[-1] for row in plan), statement
+    storage.close()
+
+    storage = storage_method(
+        testing=True, filepath=filepath, indexed_keys={"currentwindow": ["app"]}
+    )
+    assert get_indexed_keys(eventdata_conn()) == {"app"}
+    assert_filtered()
+    storage.close()
+
+
+@pytest.mark.parametrize("storage_sid", ["sqlite", "sqlite-partitioned"])
+def test_sqlite_search(tmp_path, storage_sid):
+    """
+    Tests that searching with the full-text index gives the same events as searching
+    all of them, as events are inserted, replaced and deleted
+    """
+    from aw_datastore.storages import DataFilter, SearchFilter
+    from aw_datastore.storages.search import HAS_FTS5
+
+    if not HAS_FTS5:
+        pytest.skip("SQLite doesn't support FTS5")
+
+    storage_method = get_storage_methods()[storage_sid]
+    filepath = str(tmp_path / "search")
+    storage = storage_method(
+        testing=True, filepath=filepath, search_keys=["title", "url"]
+    )
+    assert storage.supports_search
+    storage.create_bucket("test", "test", "test", "test", now.isoformat())
+    titles = ["Issues · GitHub", "github_search", "Hub", 1, "Ünïcode GIT"]
+    urls = ["https://github.com/ActivityWatch", "https://example.com/git", None]
+    storage.insert_many(
+        "test",
+        [
+            Event(
+                timestamp=now + i * td1s,
+                duration=td1s,
+                data={"title": titles[i % 5], "url": urls[i % 3], "app": i % 2},
+            )
+            for i in range(30)
+        ],
+    )
+
+    searches = [
+        SearchFilter("git"),
+        SearchFilter("GIT hub"),
+        SearchFilter("issues github"),
+        SearchFilter("example.com/git"),
+        SearchFilter("ünï"),
+        SearchFilter("search", ("title",)),
+        SearchFilter("nothing"),
+    ]
+
+    def assert_searches():
+        events = storage.get_events("test", -1)
+        for search in searches:
+            for filters in [(), (DataFilter("app", (1,)),)]:
+                found = storage.search_events("test", search, filters=filters)
+                assert found is not None
+                assert list(found) == [
+                    e
+                    for e in events
+                    if search.match(e.data) and all(f.match(e.data) for f in filters)
+                ]
+
+    assert_searches()
+    # Searches on keys without an index, or without words, aren't done by the storage
+    assert storage.search_events("test", SearchFilter("1", ("app",))) is None
+    assert storage.search_events("test", SearchFilter(" ")) is None
+
+    last = storage.get_events("test", 1)[0]
+    last.data = {"title": "Replaced git"}
+    storage.replace_last("test", last)
+    first = storage.get_events("test", -1)[-1]
+    storage.replace("test", first.id, Event(**{**first, "data": {"url": "git"}}))
+    storage.delete("test", storage.get_events("test", -1)[5].id)
+    assert_searches()
+    storage.close()
+
+    # The index is rebuilt when the keys change
+    storage = storage_method(testing=True, filepath=filepath, search_keys=["title"])
+    assert storage.search_events("test", SearchFilter("git")) is None
+    searches = [SearchFilter("git", ("title",)), SearchFilter("replaced", ("title",))]
+    assert_searches()
+    storage.close()
+
+    storage = storage_method(testing=True, filepath=filepath)
+    assert not storage.supports_search
+    storage.close()
+
+
+def test_benchmark_small():
+    """Operations that don't run at a small size have no latencies"""
+    from aw_datastore.benchmark import benchmark
+    from aw_datastore.storages import MemoryStorage
+
+    result = benchmark(MemoryStorage, num_events=50, num_reads=2)
+    summaries = {summary["op"]: summary for summary in result["operations"]}
+    assert summaries["insert_bulk"]["calls"] == 0
+    assert summaries["insert_bulk"]["p50_ms"] is None
+    assert summaries["insert_bulk"]["p99_ms"] is None
+    assert all(s["p50_ms"] is not None for s in summaries.values() if s["calls"])
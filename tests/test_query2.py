@@ -4,23 +4,32 @@ from typing import Any, Dict
 import iso8601
 import pytest
 from aw_core.models import Event
-from aw_datastore.storages import MemoryStorage
-from aw_query import query
+from aw_datastore import Datastore
+from aw_datastore.storages import DataFilter, MemoryStorage, SqliteStorage
+from aw_query import QueryCache, query
 from aw_query.exceptions import (
     QueryFunctionException,
     QueryInterpretException,
     QueryParseException,
 )
 from aw_query.query2 import (
+    QAssignment,
     QDict,
     QFunction,
     QInteger,
     QList,
+    QMaterialize,
+    QMemoizedFunction,
     QString,
     QVariable,
+    _parse_program,
     _parse_token,
     _split_query_statements,
+    compile_query,
+    plan,
 )
+from aw_query.stream import EventStream
+from aw_transform import filter_keyvals
 
 from .utils import param_datastore_objects
 
@@ -279,6 +288,244 @@ RETURN = my_multiline_string;
     assert result == "a\nb"
 
 
+def test_query2_compile():
+    example_query = "a = [1, 'b', {'c': d}]; RETURN = nop(a);"
+    program = compile_query(example_query)
+    assert compile_query(example_query) is program
+    assert program.statements == (
+        QAssignment(
+            "a",
+            QList((QInteger(1), QString("b"), QDict((("c", QVariable("d")),)))),
+        ),
+        QAssignment("RETURN", QFunction("nop", (QVariable("a"),))),
+    )
+    with pytest.raises(AttributeError):
+        program.statements[0].name = "b"  # type: ignore
+
+
+def test_query2_plan():
+    program = plan(
+        _parse_program(
+            """
+            a = query_bucket("a");
+            unused = query_bucket("b");
+            b = nop();
+            b = query_bucket("a");
+            RETURN = [a, b, query_bucket(find_bucket("c")), query_bucket("b")];
+            """
+        )
+    )
+    a = QMemoizedFunction("query_bucket", (QString("a"),))
+    assert program.statements == (
+        QAssignment("a", a),
+        QAssignment("b", a),
+        QAssignment(
+            "RETURN",
+            QList(
+                (
+                    QVariable("a"),
+                    QVariable("b"),
+                    QFunction(
+                        "query_bucket", (QFunction("find_bucket", (QString("c"),)),)
+                    ),
+                    QFunction("query_bucket", (QString("b"),)),
+                )
+            ),
+        ),
+    )
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_query2_plan_implicit_variables(datastore):
+    """Assignments to variables read by functions from the namespace are kept"""
+    bid = "test_query2_plan_implicit_variables"
+    starttime = iso8601.parse_date("2020-01-01T00:00:00+00:00")
+    endtime = starttime + timedelta(hours=4)
+    example_query = f"""
+    STARTTIME = "2020-01-01T03:00:00+00:00";
+    RETURN = sum_durations(query_bucket("{bid}"));
+    """
+    try:
+        bucket = datastore.create_bucket(
+            bucket_id=bid, type="test", client="test", hostname="test"
+        )
+        bucket.insert(
+            [
+                Event(
+                    timestamp=starttime + i * timedelta(hours=1),
+                    duration=timedelta(minutes=10 * (i + 1)),
+                )
+                for i in range(4)
+            ]
+        )
+        duration = query("test", example_query, starttime, endtime, datastore)
+        assert duration == timedelta(minutes=40)
+    finally:
+        datastore.delete_bucket(bid)
+
+
+def test_query2_plan_materialize():
+    program = plan(
+        _parse_program(
+            """
+            events = query_bucket("a");
+            events = categorize(events, []);
+            RETURN = [events, sum_durations(events)];
+            """
+        )
+    )
+    categorized = QFunction("categorize", (QVariable("events"), QList(())))
+    assert program.statements[1] == QAssignment("events", QMaterialize(categorized))
+
+
+def test_query2_event_stream():
+    now = datetime.now(tz=timezone.utc)
+    events = [Event(timestamp=now, data={"a": i % 2}) for i in range(2500)]
+    reads = []
+
+    def source(filters):
+        reads.append(filters)
+        return (e for e in events if all(f.match(e.data) for f in filters))
+
+    # The filter is passed to the source, the filter after the transform isn't
+    stream = EventStream(source).filter(
+        DataFilter("a", vals=(1,)), lambda chunk: filter_keyvals(chunk, "a", [1])
+    )
+    stream = stream.pipe(lambda chunk: [e for e in chunk if e.duration == timedelta()])
+    stream = stream.filter(DataFilter("a", vals=(0,)), lambda chunk: chunk)
+    assert reads == []
+    assert stream.materialize() == events[1::2]
+    assert stream.materialize() is stream.materialize()
+    assert list(stream) == events[1::2]
+    assert reads == [(DataFilter("a", vals=(1,)),)]
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_query2_memoized_calls(datastore):
+    bid = "test_query2_memoized_calls"
+    starttime = iso8601.parse_date("2020-01-01")
+    endtime = starttime + timedelta(hours=1)
+    example_query = f"""
+    events = query_bucket(find_bucket("{bid}"));
+    events = categorize(events, [[["Test"], {{"type": "regex", "regex": "test"}}]]);
+    RETURN = [events, query_bucket(find_bucket("{bid}"))];
+    """
+    try:
+        bucket = datastore.create_bucket(
+            bucket_id=bid, type="test", client="test", hostname="test"
+        )
+        bucket.insert(
+            Event(
+                timestamp=starttime, duration=timedelta(seconds=1), data={"a": "test"}
+            )
+        )
+        categorized, events = query(
+            "test", example_query, starttime, endtime, datastore
+        )
+        assert categorized[0].data == {"a": "test", "$category": ["Test"]}
+        # Events reused from the first call aren't affected by categorize
+        assert events[0].data == {"a": "test"}
+    finally:
+        datastore.delete_bucket(bid)
+
+
+def test_query2_event_stream_aggregate():
+    events = [Event(timestamp=datetime.now(tz=timezone.utc), data={"a": 1})]
+    calls = []
+
+    def source(filters):
+        raise AssertionError("Events shouldn't be read")
+
+    def aggregate(keys, filters):
+        calls.append((keys, filters))
+        return events
+
+    f1, f2 = DataFilter("a", vals=(1,)), DataFilter("b", vals=(2,))
+    stream = EventStream(source, aggregate=aggregate).filter(f1, lambda c: c)
+    assert stream.merge_by_keys(["a"]) == events
+    assert stream.share().filter(f2, lambda c: c).merge_by_keys([]) == events
+    assert calls == [(["a"], (f1,)), ([], (f1, f2))]
+    assert stream.pipe(lambda c: c).merge_by_keys(["a"]) is None
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_query2_aggregate(datastore):
+    bid = "test_query2_aggregate"
+    starttime = iso8601.parse_date("2020-01-01")
+    endtime = starttime + timedelta(hours=1)
+    example_query = f"""
+    merged = merge_events_by_keys(query_bucket("{bid}"), ["app"]);
+    filtered = filter_keyvals(query_bucket("{bid}"), "app", ["a"]);
+    RETURN = [merged, sum_durations(filtered), sum_durations(query_bucket("{bid}"))];
+    """
+    try:
+        bucket = datastore.create_bucket(
+            bucket_id=bid, type="test", client="test", hostname="test"
+        )
+        bucket.insert(
+            [
+                Event(
+                    timestamp=starttime + i * timedelta(minutes=1),
+                    duration=timedelta(seconds=i + 1),
+                    data={"app": app},
+                )
+                for i, app in enumerate(["a", "b", "a"])
+            ]
+        )
+        merged, filtered_duration, duration = query(
+            "test", example_query, starttime, endtime, datastore
+        )
+        assert [(e.data, e.duration) for e in merged] == [
+            ({"app": "a"}, timedelta(seconds=4)),
+            ({"app": "b"}, timedelta(seconds=2)),
+        ]
+        assert merged[0].timestamp == starttime + timedelta(minutes=2)
+        assert filtered_duration == timedelta(seconds=4)
+        assert duration == timedelta(seconds=6)
+    finally:
+        datastore.delete_bucket(bid)
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_query2_search_bucket(datastore):
+    bid = "test_query2_search_bucket"
+    starttime = iso8601.parse_date("2020-01-01")
+    endtime = starttime + timedelta(hours=1)
+    example_query = f"""
+    found = search_bucket("{bid}", "GIT hub");
+    RETURN = [found, filter_keyvals(found, "app", ["b"]), search_bucket("{bid}", "a", ["app"])];
+    """
+    try:
+        bucket = datastore.create_bucket(
+            bucket_id=bid, type="test", client="test", hostname="test"
+        )
+        bucket.insert(
+            [
+                Event(
+                    timestamp=starttime + i * timedelta(minutes=1),
+                    duration=timedelta(seconds=1),
+                    data=data,
+                )
+                for i, data in enumerate(
+                    [
+                        {"app": "a", "title": "GitHub"},
+                        {"app": "a", "title": "Hub", "url": "https://github.com"},
+                        {"app": "b", "title": "hubgit", "url": "https://git.hub"},
+                        {"app": "b", "title": "git", "url": 1},
+                    ]
+                )
+            ]
+        )
+        found, filtered, by_app = query(
+            "test", example_query, starttime, endtime, datastore
+        )
+        assert [e.data["app"] for e in found] == ["b", "a"]
+        assert [e.data["title"] for e in filtered] == ["hubgit"]
+        assert len(by_app) == 2
+    finally:
+        datastore.delete_bucket(bid)
+
+
 def test_query2_function_invalid_types():
     """Tests the q2_typecheck decorator"""
     ds = mock_ds
@@ -313,6 +560,29 @@ def test_query2_function_invalid_types():
     """
 
 
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_query2_function_invalid_types_stream(datastore):
+    """Event streams are only accepted as arguments for events"""
+    bid = "test_query2_function_invalid_types_stream"
+    starttime = iso8601.parse_date("1970-01-01")
+    endtime = iso8601.parse_date("1970-01-02")
+    try:
+        datastore.create_bucket(
+            bucket_id=bid, type="test", client="test", hostname="test"
+        )
+        for example_query in [
+            f'RETURN = filter_keyvals(query_bucket("{bid}"), "a", query_bucket("{bid}"));',
+            f'RETURN = merge_events_by_keys(query_bucket("{bid}"), query_bucket("{bid}"));',
+            f'RETURN = categorize(query_bucket("{bid}"), query_bucket("{bid}"));',
+        ]:
+            with pytest.raises(QueryFunctionException):
+                query("test", example_query, starttime, endtime, datastore)
+        example_query = f'RETURN = filter_keyvals(query_bucket("{bid}"), "a", []);'
+        assert query("test", example_query, starttime, endtime, datastore) == []
+    finally:
+        datastore.delete_bucket(bid)
+
+
 def test_query2_function_invalid_argument_count():
     ds = mock_ds
     qname = "asd"
@@ -506,6 +776,57 @@ def test_query2_test_merged_keys(datastore):
         datastore.delete_bucket(bid)
 
 
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_query2_query_bucket_merged(datastore):
+    """Tests query_bucket_merged, with and without rollups for the keys"""
+    bid = "bucket1"
+    starttime = iso8601.parse_date("2080")
+    endtime = starttime + timedelta(hours=3)
+
+    example_query = f"""
+    events = query_bucket_merged("{bid}", ["label1", "label2"]);
+    RETURN = events;
+    """
+    try:
+        bucket = datastore.create_bucket(
+            bucket_id=bid, type="test", client="test", hostname="test"
+        )
+        bucket.insert(
+            [
+                Event(
+                    data={"label1": "test1", "label2": f"test{i % 2}"},
+                    timestamp=starttime
+                    + i * timedelta(minutes=20)
+                    - timedelta(minutes=10),
+                    duration=timedelta(minutes=15),
+                )
+                for i in range(9)
+            ]
+        )
+        result = query("test", example_query, starttime, endtime, datastore)
+        assert [e.data for e in result] == [
+            {"label1": "test1", "label2": "test0"},
+            {"label1": "test1", "label2": "test1"},
+        ]
+        # The first event is trimmed to the range
+        assert [e.duration for e in result] == [
+            timedelta(minutes=65),
+            timedelta(minutes=60),
+        ]
+    finally:
+        datastore.delete_bucket(bid)
+
+
+def test_query2_query_bucket_merged_rollups(tmp_path):
+    datastore = Datastore(
+        SqliteStorage,
+        testing=True,
+        filepath=str(tmp_path / "test.db"),
+        rollup_keys=[["label1", "label2"]],
+    )
+    test_query2_query_bucket_merged(datastore)
+
+
 @pytest.mark.parametrize("datastore", param_datastore_objects())
 def test_query2_fancy_query(datastore):
     """
@@ -597,3 +918,149 @@ def test_query2_query_categorize(datastore):
         assert result["events_by_cat"][1].duration == timedelta(seconds=2)
     finally:
         datastore.delete_bucket(bid)
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_query2_cache(datastore):
+    """Tests that cached results are reused until events in the queried range change"""
+    bid = "test_query2_cache"
+    starttime = iso8601.parse_date("2020-01-01")
+    endtime = starttime + timedelta(hours=1)
+    example_query = f"""
+    events = query_bucket("{bid}");
+    RETURN = sum_durations(events);
+    """
+    cache = QueryCache()
+    try:
+        bucket = datastore.create_bucket(
+            bucket_id=bid, type="test", client="test", hostname="test"
+        )
+        bucket.insert(Event(timestamp=starttime, duration=timedelta(seconds=1)))
+
+        def cached_query():
+            return cache.query("test", example_query, starttime, endtime, datastore)
+
+        assert cached_query() == timedelta(seconds=1)
+        assert cached_query() == timedelta(seconds=1)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # Events outside of the range don't invalidate the result
+        bucket.heartbeat(Event(timestamp=endtime + timedelta(seconds=10)), 60)
+        bucket.heartbeat(Event(timestamp=endtime + timedelta(seconds=20)), 60)
+        assert cached_query() == timedelta(seconds=1)
+        assert (cache.hits, cache.misses) == (2, 1)
+
+        # Events in the range do
+        e = bucket.insert(
+            Event(
+                timestamp=starttime + timedelta(minutes=1),
+                duration=timedelta(minutes=2),
+            )
+        )
+        assert cached_query() == timedelta(minutes=2, seconds=1)
+        assert e is not None
+        bucket.delete(e.id)
+        assert cached_query() == timedelta(seconds=1)
+        assert (cache.hits, cache.misses) == (2, 3)
+
+        # As do changes to the buckets
+        datastore.update_bucket(bid, name="test")
+        assert cached_query() == timedelta(seconds=1)
+        assert (cache.hits, cache.misses) == (2, 4)
+
+        # Least recently used results are evicted when the cache is full
+        cache.max_size = cache.size
+        cache.query("test", example_query, starttime, starttime, datastore)
+        assert len(cache) == 1
+    finally:
+        datastore.delete_bucket(bid)
+
+
+def test_query2_cache_name():
+    """Tests that results are cached by the name of the query, which it can read"""
+    datastore = Datastore(MemoryStorage, testing=True)
+    starttime = iso8601.parse_date("2020-01-01")
+    endtime = starttime + timedelta(hours=1)
+    cache = QueryCache()
+    for name in ["alice", "bob", "alice"]:
+        assert (
+            cache.query(name, "RETURN = NAME;", starttime, endtime, datastore) == name
+        )
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_query2_cache_concurrent_write():
+    """Tests that results of queries run while events are written aren't reused"""
+    datastore = Datastore(MemoryStorage, testing=True)
+    bid = "test_query2_cache_concurrent_write"
+    starttime = iso8601.parse_date("2020-01-01")
+    endtime = starttime + timedelta(hours=1)
+    example_query = f'RETURN = sum_durations(query_bucket("{bid}"));'
+    cache = QueryCache()
+
+    def cached_query():
+        return cache.query("test", example_query, starttime, endtime, datastore)
+
+    bucket = datastore.create_bucket(
+        bucket_id=bid, type="test", client="test", hostname="test"
+    )
+    storage = datastore.storage_strategy
+    insert_one = storage.insert_one
+    during_write = []
+
+    def interleaved_insert_one(bucket_id, event):
+        # Another thread runs the query before the event is written
+        during_write.append(cached_query())
+        return insert_one(bucket_id, event)
+
+    storage.insert_one = interleaved_insert_one  # type: ignore
+    bucket.insert(Event(timestamp=starttime, duration=timedelta(seconds=1)))
+    assert during_write == [timedelta(0)]
+    assert cached_query() == timedelta(seconds=1)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_query2_benchmark_stages():
+    """Tests that reading the events of a bucket is timed as part of query_bucket"""
+    import time
+
+    from aw_query.benchmark import benchmark_query
+
+    datastore = Datastore(MemoryStorage, testing=True)
+    bid = "test_query2_benchmark_stages"
+    starttime = iso8601.parse_date("2020-01-01")
+    endtime = starttime + timedelta(hours=1)
+    bucket = datastore.create_bucket(
+        bucket_id=bid, type="test", client="test", hostname="test"
+    )
+    bucket.insert(Event(timestamp=starttime, duration=timedelta(seconds=1)))
+    storage = datastore.storage_strategy
+    iter_events = storage.iter_events
+
+    def slow_iter_events(*args, **kwargs):
+        time.sleep(0.05)
+        yield from iter_events(*args, **kwargs)
+
+    storage.iter_events = slow_iter_events  # type: ignore
+    stats = benchmark_query(
+        datastore,
+        f'RETURN = sum_durations(categorize(flood(query_bucket("{bid}")), []));',
+        starttime,
+        endtime,
+    )["functions"]
+    assert stats["query_bucket"]["calls"] == 1
+    assert stats["query_bucket"]["total_s"] >= 0.05
+    assert stats["flood"]["total_s"] < 0.05
+    assert stats["sum_durations"]["total_s"] < 0.05
+
+
+@pytest.mark.parametrize("storage_name", ["SqliteStorage", "PartitionedSqliteStorage"])
+def test_query2_benchmark_temporary(tmp_path, monkeypatch, storage_name):
+    """Tests that the benchmark doesn't write to the data directory, so it can be rerun"""
+    from aw_query.benchmark import benchmark
+
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    for _ in range(2):
+        result = benchmark(storage_name, days=1, runs=1)
+        assert all(count > 0 for count in result["eventcounts"].values())
+    assert list(tmp_path.rglob("*.db")) == []